@@ -0,0 +1,179 @@
+"""
+Batched spectral index fitting for GLEAM catalogues
+
+A straight line in log(S)-log(nu) has a closed-form weighted least-squares
+solution, so every source of the catalogue is fitted with a few array sums
+rather than one scipy.optimize.leastsq call per source. Bands which are
+missing or below the flux limit are masked out of each source's fit.
+
+Curved spectra are fitted as polynomials in log frequency, e.g. the log-parabola
+S = S_ref (nu/nu_ref)^(alpha + q ln(nu/nu_ref)) for order 2, with one batched
+linear solve per chunk, and each source's preferred model is chosen with an
+F-test or the AIC.
+
+Usage example
+====
+import alpha_fit
+for fit in alpha_fit.fit_catalogue(data, freqs, order=2):
+    rows, alpha, curved = fit['rows'], fit['alpha'], fit['curved']
+====
+"""
+import numpy as np
+import scipy.stats as stats
+
+def fit_loglinear(x, y, err, mask=None):
+    '''
+    Weighted fit of y = log(amp) + alpha*x for every row of y.
+
+    x: (n_freq,) log frequencies; y, err: (n_src, n_freq) log flux densities and their errors.
+    mask: optional (n_src, n_freq) boolean array, True for the points to fit.
+
+    Returns alpha, err_alpha, amp, err_amp and chi2red as (n_src,) arrays, with the same
+    definitions as the per-source leastsq fit: err_amp is the error on log(amp), the errors
+    come from the unscaled covariance, and chi2red is divided by n_points - 2. Sources with
+    fewer than two usable points are NaN.
+    '''
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    err = np.asarray(err, dtype=float)
+    good = np.isfinite(y) & np.isfinite(err) & (err > 0)
+    if mask is not None:
+        good &= mask
+    with np.errstate(divide='ignore', invalid='ignore'):
+        w = np.where(good, 1./err**2, 0.)
+        y = np.where(good, y, 0.)
+
+    S = w.sum(axis=1)
+    Sx = np.dot(w, x)
+    Sxx = np.dot(w, x*x)
+    Sy = (w*y).sum(axis=1)
+    Sxy = (w*y*x).sum(axis=1)
+    npts = good.sum(axis=1)
+
+    det = S*Sxx - Sx**2
+    ok = (npts >= 2) & (det > 0)
+    det = np.where(ok, det, np.nan)
+
+    alpha = (S*Sxy - Sx*Sy)/det
+    lnamp = (Sxx*Sy - Sx*Sxy)/det
+    err_alpha = np.sqrt(S/det)
+    err_amp = np.sqrt(Sxx/det)
+
+    resid = y - lnamp[:, np.newaxis] - alpha[:, np.newaxis]*x
+    with np.errstate(divide='ignore', invalid='ignore'):
+        chi2red = np.where(good, resid**2*w, 0.).sum(axis=1)/(npts - 2)
+    return alpha, err_alpha, np.exp(lnamp), err_amp, chi2red
+
+def fit_logpoly(x, y, err, order, mask=None):
+    '''
+    Weighted fit of y = c_0 + c_1*x + ... + c_order*x^order for every row of y, with the
+    normal equations of all the rows solved in one batched call.
+
+    x, y, err, mask: as for fit_loglinear.
+    Returns the coefficients (n_src, order+1), their unscaled covariance (n_src, order+1, order+1),
+    chi2 and the number of points fitted. Sources with fewer than order+2 points are NaN.
+    '''
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    err = np.asarray(err, dtype=float)
+    good = np.isfinite(y) & np.isfinite(err) & (err > 0)
+    if mask is not None:
+        good &= mask
+    with np.errstate(divide='ignore', invalid='ignore'):
+        w = np.where(good, 1./err**2, 0.)
+        y = np.where(good, y, 0.)
+    npts = good.sum(axis=1)
+    nparams = order + 1
+
+    V = x[:, np.newaxis]**np.arange(nparams) # Vandermonde matrix, (n_freq, n_params)
+    A = np.einsum('nf,fi,fj->nij', w, V, V)
+    b = np.einsum('nf,fi,nf->ni', w, V, y)
+
+    # Leave at least one degree of freedom; singular systems are replaced so the batch solves
+    ok = (npts > nparams) & (np.abs(np.linalg.det(A)) > 0)
+    A[~ok] = np.eye(nparams)
+    cov = np.linalg.inv(A)
+    coeffs = np.einsum('nij,nj->ni', cov, b)
+    coeffs[~ok] = np.nan
+    cov[~ok] = np.nan
+
+    resid = y - np.dot(coeffs, V.T)
+    chi2 = np.where(good, resid**2*w, 0.).sum(axis=1)
+    chi2[~ok] = np.nan
+    return coeffs, cov, chi2, npts
+
+def select_model(chi2_lin, chi2_poly, npts, order, method='ftest', fprob=0.01):
+    '''
+    Whether the order-`order` polynomial is preferred to the straight line for each source.
+
+    'ftest': the extra terms are significant at probability fprob.
+    'aic': the polynomial has the lower Akaike information criterion.
+    Returns the boolean choice and the statistic: the F-test probability, or AIC(poly) - AIC(line).
+    '''
+    extra = order - 1
+    dof = npts - order - 1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if method == 'ftest':
+            F = ((chi2_lin - chi2_poly)/extra)/(chi2_poly/dof)
+            stat = stats.f.sf(F, extra, dof)
+            prefer = stat < fprob
+        elif method == 'aic':
+            stat = (chi2_poly + 2.*(order + 1)) - (chi2_lin + 4.)
+            prefer = stat < 0
+        else:
+            raise ValueError("method must be ftest or aic")
+    return prefer & np.isfinite(stat), stat
+
+def fit_catalogue(data, freqs, flux_limit=0.0, calerror=0.02, hldec_calerror=0.03,
+                  min_bands=None, chunk_size=20000, order=1, ref_freq=150.,
+                  select='ftest', fprob=0.01):
+    '''
+    Fit every source of a GLEAM catalogue, chunk_size rows at a time, so that only one
+    chunk of the (n_src, n_freq) flux and error arrays is in memory at once.
+
+    data: table with int_flux_<freq>, err_int_flux_<freq>, int_flux_wide and DEJ2000 columns.
+    freqs: the band names, e.g. "076".
+    Sources need int_flux_wide above flux_limit and at least min_bands bands (default all of
+    them) above it; only those bands are fitted. The calibration error is calerror for
+    -72 <= Dec <= 18.5 and hldec_calerror elsewhere, added in quadrature to err/flux.
+
+    For order > 1 the polynomial in ln(nu/ref_freq) is fitted to the same points and
+    compared with the straight line using select_model(select, fprob).
+
+    Yields a dictionary for each chunk with rows, the indices into data of the fitted sources,
+    and alpha, err_alpha, amp, err_amp and chi2red of the straight line. For order > 1 it also
+    has coeffs and err_coeffs of the polynomial (c_0 = ln S_ref, c_1 = alpha at ref_freq,
+    c_2 = q, ...), chi2red_poly, curved (True where the polynomial is preferred) and model_stat.
+    '''
+    if min_bands is None:
+        min_bands = len(freqs)
+    x = np.log(np.array([float(int(f)) for f in freqs]))
+    nrows = len(data["int_flux_wide"])
+    for start in range(0, nrows, chunk_size):
+        stop = min(start + chunk_size, nrows)
+        flux = np.column_stack([np.asarray(data["int_flux_"+f][start:stop], dtype=float) for f in freqs])
+        err = np.column_stack([np.asarray(data["err_int_flux_"+f][start:stop], dtype=float) for f in freqs])
+        with np.errstate(invalid='ignore'):
+            use = flux > flux_limit
+            bright = (np.asarray(data["int_flux_wide"][start:stop]) > flux_limit) & (use.sum(axis=1) >= min_bands)
+        rows = np.where(bright)[0]
+        flux, err, use = flux[rows], err[rows], use[rows]
+
+        dec = np.asarray(data["DEJ2000"][start:stop])[rows]
+        calibration_error = np.where((dec <= 18.5) & (dec >= -72.), calerror, hldec_calerror)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # Error propagation: error on log(x) = err_x/x
+            log_err = np.sqrt((err/flux)**2 + calibration_error[:, np.newaxis]**2)
+            log_flux = np.log(flux)
+
+        fit = {'rows': rows + start}
+        fit['alpha'], fit['err_alpha'], fit['amp'], fit['err_amp'], fit['chi2red'] = fit_loglinear(x, log_flux, log_err, use)
+        if order > 1:
+            coeffs, cov, chi2, npts = fit_logpoly(x - np.log(ref_freq), log_flux, log_err, order, use)
+            fit['coeffs'] = coeffs
+            fit['err_coeffs'] = np.sqrt(np.diagonal(cov, axis1=1, axis2=2))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                fit['chi2red_poly'] = chi2/(npts - order - 1)
+            fit['curved'], fit['model_stat'] = select_model(fit['chi2red']*(npts - 2), chi2, npts, order, select, fprob)
+        yield fit
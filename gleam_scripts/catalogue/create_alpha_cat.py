@@ -6,9 +6,6 @@
 
 import os, sys
 
-# Need a least-squares estimator that gives a useable error estimate
-from scipy.optimize import leastsq
-
 import numpy as np
 #tables and votables
 import astropy.io.fits as fits
@@ -16,10 +13,8 @@ from astropy.io.votable import parse_single_table
 from astropy.io.votable import writeto as writetoVO
 from astropy.table import Table, Column
 
-# Parallelise the code
-import multiprocessing
-# multiple cores support
-import pprocess
+# Closed-form fits to all the sources at once
+import alpha_fit
 
 import matplotlib.pyplot as plt
 
@@ -36,9 +31,19 @@ parser.add_option('--andre',type="string", dest="andre",
 #parser.add_option('--plot',action="store_true",dest="make_plots",default=False,
 #                  help="Make fit plots? (default = False)")
 parser.add_option('--order',dest="poly_order",default=1,type=int,
-                  help="Set the order of the polynomial fit. (default = 1)")
+                  help="Set the order of the polynomial in log frequency fitted alongside the straight line, e.g. 2 for a curved spectrum. (default = 1, straight line only)")
+parser.add_option('--ref_freq',dest="ref_freq",default=150.,type=float,
+                  help="Reference frequency in MHz of the polynomial fit. (default = 150)")
+parser.add_option('--select',dest="select",default="ftest",type="choice",choices=["ftest","aic"],
+                  help="How to choose between the straight line and the polynomial for each source: ftest or aic. (default = ftest)")
+parser.add_option('--fprob',dest="fprob",default=0.01,type=float,
+                  help="F-test probability below which the polynomial is preferred. (default = 0.01)")
 parser.add_option('--cores',dest="cores",default=None,type=int,
-                  help="How many cores to use. (default = all available)")
+                  help="Not used any more, since all sources are fitted at once; kept for compatibility.")
+parser.add_option('--min_bands',dest="min_bands",default=20,type=int,
+                  help="Minimum number of bands above the flux limit for a source to be fitted; fainter bands are left out of its fit (default = 20, i.e. all)")
+parser.add_option('--chunk_size',dest="chunk_size",default=20000,type=int,
+                  help="Number of catalogue rows to fit at a time (default = 20000)")
 parser.add_option('--limit',dest="flux_limit",default=0.0,type=float,
                   help="Minimum flux density at any frequency for source to be included to in fit (default = 0.0Jy)")
 parser.add_option('--calerror',dest="calerror",default=0.02,type=float,
@@ -47,20 +52,10 @@ parser.add_option('--hldec_calerror',dest="hldec_calerror",default=0.03,type=flo
                   help="Estimated calibration error for Dec<-72 and Dec>18.5 (default = 0.03, i.e. 3%)")
 (options, args) = parser.parse_args()
 
-# http://scipy-cookbook.readthedocs.org/items/FittingData.html
 # Define function for calculating a power law
 def powerlaw(x,amp,index):
     return amp * (x**index)
-vpowerlaw = np.vectorize(powerlaw)
-
-# define our (line) fitting function
-fitfunc = lambda p, x: p[0] + p[1] * x
-errfunc = lambda p, x, y, err: (y - fitfunc(p, x)) / err
 
-if options.cores is None:
-    cores = multiprocessing.cpu_count()
-else:
-    cores = options.cores
 if options.output is None:
     output="test.vot"
 else:
@@ -72,58 +67,12 @@ if options.catalogue is None:
 else:
     filename, file_extension = os.path.splitext(options.catalogue)
     if file_extension == ".fits":
-        temp = fits.open(options.catalogue)
+        temp = fits.open(options.catalogue, memmap=True)
         data = temp[1].data
-        temp.close()
     elif file_extension == ".vot":
         temp = parse_single_table(options.catalogue)
         data = temp.array
 
-# Spectral index fitting function
-
-def fit_spectrum(name,freq_array,flux_array,flux_errors): #,plot):
-    pinit = [-2.0, -0.7]
-    pinit = [0.0, -0.7]
-    fit = leastsq(errfunc, pinit, args=(freq_array, flux_array, flux_errors), full_output=1)
-    covar = fit[1]
-    if covar is not None:
-        P = fit[0]
-        residual = errfunc(P,freq_array, flux_array, flux_errors)
-        chi2red = sum(np.power(residual,2))/(len(freqs)-len(pinit))
-        alpha=P[1]
-        amp = np.exp(P[0])
-    # Errors
-        err_alpha = np.sqrt(covar[1][1])
-        err_amp = np.sqrt(covar[0][0])
-    else:
-        chi2red=None
-        alpha=None
-        amp=None
-        err_alpha=None
-        err_amp=None
-#    if plot:
-#        outpng=(name.replace(" ","_"))+".png"
-#        # Plot
-#        example=plt.figure(figsize=(10,5))
-#        example.suptitle(name)
-#        ax1=example.add_subplot(1,2,1)
-#        ax1.plot(np.exp(freq_array), powerlaw(np.exp(freq_array), amp, alpha),label="alpha={0:3.1f} ".format(alpha))     # Scipy Fit
-#        ax1.errorbar(np.exp(freq_array), np.exp(flux_array), yerr=flux_errors*np.exp(flux_array), fmt='k.')  # Data
-#        ax1.set_ylabel("S / Jy")
-#        ax1.set_xlabel("Frequency / MHz")
-#        ax1.legend()
-#        ax2=example.add_subplot(1,2,2)
-#        ax2.loglog(np.exp(freq_array), powerlaw(np.exp(freq_array), amp, alpha),label="alpha={0:3.1f} ".format(alpha))     # Scipy Fit
-#        ax2.errorbar(np.exp(freq_array), np.exp(flux_array), yerr=flux_errors*np.exp(flux_array), fmt='k.')  # Data
-##        ax2.set_xlim(left=xmin01,right=xmax01)
-##       ax2.set_ylim([min(np.exp(flux_array)),max(np.exp(flux_array))])
-#        ax2.set_ylabel("S / Jy")
-#        ax2.set_xlabel("Frequency / MHz")
-#        ax2.legend()
-#        example.savefig(outpng)
-#        example.clf()
-    return alpha, err_alpha, amp, err_amp, chi2red
-
 # Set up the parameters and do the fitting
 
 # Frequencies to write out -- use the full band since it shows the range I did the fitting over
@@ -132,70 +81,34 @@ freq2=231
 
 # Can't figure out how to read the bloody column names! hardcode
 freqs=["076", "084", "092", "099", "107",  "115", "122", "130", "143", "151", "158", "166", "174",  "181", "189","197", "204", "212", "220", "227"]
-# Frequencies
-freq_array = np.log(np.ma.array([float(int(x)) for x in freqs]),dtype="float32")
-
-# Select source flux densities that meet the flux limit criterion
-#if options.flux_limit is not None:
-#    brightsrcs = np.where(data["int_flux_wide"]>options.flux_limit)
-#else:
-#    brightsrcs = np.where(data["int_flux_wide"]>0.0)
-# And are not NaN at any frequency
-brightsrcs = np.where(data["int_flux_wide"]>options.flux_limit)
-for x in freqs:
-#    brightsrcs = np.intersect1d(brightsrcs,np.where(np.isfinite(data["int_flux_"+x])))
-    brightsrcs = np.intersect1d(brightsrcs,np.where(data["int_flux_"+x]>options.flux_limit))
-
-brightsrcs = np.squeeze(brightsrcs)
-
-print "Fitting",len(brightsrcs),"source spectral energy distributions"
-
-# Extreme Dec sources = 3% calibration error
-calibration_error = options.hldec_calerror*np.ones(len(brightsrcs))
-
-# Mid-range Dec sources = 2% calibration error
-midsrcs = np.intersect1d(np.where(data["DEJ2000"][brightsrcs]<=18.5),np.where(data["DEJ2000"][brightsrcs]>=-72.))
-midsrcs = np.squeeze(midsrcs)
-calibration_error[midsrcs] = options.calerror
-
-flux_list = []
-err_list = []
-for x in freqs:
-    flux_list.append(data["int_flux_"+x][brightsrcs])
-# Error propagation: error on log(x) = err_x/x
-    fitting_error = data["err_int_flux_"+x][brightsrcs]/data["int_flux_"+x][brightsrcs]
-    err_list.append(np.sqrt(fitting_error**2 + calibration_error**2))
-    
-flux_array = np.transpose(np.ma.vstack(flux_list)).astype("float32")
-flux_array = np.ma.log(flux_array)
-flux_errors = np.transpose(np.ma.vstack(err_list)).astype("float32")
-names = data["Name"][brightsrcs]
-
-#weights = 1/(flux_errors*flux_errors)
-
-results = pprocess.Map(limit=cores)
-calc = results.manage(pprocess.MakeParallel(fit_spectrum))
-
-for i in range(0,len(brightsrcs)):
-    calc(names[i],freq_array,flux_array[i],flux_errors[i]) # ,options.plot)
-
-# Unpack results
-alpha, err_alpha, amp, err_amp, chi2red = map(list, zip(*results))
+
+# Select sources with int_flux_wide and at least --min_bands bands above the flux limit,
+# and fit a straight line in log space to all of them at once, a chunk of rows at a time.
+# With --order > 1 a polynomial in log frequency is fitted to the same points in the same pass.
+# Extreme Dec sources get a 3% calibration error, mid-range Dec sources 2%.
+fits_list = list(alpha_fit.fit_catalogue(data, freqs,
+    flux_limit=options.flux_limit, calerror=options.calerror, hldec_calerror=options.hldec_calerror,
+    min_bands=options.min_bands, chunk_size=options.chunk_size, order=options.poly_order,
+    ref_freq=options.ref_freq, select=options.select, fprob=options.fprob))
+results = dict((key, np.concatenate([fit[key] for fit in fits_list])) for key in fits_list[0])
+brightsrcs = results['rows']
+
+print "Fitted",len(brightsrcs),"source spectral energy distributions"
 
 # Convert to numpy arrays
-alpha = np.array(alpha, dtype="float32")
-err_alpha = np.array(err_alpha, dtype="float32")
-amp = np.array(amp, dtype="float32")
-err_amp = np.array(err_amp, dtype="float32")
-chi2red = np.array(chi2red, dtype="float32")
+alpha = np.array(results['alpha'], dtype="float32")
+err_alpha = np.array(results['err_alpha'], dtype="float32")
+amp = np.array(results['amp'], dtype="float32")
+err_amp = np.array(results['err_amp'], dtype="float32")
+chi2red = np.array(results['chi2red'], dtype="float32")
 
 # Exclude any sources which came out with NaN alphas or amps
 good = np.squeeze(np.where(np.isfinite(alpha)))
 
 # Generate flux density columns
-flux1 = vpowerlaw(np.tile(freq1,len(amp[good])),amp[good],alpha[good])
+flux1 = powerlaw(freq1,amp[good],alpha[good])
 err_flux1 = err_amp[good]*flux1
-flux2 = vpowerlaw(np.tile(freq2,len(amp[good])),amp[good],alpha[good])
+flux2 = powerlaw(freq2,amp[good],alpha[good])
 err_flux2 = err_amp[good]*flux2
 
 # Generate the output VO table
@@ -214,6 +127,26 @@ outtable.add_column(Column(data=err_flux1,name='err_S_72'))
 outtable.add_column(Column(data=flux2,name='S_231'))
 outtable.add_column(Column(data=err_flux2,name='err_S_231'))
 
+if options.poly_order > 1:
+    # Polynomial coefficients in ln(nu/ref_freq): c_0 = ln S_ref, c_1 = alpha, c_2 = q, then c_3, ...
+    coeffs = np.array(results['coeffs'][good], dtype="float32")
+    err_coeffs = np.array(results['err_coeffs'][good], dtype="float32")
+    S_ref = np.exp(coeffs[:,0])
+    outtable.add_column(Column(data=S_ref,name='S_ref'))
+    outtable.add_column(Column(data=err_coeffs[:,0]*S_ref,name='err_S_ref'))
+    outtable.add_column(Column(data=coeffs[:,1],name='alpha_curved'))
+    outtable.add_column(Column(data=err_coeffs[:,1],name='err_alpha_curved'))
+    outtable.add_column(Column(data=coeffs[:,2],name='q'))
+    outtable.add_column(Column(data=err_coeffs[:,2],name='err_q'))
+    for k in range(3,options.poly_order+1):
+        outtable.add_column(Column(data=coeffs[:,k],name='c'+str(k)))
+        outtable.add_column(Column(data=err_coeffs[:,k],name='err_c'+str(k)))
+    outtable.add_column(Column(data=np.array(results['chi2red_poly'][good], dtype="float32"),name='reduced_chi2_curved'))
+    outtable.add_column(Column(data=np.array(results['model_stat'][good], dtype="float32"),name=('fprob' if options.select=="ftest" else 'delta_aic')))
+    outtable.add_column(Column(data=results['curved'][good],name='curved'))
+    outtable.meta['ref_freq'] = options.ref_freq
+    print "Polynomial preferred for",np.sum(results['curved'][good]),"of",np.size(good),"sources"
+
 if os.path.exists(output):
     os.remove(output)
 outtable.write(output,format='votable')
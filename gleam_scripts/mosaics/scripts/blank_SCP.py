@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 import sys
+import shutil
 import numpy as np
 import math
 
@@ -10,90 +11,116 @@ except ImportError:
     import pyfits
 
 from astropy import wcs
+import sky_coords
+import image_tiles
 from optparse import OptionParser
 
-usage="Usage: %prog [options] <file>\n"
-parser = OptionParser(usage=usage)
-parser.add_option('-r','--radius',dest="flag_radius",default=60.0,
-                  help="Radius in degrees to be flagged (default = 4 hours = 60 degrees)")
-parser.add_option('-f','--filename',dest="filename",default=None,
-                  help="Input file to blank <FILE>",metavar="FILE")
-parser.add_option('-o','--output',dest="output",default=None,
-                  help="Output file <FILE> (default = overwrite input)",metavar="FILE")
-(options, args) = parser.parse_args()
+def pole_row(w):
+    '''
+    Number of rows of an image with celestial WCS w lying south of the pole, i.e. the pixel row
+    of the pole rounded up, or 0 if the pole is not in the projection.
+    '''
+    # More efficient to do this with a standard WCS call
+    ycrd = w.wcs_world2pix([[0.0,-90]],1)[0][1]
+    if not np.isfinite(ycrd):
+        return 0
+# We get "whiskers" unless we aggressively round up, here.
+    return max(0,int(math.ceil(ycrd)))
 
-# For unwrapping RA values which bridge the meridian
-def unwrap(x):
-    if x>180:
-        return x-360
-    else:
-        return x
-vunwrap=np.vectorize(unwrap)
+def blank_pixels(rows,ra,south,midra,flag_radius):
+    '''True for the pixels to blank in the block of rows with RAs ra.'''
+# RA from midra, wrapped onto [-180, 180), so it does not matter whether the RAs or midra are
+# negative or the meridian is in the image
+    with np.errstate(invalid='ignore'):
+        dra=np.mod(ra-midra+180.,360.)-180.
+# Pixels to keep within RA range; those not on the sky are blanked too
+        blank=np.logical_not(np.abs(dra)<=flag_radius)
+# Blank everything south of the pole
+    if south > rows.start:
+        blank[0:south-rows.start,:]=True
+    return blank
 
-if options.filename is None:
-    print "Must supply a filename"
-    sys.exit(1)
-else:
-    if options.output:
-        output=options.output
-    else:
-        output=options.filename #.replace('.fits','_crop.fits')
-    # Snapshot observation:
-    # wcs in format [stokes,freq,x,y]; stokes and freq are length 1 if they exist
-    hdu_in = pyfits.open(options.filename)
-    original_shape=hdu_in[0].data.shape
-    w = wcs.WCS(hdu_in[0].header,naxis=2)
+def blank_mask(rows,ra,south,midra,flag_radius):
+    '''1 for the pixels to keep in the block of rows with RAs ra, NaN for those to blank.'''
+    mask=np.ones(shape=ra.shape,dtype=np.float32)
+    mask[blank_pixels(rows,ra,south,midra,flag_radius)]=np.nan
+    return mask
 
-    if len(original_shape)>2:
-        scidata = np.squeeze(hdu_in[0].data)
-    else:
-        scidata=hdu_in[0].data
+def blank_image(image,w,midra,flag_radius,tile_rows=256,threads=1,coords=None):
+    '''
+    Write NaN in place over the pixels of the 2D image, with celestial WCS w, south of the pole
+    or further than flag_radius degrees in RA from midra, a tile of rows at a time. image can be
+    a writable memmap of the file. Tiles wholly south of the pole need no coordinates.
+    '''
+    south = pole_row(w)
+    def tile(rows,ra,dec):
+        if rows.stop <= south:
+            image[rows]=np.nan
+        else:
+            block=image[rows]
+            block[blank_pixels(rows,ra,south,midra,flag_radius)]=np.nan
+    image_tiles.run_sky_tiles(tile,w,image.shape,tile_rows,threads,coords,skip=lambda rows: rows.stop <= south)
 
-# Blank everything south of the pole
-# More efficient to do this with a standard WCS call
-    ycrd = w.wcs_world2pix([[0.0,-90]],1)[0][1]
-# We get "whiskers" unless we aggressively round up, here.
-    scidata[0:int(math.ceil(ycrd)),:]=np.nan
+if __name__ == '__main__':
 
-# Now blank everything within the RA range: better to do this like MIMAS
-    #create an array but don't set the values (they are random)
-    indexes = np.empty( (scidata.shape[0]*scidata.shape[1],2),dtype=int)
-    #since I know exactly what the index array needs to look like I can construct
-    # it faster than list comprehension would allow
-    #we do this only once and then recycle it
-    idx = np.array([ (j,0) for j in xrange(scidata.shape[1])])
-    j=scidata.shape[1]
-    for i in xrange(scidata.shape[0]):
-        idx[:,1]=i
-        indexes[i*j:(i+1)*j] = idx
-#put ALL the pixels into our vectorized functions and minimise our overheads
-    ra,dec = w.wcs_pix2world(indexes,1).transpose()
+    usage="Usage: %prog [options] <file>\n"
+    parser = OptionParser(usage=usage)
+    parser.add_option('-r','--radius',dest="flag_radius",default=60.0,type=float,
+                      help="Radius in degrees to be flagged (default = 4 hours = 60 degrees)")
+    parser.add_option('-f','--filename',dest="filename",default=None,
+                      help="Input file to blank <FILE>",metavar="FILE")
+    parser.add_option('-o','--output',dest="output",default=None,
+                      help="Output file <FILE> (default = overwrite input)",metavar="FILE")
+    parser.add_option('--coord_cache',type="string", dest="coord_cache", default=None,
+                        help="Directory in which to cache the RA/Dec maps of each projection, so that mosaics sharing it reuse them (default = no cache)")
+    parser.add_option('--coord_cache_size',dest="coord_cache_size", default=20.,type=float,
+                        help="Maximum size of the coordinate cache in GB; the least recently used maps are deleted (default = 20)")
+    parser.add_option('--tile_rows','--tile-rows',dest="tile_rows",default=256,type=int,
+                        help="Number of rows corrected at a time (default = 256)")
+    parser.add_option('--threads',dest="threads",default=1,type=int,
+                        help="Number of tiles of rows to correct at once, on separate threads (default = 1)")
+    (options, args) = parser.parse_args()
 
-    midra=hdu_in[0].header['CRVAL1']
-# Want to find out if we need to unwrap RA, by looking at the pixel above ycrd
-    minra=w.wcs_pix2world([[3*scidata.shape[0]/4,ycrd+1]],1)[0][0]
-    maxra=w.wcs_pix2world([[scidata.shape[0]/4,ycrd+1]],1)[0][0]
-# WCS tends to be negative for snapshots for some reason
-    if (minra < 0) or (maxra < 0):
-        ra+=360.0
-# midra must match ra
-        midra+=360
-# And my unwrap function only works for +ve RAs
-    if maxra < minra:
-        ra=vunwrap(ra)
-# So at the end of all that, if the meridian is in the image, RA must lie between -180 and +180
-# So midra must also lie in that range
-        if midra > 180.:
-            midra-=360.
-
-# Pixels to keep within RA range
-    mask1d=np.ones(shape=ra.shape,dtype=np.float32)
-    mask1d[np.where(ra<(midra-options.flag_radius))]=np.nan
-    mask1d[np.where(ra>(midra+options.flag_radius))]=np.nan
-    mask1d[np.where(np.bitwise_not(np.isfinite(ra)))]=np.nan
+    if options.filename is None:
+        print "Must supply a filename"
+        sys.exit(1)
+    else:
+        if options.output:
+            output=options.output
+        else:
+            output=options.filename #.replace('.fits','_crop.fits')
+        # Blank everything south of the pole, and everything outside the RA range: better to do this like MIMAS
+        # The NaNs are written in place through a memmap of the output
+        if output!=options.filename:
+            shutil.copyfile(options.filename,output)
+        # Snapshot observation:
+        # wcs in format [stokes,freq,x,y]; stokes and freq are length 1 if they exist
+        header = pyfits.getheader(output)
+        w = wcs.WCS(header,naxis=2)
+        midra = header['CRVAL1']
+        try:
+            data = image_tiles.open_fits(output)
+        except ValueError:
+            # Integer images cannot hold NaN: blank a floating-point copy in memory
+            data = None
+        if data is not None:
+            scidata = image_tiles.image_view(data)
+        else:
+            hdu_in = pyfits.open(output)
+            original_shape=hdu_in[0].data.shape
+            scidata = np.array(image_tiles.image_view(hdu_in[0].data),dtype=np.float32)
 
-    mask2d=mask1d.reshape(scidata.shape[0],scidata.shape[1])
-    hdu_in[0].data=(mask2d*scidata).reshape(original_shape)
+        # RA and Dec of every pixel, from the cache or generated a block of rows at a time
+        if options.coord_cache:
+            coords = sky_coords.sky_coords(w,scidata.shape,cache_dir=options.coord_cache,cache_size=options.coord_cache_size*1e9)
+        else:
+            coords = None
 
-    hdu_in.writeto(output,clobber=True)
+        blank_image(scidata,w,midra,options.flag_radius,tile_rows=options.tile_rows,threads=options.threads,coords=coords)
 
+        if data is not None:
+            data.flush()
+            del data, scidata
+        else:
+            hdu_in[0].data=scidata.reshape(original_shape)
+            hdu_in.writeto(output,clobber=True)
@@ -17,6 +17,8 @@ from scipy.stats import lognorm
 from astropy.modeling import models, fitting
 import os
 import sys
+import reference_photometry
+import fit_cache
 
 print "#----------------------------------------------------------#"
 print '''Fixing final week-long flux scale in GLEAM mosaic. Ensure you have votables from Aegean. 
@@ -38,6 +40,10 @@ parser.add_option('--write',action="store_true",dest="write_coefficients",defaul
                     help="Write coefficients to file? (default = False)")
 parser.add_option('--table',action="store_true",dest="write_table",default=False,
                     help="Write table used for fit to file? (default = False)")
+parser.add_option('--cache',type="string", dest="cache",default=None,
+                    help="sqlite file of cached spectral fits keyed by the photometry, frequencies and fit options (default = no cache)")
+parser.add_option('--cache_size',dest="cache_size",default=100000,type=int,
+                    help="Maximum number of fit results kept in the cache; the least recently used are evicted (default = 100000)")
 (options, args) = parser.parse_args()
 
 if options.make_plots:
@@ -124,10 +130,8 @@ if not os.path.exists(marco_xmatch):
     os.system('stilts tmatch2 in1='+options.catalog+' in2='+options.isles+' join=1and2 find=best matcher=exact values1="island" values2="island" out='+input_root+'_tot.vot')
     os.system('stilts tmatch2 matcher=skyellipse in1=$MWA_CODE_BASE/MWA_Tools/catalogues/marco_all_VLSSsrcs.fits in2='+input_root+'_tot.vot out=marco_all_VLSSsrcs+'+input_root+'.fits values1="RAJ2000 DEJ2000 MajAxis MinAxis PA" values2="ra_1 dec_1 a b pa_1" params=20')
 
-hdulist = fits.open(marco_xmatch)
-hdulist.verify('fix')
-tbdata = hdulist[1].data
-hdulist.close()
+tbdata = reference_photometry.read_columns(marco_xmatch, ['RAJ2000_vlss', 'DEJ2000_vlss', 'S_vlss', 'e_S_vlss', 'S_mrc', 'e_S_mrc', 'S', 'e_S',
+    'flags_1', 'isolated', 'components', 'int_flux_1', 'local_rms_1'])
 
 #week=input_root.split("_")[1][0:8]
 #if Dec_strip == -40. or Dec_strip == -55. or Dec_strip == -72. or ( week != "20131107" and week != "20131111" and week != "20131125" and week != "20130822" ):
@@ -165,18 +169,24 @@ freq_array = np.log(np.array([74., 408., 1400.]))
 catalogue_fluxes = np.transpose(np.log(np.vstack((tbdata['S_vlss'][indices_mrc],tbdata['S_mrc'][indices_mrc],tbdata['S'][indices_mrc]))))
 catalogue_flux_errs = np.transpose(np.vstack((tbdata['e_S_vlss'][indices_mrc],tbdata['e_S_mrc'][indices_mrc],tbdata['e_S'][indices_mrc]))/(np.vstack((tbdata['S_vlss'][indices_mrc],tbdata['S_mrc'][indices_mrc],tbdata['S'][indices_mrc]))))
 weights = 1/(catalogue_flux_errs**2)
-pred_fluxes=np.empty(catalogue_fluxes.shape[0])
-residuals=np.empty(catalogue_fluxes.shape[0])
-alpha_mrc=np.empty(catalogue_fluxes.shape[0])
 # Currently the vectorized version doesn't care about weights, so we'll have to do this with a loop
 #    fit=np.polynomial.polynomial.polyfit(freq_array,catalogue_fluxes,1)
 
-for i in range(0,catalogue_fluxes.shape[0]):
-    P,res,rank,singular_values,rcond=np.polyfit(freq_array,catalogue_fluxes[i],1,w=weights[i],full=True)
+def fit_mrc(index):
+    slope, intercept, res = [np.empty(len(index)) for dummy in range(3)]
+    for j,i in enumerate(index):
+        P,r,rank,singular_values,rcond=np.polyfit(freq_array,catalogue_fluxes[i],1,w=weights[i],full=True)
 #        fit[i]=[P[0],P[1],residuals[0]]
-    pred_fluxes[i]=powlaw(freq_obs,np.exp(P[1]),P[0])
-    residuals[i]=res[0]
-    alpha_mrc[i]=P[0]
+        slope[j], intercept[j], res[j] = P[0], P[1], r[0]
+    return slope, intercept, res
+
+if options.cache:
+    cache = fit_cache.FitCache(options.cache, max_entries=options.cache_size, namespace='check_flux_scale')
+    slope, intercept, residuals = cache.cached(cache.keys([catalogue_fluxes.T, weights.T], common=[freq_array, 'polyfit', 1, 'weighted']), fit_mrc)
+else:
+    slope, intercept, residuals = fit_mrc(np.arange(catalogue_fluxes.shape[0]))
+pred_fluxes=powlaw(freq_obs,np.exp(intercept),slope)
+alpha_mrc=slope
 ratio_mrc=np.log(pred_fluxes/tbdata['int_flux_1'][indices_mrc])
 decs_mrc=tbdata['DEJ2000_vlss'][indices_mrc]
 ras_mrc=tbdata['RAJ2000_vlss'][indices_mrc]
@@ -203,13 +213,20 @@ indices_highdec=np.intersect1d(np.where(tbdata['DEJ2000_vlss']>18),indices)
 if indices_highdec.any():
     catalogue_fluxes = np.transpose(np.log(np.vstack((tbdata['S_vlss'][indices_highdec],tbdata['S'][indices_highdec]))))
     catalogue_flux_errs = np.transpose(np.vstack((tbdata['e_S_vlss'][indices_highdec],tbdata['e_S'][indices_highdec]))/(np.vstack((tbdata['S_vlss'][indices_highdec],tbdata['S'][indices_highdec]))))
-    pred_fluxes=np.empty(catalogue_fluxes.shape[0])
-    alpha_highdec=np.empty(catalogue_fluxes.shape[0])
 
-    for i in range(0,catalogue_fluxes.shape[0]):
-        P=np.polyfit(freq_array,catalogue_fluxes[i],1)
-        pred_fluxes[i]=powlaw(freq_obs,np.exp(P[1]),P[0])
-        alpha_highdec[i]=P[0]
+    def fit_highdec(index):
+        slope, intercept = [np.empty(len(index)) for dummy in range(2)]
+        for j,i in enumerate(index):
+            P=np.polyfit(freq_array,catalogue_fluxes[i],1)
+            slope[j], intercept[j] = P[0], P[1]
+        return slope, intercept
+
+    if options.cache:
+        slope, intercept = cache.cached(cache.keys([catalogue_fluxes.T], common=[freq_array, 'polyfit', 1, 'unweighted']), fit_highdec)
+    else:
+        slope, intercept = fit_highdec(np.arange(catalogue_fluxes.shape[0]))
+    pred_fluxes=powlaw(freq_obs,np.exp(intercept),slope)
+    alpha_highdec=slope
 
     ratio_highdec=np.log(pred_fluxes/tbdata['int_flux_1'][indices_highdec])
     decs_highdec=tbdata['DEJ2000_vlss'][indices_highdec]
@@ -258,6 +275,10 @@ if indices_highdec.any():
     polycoeffs_highdec=np.polyfit(decs_highdec,ratio_highdec,0,w=np.log(w_highdec))
     print polycoeffs_highdec
 
+if options.cache:
+    print cache.report()
+    cache.close()
+
 if options.write_coefficients:
     outcoeff=input_root+'_fluxscale.fits'
     print "#----------------------------------------------------------#"
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+# Apply a chain of mosaic corrections in one pass over the pixels, instead of one script
+# (and one full read and write of the mosaic) per correction. The steps are applied in the
+# order given, a block of rows at a time, and each is recorded in the output header HISTORY.
+#
+# Steps:
+#   xxyy:<*_xxyy_coefficients.fits>  XX:YY quintic in Dec written by fit_poly.py --write
+#   dec[:<mosaic>]                   Dec polynomial of apply_dec_polynomial.py, with the
+#                                    coefficients chosen for <mosaic> (default = the input)
+#   rescale:<zerofits>               multiply by the factor in the zerofits table, as rescale_zerofits.py
+#   divide:<zerofits>                divide by it, as rescale_zerofits.py --divide
+#   psf:<psf map>                    blur factor of the PSF map, as dd_flux_mod.py
+#   psf_bilinear:<psf map>           the same, bilinearly interpolated
+#   blank[:<radius>]                 blank south of the pole and further than radius (default = 60)
+#                                    degrees in RA from CRVAL1, as blank_SCP.py
+#
+# e.g. correct_mosaic.py --mosaic mosaic.fits --step xxyy:mosaic_XY_r-1.0_xxyy_coefficients.fits
+#          --step dec --step rescale:mosaic_zerofits.fits --step psf:psf_map.fits --step blank
+
+import sys
+import numpy as np
+from astropy.io import fits
+from astropy import wcs
+from optparse import OptionParser
+import sky_coords
+import image_tiles
+import apply_dec_polynomial
+import rescale_zerofits
+import dd_flux_mod
+import psf_resample
+import blank_SCP
+
+def xxyy_step(coefficients):
+    '''The fit_poly.py XX:YY correction, u*dec^5 + ... + z, from its coefficients file.'''
+    qdata = fits.getdata(coefficients,1)
+    P = [np.array(qdata[col])[0] for col in ['u','v','w','x','y','z']]
+    def step(rows,ra,dec):
+        return np.polyval(P,dec)
+    return step, 'multiplied by the XX:YY polynomial in Dec from '+coefficients
+
+def dec_step(mosaic):
+    '''The apply_dec_polynomial.py correction for mosaic.'''
+    correction = apply_dec_polynomial.dec_correction(mosaic)
+    def step(rows,ra,dec):
+        return correction(ra,dec)
+    return step, 'applied the Dec-dependent polynomial correction for '+mosaic
+
+def rescale_step(zerofits,divide=False):
+    '''The rescale_zerofits.py factor.'''
+    factor = rescale_zerofits.zerofits_factor(zerofits)
+    if divide:
+        def step(rows,ra,dec):
+            return 1./factor
+        return step, 'divided by '+str(factor)+' from '+zerofits
+    def step(rows,ra,dec):
+        return factor
+    return step, 'multiplied by '+str(factor)+' from '+zerofits
+
+def psf_step(psf,method='nearest'):
+    '''The dd_flux_mod.py blur factor.'''
+    blur, w_psf = dd_flux_mod.psf_blur(psf)
+    def step(rows,ra,dec):
+        return psf_resample.sample(blur,w_psf,ra,dec,method,edge='clamp')
+    return step, 'multiplied by the blur factor of '+psf+' ('+method+')'
+
+def blank_step(header,flag_radius):
+    '''The blank_SCP.py mask.'''
+    south = blank_SCP.pole_row(sky_coords.celestial(wcs.WCS(header)))
+    midra = header['CRVAL1']
+    def step(rows,ra,dec):
+        return blank_SCP.blank_mask(rows,ra,south,midra,flag_radius)
+    return step, 'blanked south of the pole and beyond '+str(flag_radius)+' deg in RA from '+str(midra)
+
+def parse_steps(specs,input_mosaic,header):
+    '''The (step, description) of each name[:argument] in specs, in order.'''
+    steps = []
+    for spec in specs:
+        name, sep, arg = spec.partition(':')
+        if name == 'xxyy' and arg:
+            steps.append(xxyy_step(arg))
+        elif name == 'dec':
+            steps.append(dec_step(arg if arg else input_mosaic))
+        elif name in ('rescale','divide') and arg:
+            steps.append(rescale_step(arg,divide=(name == 'divide')))
+        elif name in ('psf','psf_bilinear') and arg:
+            steps.append(psf_step(arg,'bilinear' if name == 'psf_bilinear' else 'nearest'))
+        elif name == 'blank':
+            steps.append(blank_step(header,float(arg) if arg else 60.0))
+        else:
+            raise ValueError("Unrecognised step "+spec)
+    return steps
+
+if __name__ == '__main__':
+
+    usage="Usage: %prog [options]\n"
+    parser = OptionParser(usage=usage)
+    parser.add_option('--mosaic',type="string", dest="mosaic",
+                        help="The filename of the mosaic you want to read in.")
+    parser.add_option('--output',type="string", dest="output", default=None,
+                        help="The output filename (default = input_corrected.fits).")
+    parser.add_option('--step',type="string", dest="steps", action="append", default=[],
+                        help="A correction to apply, as name[:argument]; repeat for each step, in order. Names: xxyy, dec, rescale, divide, psf, psf_bilinear, blank.")
+    parser.add_option('--tile_rows','--tile-rows',dest="tile_rows",default=256,type=int,
+                        help="Number of rows corrected at a time (default = 256)")
+    parser.add_option('--threads',dest="threads",default=1,type=int,
+                        help="Number of tiles of rows to correct at once, on separate threads (default = 1)")
+    parser.add_option('--coord_cache',type="string", dest="coord_cache", default=None,
+                        help="Directory in which to cache the RA/Dec maps of each projection, so that mosaics sharing it reuse them (default = no cache)")
+    parser.add_option('--coord_cache_size',dest="coord_cache_size", default=20.,type=float,
+                        help="Maximum size of the coordinate cache in GB; the least recently used maps are deleted (default = 20)")
+    (options, args) = parser.parse_args()
+
+    if not options.mosaic or not options.steps:
+        print "Mosaic and at least one step must be specified."
+        sys.exit(1)
+
+    input_mosaic = options.mosaic
+    if options.output:
+        output = options.output
+    else:
+        output = input_mosaic.replace(".fits","_corrected.fits")
+
+    header = fits.getheader(input_mosaic)
+    try:
+        steps = parse_steps(options.steps,input_mosaic,header)
+    except ValueError as e:
+        print str(e)
+        sys.exit(1)
+
+    for step, description in steps:
+        print "Step: "+description
+        header.add_history('correct_mosaic.py: '+description)
+
+    if options.coord_cache:
+        coords = sky_coords.sky_coords(wcs.WCS(header),(header['NAXIS2'],header['NAXIS1']),cache_dir=options.coord_cache,cache_size=options.coord_cache_size*1e9)
+    else:
+        coords = None
+
+    image_tiles.apply_chain(input_mosaic,output,[step for step, description in steps],header=header,tile_rows=options.tile_rows,coords=coords,threads=options.threads)
+    print "Wrote "+output
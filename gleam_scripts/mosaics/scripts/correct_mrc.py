@@ -12,6 +12,9 @@ import shutil
 import numpy
 from astropy.io import fits
 from astropy.io.votable import parse_single_table
+import fits_scale
+import sky_match
+import reference_index
 import re
 import matplotlib as mpl
 mpl.use('Agg') # So does not use display
@@ -27,8 +30,18 @@ parser.add_option('--dec',dest="dec",default=None,type="float",
                   help="Declination of the observations to set plotting ranges. (default is to try to get from the date)")
 parser.add_option('--date',dest="date",default=None,type="string",
                   help="Date of observations in YYYYMMDD format? (default is try to read from directory name) Not used if --dec is specified.")
+parser.add_option('--bscale',action="store_true",dest="bscale",default=False,
+                  help="Record the flux scale ratio in the BSCALE keyword of the corrected snapshots, which are copies with only their headers changed, instead of rewriting the pixels; the copies still read and write every pixel, use --in_place to avoid that. (off by default)")
+parser.add_option('--in_place',action="store_true",dest="in_place",default=False,
+                  help="With --bscale, record the ratio and the ionospheric CRVAL fixes in the headers of the snapshots themselves, with a HISTORY card, instead of writing _corrected.fits copies; snapshots with that card are not corrected again. (off by default)")
 (options, args) = parser.parse_args()
 
+history_tag="correct_mrc.py: multiplied by the MRC flux scale ratio "
+
+def corrected_in_place(image):
+    '''Whether the header of image has the HISTORY card of a --bscale --in_place correction.'''
+    return any(str(card).startswith(history_tag) for card in fits.getheader(image).get('HISTORY',[]))
+
 def unwrap(x):
     if x>250:
         return x-360
@@ -43,6 +56,9 @@ if not os.path.exists(MRCvot):
     print "Can't find MRC.vot in $MWA_CODE_BASE! Either it's not there or the variable wasn't set properly. Make sure you set it to the directory in which MWA_Tools resides."
     sys.exit(1)
 
+# MRC: point-like sources (MFLAG is blank), from the saved index of the catalogue
+mrc=reference_index.point_sources(reference_index.load(MRCvot))
+
 if options.dec:
     plotdec=options.dec
 else:
@@ -107,7 +123,11 @@ for Xfits in files:
     Xfits_corr=re.sub(".fits","_corrected.fits",Xfits)
     Yfits_corr=re.sub(".fits","_corrected.fits",Yfits)
     Ifits_corr=re.sub(".fits","_corrected.fits",Ifits)
-    if os.path.exists(Xfits_corr) and os.path.exists(Yfits_corr) and os.path.exists(Ifits_corr):
+    if options.bscale and options.in_place:
+        done=all(corrected_in_place(image) for image in (Xfits,Yfits,Ifits))
+    else:
+        done=os.path.exists(Xfits_corr) and os.path.exists(Yfits_corr) and os.path.exists(Ifits_corr)
+    if done:
        print Xfits+" already corrected: not bothing to calculate."
 #       files.remove(Xfits)
        docorr.append(False)
@@ -163,17 +183,7 @@ for Xfits,corr in files_to_check:
                 matchvot="unused/"+matchvot
 # Need to make a new matchtable
             else:
-                os.system('stilts tpipe in='+MRCvot+' cmd=\'select NULL_MFLAG\' cmd=\'addcol PA "0.0"\' cmd=\'addcol S_'+freq_str+' "S408*pow(('+str(freq)+'/408000000.0),-0.85)"\' out=temp1.vot')
-                os.system('stilts tpipe in='+vot+' cmd=\'select local_rms<1.0\' out=temp2.vot')
-                os.system('stilts tmatch2 matcher=skyellipse params=30 in1=temp1.vot in2=temp2.vot out=temp.vot values1="_RAJ2000 _DEJ2000 e_RA2000 e_DE2000 PA" values2="ra dec a b pa" ofmt=votable')
-            # Exclude extended sources
-# weight is currently S/N
-                os.system('stilts tpipe in=temp.vot cmd=\'select ((int_flux/peak_flux)<2)\' cmd=\'addcol logratio "(ln(S_'+freq_str+'/int_flux))"\' cmd=\'addcol weight "(int_flux/local_rms)"\' cmd=\'addcol delRA "(_RAJ2000-ra)"\' cmd=\'addcol delDec "(_DEJ2000-dec)"\' omode=out ofmt=vot out=temp3.vot')
-                os.system('stilts tpipe in=temp3.vot cmd=\'select abs(delRA)<1.0\' out='+matchvot)
-                os.remove('temp.vot')
-                os.remove('temp1.vot')
-                os.remove('temp2.vot')
-                os.remove('temp3.vot')
+                reference_index.mrc_match(mrc,sky_match.read_table(vot),freq).write(matchvot,format='votable',overwrite=True)
 
 # First do the ionospheric corrections, using the "I" table, since it has the best S/N
 # Check the matched table actually has entries
@@ -198,7 +208,20 @@ for Xfits,corr in files_to_check:
                 print "Ratio of "+str(ratio)+" between "+image+" and MRC."
                 print "stdev= "+str(stdev)
 
-                if corr:
+                if corr and options.bscale:
+                    # Fix the ionosphere and the flux scaling in the headers of the
+                    # NON-primary-beam-corrected fits files, or of copies of them
+                    if options.in_place:
+                        fits_corr=image
+                    else:
+                        fits_corr=image.replace(".fits","_corrected.fits")
+                        shutil.copyfile(image,fits_corr)
+                    if options.in_place and corrected_in_place(image):
+                        print image+" already corrected in place."
+                    else:
+                        fits_scale.rescale_file(fits_corr,ratio,history=history_tag+str(ratio),comment="MRC flux scale ratio",updates={'CRVAL1':ra+delRA,'CRVAL2':dec+delDec},remove=('DATAMIN','DATAMAX'))
+                    f.write("{0:s} {1:10.8f} {2:10.8f} {3:10.8f} {4:10.8f} {5:10.8f} {6:10.8f}\n".format(image,delRA,delRAstdev,delDec,delDecstdev,ratio,stdev))
+                elif corr:
                     # Write new NON-primary-beam-corrected fits files
                     hdu_in = fits.open(image)
                 # Modify to fix ionosphere
@@ -11,6 +11,8 @@ import numpy as np
 from astropy.io import fits
 from astropy.io.votable import parse_single_table
 import re
+import sky_match
+import reference_index
 import matplotlib as mpl
 mpl.use('Agg') # So does not use display
 import matplotlib.pylab as plt
@@ -43,6 +45,9 @@ if not os.path.exists(MRCvot):
     print "Can't find MRC.vot in $MWA_CODE_BASE! Either it's not there or the variable wasn't set properly. Make sure you set it to the directory in which MWA_Tools resides."
     sys.exit(1)
 
+# MRC: point-like sources (MFLAG is blank), from the saved index of the catalogue
+mrc=reference_index.point_sources(reference_index.load(MRCvot))
+
 corrfile=options.input+"_flux_corrections.txt"
 f=open(corrfile,"w")
 
@@ -113,17 +118,7 @@ for Xfits,corr in files_to_check:
                 matchvot="unused/"+matchvot
 # Need to make a new matchtable
             else:
-                os.system('stilts tpipe in='+MRCvot+' cmd=\'select NULL_MFLAG\' cmd=\'addcol PA "0.0"\' cmd=\'addcol S_'+freq_str+' "S408*pow(('+str(freq)+'/408000000.0),-0.85)"\' out='+image+'temp1.vot')
-                os.system('stilts tpipe in='+vot+' cmd=\'select local_rms<1.0\' out='+image+'temp2.vot')
-                os.system('stilts tmatch2 matcher=skyellipse params=30 in1='+image+'temp1.vot in2='+image+'temp2.vot out='+image+'temp.vot values1="_RAJ2000 _DEJ2000 e_RA2000 e_DE2000 PA" values2="ra dec a b pa" ofmt=votable')
-            # Exclude extended sources
-# weight is currently S/N
-                os.system('stilts tpipe in='+image+'temp.vot cmd=\'select ((int_flux/peak_flux)<2)\' cmd=\'addcol logratio "(ln(S_'+freq_str+'/int_flux))"\' cmd=\'addcol weight "(int_flux/local_rms)"\' cmd=\'addcol delRA "(_RAJ2000-ra)"\' cmd=\'addcol delDec "(_DEJ2000-dec)"\' omode=out ofmt=vot out='+image+'temp3.vot')
-                os.system('stilts tpipe in='+image+'temp3.vot cmd=\'select abs(delRA)<1.0\' out='+matchvot)
-                os.remove(image+'temp.vot')
-                os.remove(image+'temp1.vot')
-                os.remove(image+'temp2.vot')
-                os.remove(image+'temp3.vot')
+                reference_index.mrc_match(mrc,sky_match.read_table(vot),freq).write(matchvot,format='votable',overwrite=True)
 
 # Check the matched table actually has entries
     Imatchvot=Ifits.replace(".fits","_MRC.vot")
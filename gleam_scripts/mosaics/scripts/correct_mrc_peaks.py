@@ -12,9 +12,13 @@ import numpy
 from astropy.io import fits
 from astropy.io.votable import parse_single_table
 import re
+import sky_match
+import reference_index
 
 catdir=os.environ['MWA_CODE_BASE']
 MRCvot=catdir+"/MRC.vot"
+# MRC: point-like sources (MFLAG is blank), from the saved index of the catalogue
+mrc=reference_index.point_sources(reference_index.load(MRCvot))
 
 #files=sorted(glob.glob("10*XX*2.0.fits")) #[::-1]
 files=sorted(glob.glob("10*XX*2.?.fits")) #[::-1]
@@ -57,16 +61,7 @@ for Xfits in files:
     matchvot=re.sub(".fits","_MRC.vot",Ifits)
 
     if not os.path.exists(matchvot):
-        os.system('stilts tpipe in='+MRCvot+' cmd=\'select NULL_MFLAG\' cmd=\'addcol PA "0.0"\' cmd=\'addcol S_'+freq_str+' "S408*pow(('+str(freq)+'/408000000.0),-0.85)"\' out=temp1.vot')
-        os.system('stilts tpipe in='+Ivot+' cmd=\'select local_rms<1.0\' out=temp2.vot')
-        os.system('stilts tmatch2 matcher=skyellipse params=30 in1=temp1.vot in2=temp2.vot out=temp.vot values1="_RAJ2000 _DEJ2000 e_RA2000 e_DE2000 PA" values2="ra dec a b pa" ofmt=votable')
-    # Exclude extended sources
-        os.system('stilts tpipe in=temp.vot cmd=\'select ((int_flux/peak_flux)<2)\' cmd=\'addcol logratio "(ln(S_'+freq_str+'/peak_flux))"\' cmd=\'addcol weight "(peak_flux/local_rms)"\' cmd=\'addcol delRA "(_RAJ2000-ra)"\' cmd=\'addcol delDec "(_DEJ2000-dec)"\' omode=out ofmt=vot out=temp3.vot')
-        os.system('stilts tpipe in=temp3.vot cmd=\'select abs(delRA)<1.0\' out='+matchvot)
-        os.remove('temp.vot')
-        os.remove('temp1.vot')
-        os.remove('temp2.vot')
-        os.remove('temp3.vot')
+        reference_index.mrc_match(mrc,sky_match.read_table(Ivot),freq,flux='peak_flux').write(matchvot,format='votable',overwrite=True)
 
     t = parse_single_table(matchvot)
 # Check the matched table actually has entries
@@ -2,68 +2,118 @@
 # Crossmatching script for total GLEAM and other SED samples (MS4 etc).
 
 import os
-
-print 'Crossmatching GLEAM'
-
-if not os.path.exists(os.getcwd()+'/crossmatching'):
-    os.makedirs(os.getcwd()+'/crossmatching')
-    print 'Creating directory ', os.getcwd()+'/crossmatching'
-
-os.system('stilts tmatchn matcher=skyellipse multimode=pairs nin=20 params=20 \
-    in1=154-162MHz/Week2_154-162MHz.vot  values1="ra dec a b pa" \
-    in2=072-080MHz/Week2_072-080MHz.vot  values2="ra dec a b pa" \
-    in3=080-088MHz/Week2_080-088MHz.vot  values3="ra dec a b pa" \
-    in4=088-095MHz/Week2_088-095MHz.vot  values4="ra dec a b pa" \
-    in5=095-103MHz/Week2_095-103MHz.vot  values5="ra dec a b pa" \
-    in6=103-111MHz/Week2_103-111MHz.vot  values6="ra dec a b pa" \
-    in7=111-118MHz/Week2_111-118MHz.vot  values7="ra dec a b pa" \
-    in8=118-126MHz/Week2_118-126MHz.vot  values8="ra dec a b pa" \
-    in9=126-134MHz/Week2_126-134MHz.vot  values9="ra dec a b pa" \
-    in10=139-147MHz/Week2_139-147MHz.vot values10="ra dec a b pa" \
-    in11=147-154MHz/Week2_147-154MHz.vot values11="ra dec a b pa" \
-    in12=162-170MHz/Week2_162-170MHz.vot values12="ra dec a b pa" \
-    in13=170-177MHz/Week2_170-177MHz.vot values13="ra dec a b pa" \
-    in14=177-185MHz/Week2_177-185MHz.vot values14="ra dec a b pa" \
-    in15=185-193MHz/Week2_185-193MHz.vot values15="ra dec a b pa" \
-    in16=193-200MHz/Week2_193-200MHz.vot values16="ra dec a b pa" \
-    in17=200-208MHz/Week2_200-208MHz.vot values17="ra dec a b pa" \
-    in18=208-216MHz/Week2_208-216MHz.vot values18="ra dec a b pa" \
-    in19=216-223MHz/Week2_216-223MHz.vot values19="ra dec a b pa" \
-    in20=223-231MHz/Week2_223-231MHz.vot values20="ra dec a b pa" \
-    out=crossmatching/tot_mwa_154-162MHzbase.fits')
-
-print 'Crossmatching GLEAM with MS4'
-
-if not os.path.exists(os.getcwd()+'/crossmatching/ms4'):
-    os.makedirs(os.getcwd()+'/crossmatching/ms4')
-    print 'Creating directory ', os.getcwd()+'/crossmatching/ms4'
-
-os.system('stilts tmatchn multimode=pairs nin=2 matcher=sky params=60 \
-	in1=tot_mwa_154-162MHzbase.fits values1="ra_1 dec_1" \
-	in2=MWA_Tools/catalogues/ms4.fits values2="RAJ2000 DEJ2000" \
-	out=crossmatching/ms4/tot_mwa_154-162MHzbase+MS4.fits')
-
-print 'Crossmatching GLEAM with ATCA database'
-
-if not os.path.exists(os.getcwd()+'/crossmatching/atca_cali'):
-    os.makedirs(os.getcwd()+'/crossmatching/atca_cali')
-    print 'Creating directory ', os.getcwd()+'/crossmatching/atca_cali'
-
-os.system('stilts tmatchn multimode=pairs nin=2 matcher=sky params=60 \
-    in1=tot_mwa_154-162MHzbase.fits values1="ra_1 dec_1" \
-    in2=MWA_Tools/catalogues/atcacaldb+mrc+sumss+vlssr+nvss.fits values2="RAJ2000 DEJ2000" \
-    out=crossmatching/atca_cali/tot_mwa_154-162MHzbase+atcacaldb+mrc+sumss+vlssr+nvss.fits')
-
-print 'Crossmatching GLEAM with Randall et al. (2011) sample'
-
-if not os.path.exists(os.getcwd()+'/crossmatching/randall'):
-    os.makedirs(os.getcwd()+'/crossmatching/randall')
-    print 'Creating directory ', os.getcwd()+'/crossmatching/randall'
-
-os.system('stilts tmatchn multimode=pairs nin=2 matcher=sky params=60 \
-    in1=tot_mwa_154-162MHzbase.fits values1="ra_1 dec_1" \
-    in2=MWA_Tools/catalogues/randall+mrc+sumss.fits values2="_RAJ2000 _DEJ2000" \
-    out=crossmatching/randall/tot_mwa_154-162MHzbase+randall+mrc+sumss.fits')
-
-
-
+import multiprocessing
+import numpy as np
+import sky_match
+
+# The 154-162MHz catalogue is the reference: each of the other subbands is matched to it, in
+# parallel, as stilts tmatchn multimode=pairs matcher=skyellipse
+bands=['154-162MHz','072-080MHz','080-088MHz','088-095MHz','095-103MHz','103-111MHz','111-118MHz',
+       '118-126MHz','126-134MHz','139-147MHz','147-154MHz','162-170MHz','170-177MHz','177-185MHz',
+       '185-193MHz','193-200MHz','200-208MHz','208-216MHz','216-223MHz','223-231MHz']
+catalogues=[band+'/Week2_'+band+'.vot' for band in bands]
+ellipse=('ra','dec','a','b','pa')
+find='best'
+# The matches of each subband, reused until it, the reference catalogue or the way they are
+# matched changes
+cache_dir='crossmatching/cache'
+cache_version=1
+
+# Read and indexed once; the worker processes inherit them from the parent
+reference=None
+reference_index=None
+
+def load_reference():
+    '''The reference catalogue and the ellipse_index() of its sources.'''
+    global reference, reference_index
+    if reference is None:
+        reference=sky_match.read_table(catalogues[0])
+        reference_index=sky_match.ellipse_index(*[sky_match.positions(reference[col]) for col in ellipse])
+    return reference, reference_index
+
+def file_key(filename):
+    '''Size and modification time of filename, to tell whether it has changed.'''
+    info=os.stat(filename)
+    return np.array([info.st_size,info.st_mtime],dtype=float)
+
+def match_key():
+    '''The columns, find mode, cache version and sky_match ellipse version of the matches.'''
+    return repr((ellipse,find,cache_version,sky_match.ELLIPSE_VERSION))
+
+def match_band(catalogue):
+    '''(reference rows, catalogue rows) of the best matches of the ellipses of catalogue with the reference.'''
+    cache=os.path.join(cache_dir,catalogue.replace('/','_').replace('.vot','.npz'))
+    key=np.concatenate([file_key(catalogues[0]),file_key(catalogue)])
+    if os.path.exists(cache):
+        with np.load(cache) as cached:
+            if 'match' in cached.files and str(cached['match'])==match_key() and np.array_equal(cached['key'],key):
+                return cached['i_ref'],cached['i_band']
+    ref, index=load_reference()
+    table=sky_match.read_table(catalogue)
+    values=[sky_match.positions(table[col]) for col in ellipse]+[sky_match.positions(ref[col]) for col in ellipse]
+    i_band, i_ref, score=sky_match.ellipse_pairs(*values,index2=index)
+    keep=sky_match.select_pairs(i_band,i_ref,score,find)
+    i_ref, i_band=i_ref[keep], i_band[keep]
+    np.savez(cache.replace('.npz','_tmp.npz'),key=key,match=match_key(),i_ref=i_ref,i_band=i_band,score=score[keep])
+    os.rename(cache.replace('.npz','_tmp.npz'),cache)
+    return i_ref, i_band
+
+def match_gleam(gleam,catalogue,ra,dec,output):
+    '''Each row of gleam with its closest counterpart in catalogue within 60 arcsec, as stilts tmatchn multimode=pairs nin=2.'''
+    sky_match.match(gleam,sky_match.read_table(catalogue),60.,ra1='ra_1',dec1='dec_1',ra2=ra,dec2=dec,find='best1').write(output,overwrite=True)
+
+if __name__ == '__main__':
+
+    print 'Crossmatching GLEAM'
+
+    if not os.path.exists(os.getcwd()+'/crossmatching'):
+        os.makedirs(os.getcwd()+'/crossmatching')
+        print 'Creating directory ', os.getcwd()+'/crossmatching'
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    load_reference()
+    pool=multiprocessing.Pool(min(len(catalogues)-1,multiprocessing.cpu_count()))
+    matches=pool.map(match_band,catalogues[1:])
+    pool.close()
+    pool.join()
+
+# One row per reference source matched in at least one other subband; the columns of the
+# n-th catalogue get the suffix _n
+    rows=[np.arange(len(reference))]
+    matched=np.zeros(len(reference),dtype=bool)
+    for i_ref, i_band in matches:
+        index=-np.ones(len(reference),dtype=int)
+        index[i_ref]=i_band
+        rows.append(index)
+        matched[i_ref]=True
+    tables=[reference]+[sky_match.read_table(catalogue) for catalogue in catalogues[1:]]
+    gleam=sky_match.join_columns(tables,[index[matched] for index in rows])
+    gleam.write('crossmatching/tot_mwa_154-162MHzbase.fits',overwrite=True)
+
+    print 'Crossmatching GLEAM with MS4'
+
+    if not os.path.exists(os.getcwd()+'/crossmatching/ms4'):
+        os.makedirs(os.getcwd()+'/crossmatching/ms4')
+        print 'Creating directory ', os.getcwd()+'/crossmatching/ms4'
+
+    match_gleam(gleam,'MWA_Tools/catalogues/ms4.fits','RAJ2000','DEJ2000',
+        'crossmatching/ms4/tot_mwa_154-162MHzbase+MS4.fits')
+
+    print 'Crossmatching GLEAM with ATCA database'
+
+    if not os.path.exists(os.getcwd()+'/crossmatching/atca_cali'):
+        os.makedirs(os.getcwd()+'/crossmatching/atca_cali')
+        print 'Creating directory ', os.getcwd()+'/crossmatching/atca_cali'
+
+    match_gleam(gleam,'MWA_Tools/catalogues/atcacaldb+mrc+sumss+vlssr+nvss.fits','RAJ2000','DEJ2000',
+        'crossmatching/atca_cali/tot_mwa_154-162MHzbase+atcacaldb+mrc+sumss+vlssr+nvss.fits')
+
+    print 'Crossmatching GLEAM with Randall et al. (2011) sample'
+
+    if not os.path.exists(os.getcwd()+'/crossmatching/randall'):
+        os.makedirs(os.getcwd()+'/crossmatching/randall')
+        print 'Creating directory ', os.getcwd()+'/crossmatching/randall'
+
+    match_gleam(gleam,'MWA_Tools/catalogues/randall+mrc+sumss.fits','_RAJ2000','_DEJ2000',
+        'crossmatching/randall/tot_mwa_154-162MHzbase+randall+mrc+sumss.fits')
@@ -6,99 +6,106 @@
 
 # Then when I rerun the flux-calibration, using the PSF map, it should be correct
 
-import numpy as np
-
 from astropy.io import fits
 from astropy import wcs
+import sky_coords
+import psf_resample
+import image_tiles
 from optparse import OptionParser
 
-usage="Usage: %prog [options] <file>\n"
-parser = OptionParser(usage=usage)
-parser.add_option('--mosaic',type="string", dest="mosaic",
-                    help="The filename of the mosaic you want to read in.")
-parser.add_option('--psf',type="string", dest="psf",
-                    help="The filename of the psf image you want to read in.")
-parser.add_option('--output',type="string", dest="output",
-                    help="The filename of the output rescaled image.")
-(options, args) = parser.parse_args()
-
-latitude=-26.70331940
-
-input_mosaic = options.mosaic
-input_root=input_mosaic.replace(".fits","")
-
-# Read in the mosaic to be modified
-mosaic = fits.open(input_mosaic)
-w = wcs.WCS(mosaic[0].header)
-
-#create an array but don't set the values (they are random)
-indexes = np.empty( (mosaic[0].data.shape[0]*mosaic[0].data.shape[1],2),dtype=int)
-#since I know exactly what the index array needs to look like I can construct
-# it faster than list comprehension would allow
-#we do this only once and then recycle it
-idx = np.array([ (j,0) for j in xrange(mosaic[0].data.shape[1])])
-j=mosaic[0].data.shape[1]
-for i in xrange(mosaic[0].data.shape[0]):
-    idx[:,1]=i
-    indexes[i*j:(i+1)*j] = idx
-
-#put ALL the pixels into our vectorized functions and minimise our overheads
-ra,dec = w.wcs_pix2world(indexes,1).transpose()
-
-# Get the header (nominal) BMAJ and BMIN
-
-bmaj = mosaic[0].header['BMAJ']
-bmin = mosaic[0].header['BMIN']
-
-# Read in the PSF
-psf = fits.open(options.psf)
-#a = psf[0].data[0]
-#b = psf[0].data[1]
-blur = psf[0].data[3]
-#pa = psf[0].data[2]
-
-w_psf = wcs.WCS(psf[0].header,naxis=2)
-
-##create an array but don't set the values (they are random)
-#indexes = np.empty( (psf[0].data.shape[1]*psf[0].data.shape[2],2),dtype=int)
-##since I know exactly what the index array needs to look like I can construct
-## it faster than list comprehension would allow
-##we do this only once and then recycle it
-#idx = np.array([ (j,0) for j in xrange(psf[0].data.shape[2])])
-#j=psf[0].data.shape[2]
-#for i in xrange(psf[0].data.shape[1]):
-#    idx[:,1]=i
-#    indexes[i*j:(i+1)*j] = idx
-#
-#ra_psf,dec_psf = w_psf.wcs_pix2world(indexes,1).transpose()
-#za_psf = latitude - dec_psf
-#
-#corr = np.cos(np.radians(za_psf))
-#reshapedcorr=corr.reshape(psf[0].data.shape[1],psf[0].data.shape[2])
-#
-## Test file: write out number we will multiply by
-##psf[0].data[0]=a*b*reshapedcorr/(bmaj*bmin)
-##psf.writeto('test.fits',clobber=True)
-#
-#blur = a*b*reshapedcorr/(bmaj*bmin)
-
-# Now need to correct the original mosaic based on its (RA, Dec) co-ordinates.
-
-# First write it in a loop style so I can get my head around it
-
-#for i, j in mosaic[0].data:
-#   ra_tmp , dec_tmp = w.wcs_pix2world([[i,j]],1).transpose()
-#   k, l = w_psf.wcs_world2pix([[ra_tmp[0],dec_tmp[0]]],1).transpose()
-#   mosaic[0].data[i,j]*=blur[k[0],l[0]]
-
-# Now in a non-looped way
-k, l = w_psf.wcs_world2pix(ra,dec,1)
-k_int = [np.floor(x) for x in k]
-k_int = [x if (x>=0) and (x<=360) else 0 for x in k_int]
-l_int = [np.floor(x) for x in l]
-l_int = [x if (x>=0) and (x<=180) else 0 for x in l_int]
-blur_tmp = blur[l_int,k_int]
-blur_corr = blur_tmp.reshape(mosaic[0].data.shape[0],mosaic[0].data.shape[1])
-mosaic[0].data*=blur_corr
-
-mosaic.writeto(options.output,clobber=True)
+def psf_blur(psf_file):
+    '''The blur plane of a PSF map and the WCS of its celestial axes.'''
+    psf = fits.open(psf_file)
+    #a = psf[0].data[0]
+    #b = psf[0].data[1]
+    blur = psf[0].data[3]
+    #pa = psf[0].data[2]
+    w_psf = wcs.WCS(psf[0].header,naxis=2)
+    # Set up once, so that threads only read it
+    w_psf.wcs.set()
+    return blur, w_psf
+
+if __name__ == '__main__':
+
+    usage="Usage: %prog [options] <file>\n"
+    parser = OptionParser(usage=usage)
+    parser.add_option('--mosaic',type="string", dest="mosaic",
+                        help="The filename of the mosaic you want to read in.")
+    parser.add_option('--psf',type="string", dest="psf",
+                        help="The filename of the psf image you want to read in.")
+    parser.add_option('--output',type="string", dest="output",
+                        help="The filename of the output rescaled image.")
+    parser.add_option('--coord_cache',type="string", dest="coord_cache", default=None,
+                        help="Directory in which to cache the RA/Dec maps of each projection, so that mosaics sharing it reuse them (default = no cache)")
+    parser.add_option('--coord_cache_size',dest="coord_cache_size", default=20.,type=float,
+                        help="Maximum size of the coordinate cache in GB; the least recently used maps are deleted (default = 20)")
+    parser.add_option('--interpolation',type="choice", dest="interpolation", default="nearest", choices=["nearest","bilinear"],
+                        help="How to sample the PSF map at each mosaic pixel: nearest or bilinear (default = nearest)")
+    parser.add_option('--edge',type="choice", dest="edge", default="clamp", choices=["clamp","nan"],
+                        help="Mosaic pixels outside the PSF map take the value at its edge (clamp) or are blanked (nan) (default = clamp)")
+    parser.add_option('--tile_rows','--tile-rows',dest="tile_rows",default=256,type=int,
+                        help="Number of rows corrected at a time (default = 256)")
+    parser.add_option('--threads',dest="threads",default=1,type=int,
+                        help="Number of tiles of rows to correct at once, on separate threads (default = 1)")
+    (options, args) = parser.parse_args()
+
+    latitude=-26.70331940
+
+    input_mosaic = options.mosaic
+    input_root=input_mosaic.replace(".fits","")
+
+    # Read in the mosaic to be modified
+    mosaic = fits.open(input_mosaic)
+    w = wcs.WCS(mosaic[0].header)
+
+    # RA and Dec of every pixel, from the cache or generated a block of rows at a time
+    if options.coord_cache:
+        coords = sky_coords.sky_coords(w,mosaic[0].data.shape,cache_dir=options.coord_cache,cache_size=options.coord_cache_size*1e9)
+    else:
+        coords = None
+
+    # Get the header (nominal) BMAJ and BMIN
+
+    bmaj = mosaic[0].header['BMAJ']
+    bmin = mosaic[0].header['BMIN']
+
+    # Read in the PSF
+    blur, w_psf = psf_blur(options.psf)
+
+    ##create an array but don't set the values (they are random)
+    #indexes = np.empty( (psf[0].data.shape[1]*psf[0].data.shape[2],2),dtype=int)
+    ##since I know exactly what the index array needs to look like I can construct
+    ## it faster than list comprehension would allow
+    ##we do this only once and then recycle it
+    #idx = np.array([ (j,0) for j in xrange(psf[0].data.shape[2])])
+    #j=psf[0].data.shape[2]
+    #for i in xrange(psf[0].data.shape[1]):
+    #    idx[:,1]=i
+    #    indexes[i*j:(i+1)*j] = idx
+    #
+    #ra_psf,dec_psf = w_psf.wcs_pix2world(indexes,1).transpose()
+    #za_psf = latitude - dec_psf
+    #
+    #corr = np.cos(np.radians(za_psf))
+    #reshapedcorr=corr.reshape(psf[0].data.shape[1],psf[0].data.shape[2])
+    #
+    ## Test file: write out number we will multiply by
+    ##psf[0].data[0]=a*b*reshapedcorr/(bmaj*bmin)
+    ##psf.writeto('test.fits',clobber=True)
+    #
+    #blur = a*b*reshapedcorr/(bmaj*bmin)
+
+    # Now need to correct the original mosaic based on its (RA, Dec) co-ordinates.
+
+    # First write it in a loop style so I can get my head around it
+
+    #for i, j in mosaic[0].data:
+    #   ra_tmp , dec_tmp = w.wcs_pix2world([[i,j]],1).transpose()
+    #   k, l = w_psf.wcs_world2pix([[ra_tmp[0],dec_tmp[0]]],1).transpose()
+    #   mosaic[0].data[i,j]*=blur[k[0],l[0]]
+
+    # Now in a non-looped way, a tile of rows at a time
+    image_tiles.correct_image(mosaic[0].data,w,lambda rows,ra,dec: psf_resample.sample(blur,w_psf,ra,dec,options.interpolation,options.edge),
+                              tile_rows=options.tile_rows,threads=options.threads,coords=coords)
+
+    mosaic.writeto(options.output,clobber=True)
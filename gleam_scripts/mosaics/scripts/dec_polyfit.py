@@ -0,0 +1,152 @@
+"""
+Weighted polynomial fits of flux density ratio against declination
+
+Every polynomial order up to max_order is solved from one QR decomposition of
+the weighted Vandermonde matrix: its columns are nested, so the order-k fit
+uses the leading (k+1) x (k+1) block of R. Dec is rescaled to [-1, 1] for the
+decomposition and the coefficients are converted back to powers of Dec.
+Bootstrap coefficient errors come from batched solves over all the resamples
+at once, using the number of times each point was drawn as a weight.
+
+Coefficients are in increasing powers of Dec, i.e. a + b*dec + c*dec^2 + ...,
+except for polyfit(), which is a drop-in replacement for numpy.polyfit.
+
+Usage example
+====
+import dec_polyfit
+coeffs, covs, chisq = dec_polyfit.fit_orders(dec, ratio, ratio_err, max_order=4)
+coeff_errs = dec_polyfit.bootstrap_errors(dec, ratio, ratio_err, max_order=4, nboot=1000)
+====
+"""
+import numpy as np
+
+def _usable(x, y, sigma):
+    '''Finite, unmasked points with positive sigma, as plain float arrays.'''
+    good = ~(np.ma.getmaskarray(x) | np.ma.getmaskarray(y) | np.ma.getmaskarray(sigma))
+    x, y, sigma = [np.ma.getdata(v).astype(float) for v in (x, y, sigma)]
+    good &= np.isfinite(x) & np.isfinite(y) & np.isfinite(sigma) & (sigma > 0)
+    return x[good], y[good], sigma[good]
+
+def _scaling(x):
+    '''Centre and half-range mapping x onto [-1, 1].'''
+    x0 = 0.5*(x.max() + x.min())
+    s = 0.5*(x.max() - x.min())
+    if s == 0:
+        s = 1.
+    return x0, s
+
+def _unscale_matrix(x0, s, nparams):
+    '''T such that T.dot(c) converts coefficients of ((x-x0)/s)^j into coefficients of x^i.'''
+    T = np.zeros((nparams, nparams))
+    for j in range(nparams):
+        # ((x - x0)/s)^j = sum_i binom(j, i) x^i (-x0)^(j-i) / s^j
+        binom = 1.
+        for i in range(j + 1):
+            T[i, j] = binom*(-x0)**(j - i)/s**j
+            binom = binom*(j - i)/(i + 1.)
+    return T
+
+def fit_orders(x, y, sigma, max_order=4, absolute_sigma=False):
+    '''
+    Weighted least-squares polynomials of every order from 0 to max_order.
+
+    x, y, sigma: the Dec, ratio and ratio error of each source; masked or non-finite points
+    and those with sigma <= 0 are left out.
+    Returns coeffs, covs and chisq: coeffs[k] is the (k+1,) coefficients of the order-k fit in
+    increasing powers of x, covs[k] their covariance, scaled by chisq/dof unless absolute_sigma
+    as in scipy.optimize.curve_fit, and chisq the (max_order+1,) chi-squares.
+    '''
+    x, y, sigma = _usable(x, y, sigma)
+    nparams = max_order + 1
+    x0, s = _scaling(x)
+
+    V = ((x - x0)/s)[:, np.newaxis]**np.arange(nparams)
+    Vw = V/sigma[:, np.newaxis]
+    b = y/sigma
+    Q, R = np.linalg.qr(Vw)
+    qb = np.dot(Q.T, b)
+    T = _unscale_matrix(x0, s, nparams)
+
+    coeffs, covs = [], []
+    chisq = np.zeros(nparams)
+    for k in range(nparams):
+        n = k + 1
+        Rinv = np.linalg.inv(R[:n, :n])
+        c = np.dot(Rinv, qb[:n])
+        cov = np.dot(Rinv, Rinv.T)
+        chisq[k] = np.sum((b - np.dot(Vw[:, :n], c))**2)
+        if not absolute_sigma:
+            dof = len(x) - n
+            cov = cov*(chisq[k]/dof if dof > 0 else np.inf)
+        Tk = T[:n, :n]
+        coeffs.append(np.dot(Tk, c))
+        covs.append(np.dot(Tk, np.dot(cov, Tk.T)))
+    return coeffs, covs, chisq
+
+def fit_basis(basis, y, sigma, absolute_sigma=False):
+    '''
+    Weighted least-squares fit of y = sum_j p_j*basis[j], e.g. the quadratic pinned to turn over
+    at the zenith, with basis [1, dec^2 + 53.4*dec]. basis: sequence of arrays like y.
+    Returns the parameters, their covariance (as in fit_orders) and the chi-square.
+    '''
+    mask = np.ma.getmaskarray(y) | np.ma.getmaskarray(sigma)
+    y, sigma = np.ma.getdata(y).astype(float), np.ma.getdata(sigma).astype(float)
+    A = np.column_stack([np.ma.getdata(v).astype(float)*np.ones(len(y)) for v in basis])
+    use = ~mask & np.isfinite(y) & np.isfinite(sigma) & (sigma > 0) & np.all(np.isfinite(A), axis=1)
+    A, y, sigma = A[use], y[use], sigma[use]
+
+    Q, R = np.linalg.qr(A/sigma[:, np.newaxis])
+    p = np.linalg.solve(R, np.dot(Q.T, y/sigma))
+    Rinv = np.linalg.inv(R)
+    cov = np.dot(Rinv, Rinv.T)
+    chisq = np.sum(((y - np.dot(A, p))/sigma)**2)
+    if not absolute_sigma:
+        dof = len(y) - len(p)
+        cov = cov*(chisq/dof if dof > 0 else np.inf)
+    return p, cov, chisq
+
+def bootstrap_errors(x, y, sigma, max_order=4, nboot=1000, seed=None):
+    '''
+    Bootstrap standard deviations of the fit_orders() coefficients: nboot resamples of the
+    points, drawn with replacement, are fitted together with one batched solve per order.
+    Returns errs, with errs[k] the (k+1,) errors of the order-k coefficients.
+    '''
+    x, y, sigma = _usable(x, y, sigma)
+    nparams = max_order + 1
+    x0, s = _scaling(x)
+    T = _unscale_matrix(x0, s, nparams)
+
+    rng = np.random.RandomState(seed)
+    counts = rng.multinomial(len(x), np.ones(len(x))/len(x), size=nboot)
+    wts = counts/sigma**2
+
+    V = ((x - x0)/s)[:, np.newaxis]**np.arange(nparams)
+    A = np.einsum('bn,ni,nj->bij', wts, V, V)
+    rhs = np.einsum('bn,ni,n->bi', wts, V, y)
+
+    errs = []
+    for k in range(nparams):
+        n = k + 1
+        Ak = A[:, :n, :n]
+        # Resamples with too few distinct points to constrain this order are left out
+        ok = (counts > 0).sum(axis=1) > k
+        ok &= np.abs(np.linalg.det(Ak)) > 0
+        if not np.any(ok):
+            errs.append(np.nan*np.ones(n))
+            continue
+        c = np.linalg.solve(Ak[ok], rhs[ok, :n, np.newaxis])[:, :, 0]
+        errs.append(np.std(np.dot(c, T[:n, :n].T), axis=0, ddof=1))
+    return errs
+
+def polyfit(x, y, deg, w=None):
+    '''
+    Like numpy.polyfit(x, y, deg, w=w): weights multiply the residuals, and the coefficients are
+    highest power first. Masked and non-finite points are left out, as with numpy.ma.polyfit.
+    '''
+    if w is None:
+        sigma = np.ones(np.shape(y))
+    else:
+        with np.errstate(divide='ignore'):
+            sigma = 1./np.ma.asarray(w, dtype=float)
+    coeffs, covs, chisq = fit_orders(x, y, sigma, max_order=deg)
+    return coeffs[deg][::-1]
@@ -0,0 +1,61 @@
+"""
+Fast evaluation of corrections which depend only on declination
+
+The Dec polynomials and the sigmoid edge weights are functions of Dec alone,
+but the scripts evaluated them (exponentials and powers) on every pixel of
+the mosaic. A DecTable evaluates the function once on a fine 1D Dec grid and
+interpolates it linearly at each pixel. Discontinuities, such as the edges of
+the sigmoid weight, can be given as breaks so that they stay sharp.
+
+For images where Dec is constant along each row, e.g. CAR with no rotation,
+row_decs() finds the Dec of every row from a few columns. The function can
+then be evaluated once per row and broadcast along the rows, without the RA
+and Dec maps of the image at all.
+
+Usage example
+====
+import dec_table
+row_dec = dec_table.row_decs(w, data.shape)
+if row_dec is not None:
+    data *= correction(row_dec)[:, np.newaxis]
+else:
+    data *= dec_table.DecTable(correction)(dec)
+====
+"""
+import numpy as np
+
+import sky_coords
+
+class DecTable(object):
+    '''
+    func(dec) tabulated every step degrees from dec_min to dec_max, plus either side of
+    each of breaks, and interpolated linearly; NaN outside the grid.
+    '''
+    def __init__(self, func, dec_min=-90., dec_max=90., step=1e-3, breaks=()):
+        grid = np.linspace(dec_min, dec_max, int(round((dec_max - dec_min)/step)) + 1)
+        breaks = np.ravel(breaks).astype(float)
+        breaks = breaks[(breaks > dec_min) & (breaks < dec_max)]
+        if len(breaks):
+            # The function is evaluated at each break and one float either side of it
+            grid = np.union1d(grid, np.concatenate((np.nextafter(breaks, -np.inf), breaks, np.nextafter(breaks, np.inf))))
+        self.grid = grid
+        self.values = np.asarray(func(grid), dtype=float)*np.ones(len(grid))
+
+    def __call__(self, dec):
+        return np.interp(dec, self.grid, self.values, left=np.nan, right=np.nan)
+
+def row_decs(w, shape, origin=1, ncols=5, tol=1e-9):
+    '''
+    The (ny,) Dec of each row of an image of shape (ny, nx) if Dec is the same, and finite, at
+    ncols columns spread across every row, else None.
+    '''
+    w = sky_coords.celestial(w)
+    ny, nx = tuple(shape[-2:])
+    cols = np.unique(np.linspace(0, nx - 1, ncols).astype(int))
+    yy, xx = np.meshgrid(np.arange(ny), cols, indexing='ij')
+    ra, dec = w.wcs_pix2world(xx, yy, origin)
+    if not np.all(np.isfinite(dec)):
+        return None
+    if np.max(np.abs(dec - dec[:, :1])) > tol:
+        return None
+    return dec[:, 0]
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+# Derive the declination dependent flux scale corrections of all the mosaics of a week
+# (20 subbands x 7 Dec strips) in one run, instead of one decfluxdependence_derive.py
+# process per mosaic. ra_dec_limits_polyderivation.dat and the reference catalogue
+# marco_all_VLSSsrcs.fits are read once and shared, and the mosaics are spread over a pool of
+# worker processes.
+# Writes the same *_fluxdentable.fits, *_fluxdentable_decut.fits and *_poly_coefficients.fits.
+
+import datetime
+import glob
+import multiprocessing
+import os
+import traceback
+import decfluxdependence_derive as decflux
+
+# decflux.reference_catalogue(), loaded once in the parent; forked workers inherit it
+reference = None
+
+def process(args):
+    '''Worker: one mosaic. Returns the mosaic, the coefficients file (or None) and any traceback.'''
+    input_mosaic, options, limits, cores = args
+    try:
+        return input_mosaic, decflux.process_mosaic(input_mosaic, options, limits=limits, cores=cores, reference=reference), None
+    except Exception:
+        return input_mosaic, None, traceback.format_exc()
+
+if __name__ == '__main__':
+
+    parser = decflux.option_parser()
+    parser.set_usage("Usage: %prog [options] <mosaic> [<mosaic> ...]\n")
+    parser.add_option('--week',type="string", dest="week",default=None,
+                        help="Process every mosaic in the working directory with this week (e.g. 20131107) in its name and a *_comp.vot, as well as those given as arguments.")
+    parser.add_option('--workers',dest="workers",default=None,type=int,
+                        help="How many mosaics to process at once. (default = all available cores)")
+    (options, args) = parser.parse_args()
+
+    mosaics = [os.path.splitext(mosaic)[0] if mosaic.endswith('.fits') else mosaic for mosaic in args]
+    if options.mosaic:
+        mosaics.append(options.mosaic)
+    if options.week:
+        mosaics += [comp[:-len('_comp.vot')] for comp in sorted(glob.glob('*'+options.week+'*_comp.vot'))]
+    mosaics = sorted(set(mosaics))
+    if not mosaics:
+        parser.error("no mosaics given")
+
+    if options.workers is None:
+        workers = multiprocessing.cpu_count()
+    else:
+        workers = options.workers
+    workers = min(workers, len(mosaics))
+
+    # Each worker fits its sources serially; with a single worker the sources get all the cores
+    if workers > 1:
+        cores = 1
+    elif options.cores is None:
+        cores = multiprocessing.cpu_count()
+    else:
+        cores = options.cores
+
+    # Read the empirical RA and Dec limits once for all the mosaics
+    if options.make_plots or not all(os.path.exists(mosaic+'_fluxdentable_decut.fits') for mosaic in mosaics):
+        limits = decflux.polyderivation_limits()
+    else:
+        limits = None
+    # and the reference catalogue, with its ellipses indexed, for those still to be crossmatched
+    if not all(os.path.exists(mosaic+'_fluxdentable_decut.fits') for mosaic in mosaics):
+        reference = decflux.reference_catalogue()
+
+    print "#----------------------------------------------------------#"
+    print 'Deriving Dec-dependent flux scale corrections for '+str(len(mosaics))+' mosaics on '+str(workers)+' workers: '+str(datetime.datetime.now())
+
+    jobs = [(mosaic, options, limits, cores) for mosaic in mosaics]
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        results = pool.imap_unordered(process, jobs)
+    else:
+        results = (process(job) for job in jobs)
+
+    written, skipped, failed = [], [], []
+    for input_mosaic, coefficients, error in results:
+        if error is not None:
+            print 'Failed on '+input_mosaic+':'
+            print error
+            failed.append(input_mosaic)
+        elif coefficients is None:
+            skipped.append(input_mosaic)
+        else:
+            written.append(coefficients)
+
+    if workers > 1:
+        pool.close()
+        pool.join()
+
+    print "#----------------------------------------------------------#"
+    print 'Wrote '+str(len(written))+' *_poly_coefficients.fits; '+str(len(skipped))+' mosaics use corrections from another mosaic; '+str(len(failed))+' failed: '+str(datetime.datetime.now())
+    for input_mosaic in failed:
+        print '  failed: '+input_mosaic
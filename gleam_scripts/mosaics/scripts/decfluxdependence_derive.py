@@ -12,79 +12,120 @@ import numpy as np
 import matplotlib as mpl 
 mpl.use('Agg') # So does not use display
 import matplotlib.pylab as plt
-import scipy.optimize as opt
 import scipy.stats as stats
 from astropy.io import fits
 from optparse import OptionParser
 import os
+import multiprocessing
 import sys
-import emcee
+import reference_photometry
+import sky_match
+import reference_index
+import sed_fit
+import sed_posterior
+import dec_polyfit
 # import sedplots - ask Joe for a copy
 
-print "#----------------------------------------------------------#"
-print '''Fixing declination dependent flux scale in GLEAM mosaic. Ensure you have votables from Aegean. 
-You need to already run the source finder Aegean on the mosiac and have *_comp.vot and *_isle.vot 
-in your working directory. You get the *_isle.vot table from using the --island option in Aegean.
-Also ensure that the file marco_all_VLSSsrcs.fits is in $MWA_CODE_BASE. You also need stilts and 
-the python package emcee installed on your computer.'''
-
-usage="Usage: %prog [options] <file>\n"
-parser = OptionParser(usage=usage)
-parser.add_option('--mosaic',type="string", dest="mosaic",
-                    help="The filename of the mosaic you want to read in.")
-parser.add_option('--ratio_errors',action="store_true",dest="do_ratio_errors",default=True,
-                    help="Calculate errors on model fits and ratio of it with image flux measurement (default = False)")
-parser.add_option('--plot',action="store_true",dest="make_plots",default=False,
-                    help="Make fit plots? (default = False)")
-parser.add_option('--zenith',action="store_true",dest="zenith",default=False,
-                    help="Calculate correction for the special case of zenith.")
-(options, args) = parser.parse_args()
-
-input_mosaic = options.mosaic
-
-def redchisq(ydata,ymod,sd,deg):
-    chisq=np.sum(((ydata-ymod)/sd)**2)
-    nu=ydata.size-1-deg
-    return [chisq, chisq/nu]#, chisq/nu
-
-
-header = fits.getheader(input_mosaic+'.fits')
-try:
-    freq_obs = header['CRVAL3']/1e6
-except:
-    freq_obs = header['FREQ']/1e6
-if 72. < freq_obs < 103.:
-    subband = 1
-elif 103.01 < freq_obs < 134.:
-    subband = 2
-elif 139. < freq_obs < 170.:
-    subband = 3
-elif 170.01 < freq_obs < 200.:
-    subband = 4
-elif 200.01 < freq_obs < 231.:
-    subband = 5
-Dec_strip = header['CRVAL2']
-
-# Checking if file with ratios already exists. If they do, skip to straight fitting. 
-
-if not os.path.exists(input_mosaic+'_fluxdentable_decut.fits'):
-
-    print "#----------------------------------------------------------#"
-    print 'Crossmatching mosaic with literature using stilts.'
-
-    os.system('stilts tmatch2 in1='+input_mosaic+'_comp.vot in2='+input_mosaic+'_isle.vot join=1and2 find=best matcher=exact values1="island" values2="island" out='+input_mosaic+'_tot.vot')
-    #os.system('stilts tskymatch2 in1=$MWA_CODE_BASE/marco_all_VLSSsrcs.fits in2='+input_mosaic+'_tot.vot out=marco_all_VLSSsrcs+'+input_mosaic+'.fits ra1=RAJ2000 dec1=DEJ2000 ra2=ra_1 dec2=dec_1 error=40')
-    os.system('stilts tmatch2 matcher=skyellipse in1=$MWA_CODE_BASE/marco_all_VLSSsrcs.fits in2='+input_mosaic+'_tot.vot out=marco_all_VLSSsrcs+'+input_mosaic+'.fits values1="RAJ2000 DEJ2000 MajAxis MinAxis PA" values2="ra_1 dec_1 a b pa_1" params=20')
-
-    hdulist = fits.open('marco_all_VLSSsrcs+'+input_mosaic+'.fits')
-    hdulist.verify('fix')
-    tbdata = hdulist[1].data
-    hdulist.close()
+def option_parser():
+    '''The options of this script, shared with the multi-mosaic driver decflux_week.py.'''
+    usage="Usage: %prog [options] <file>\n"
+    parser = OptionParser(usage=usage)
+    parser.add_option('--mosaic',type="string", dest="mosaic",
+                        help="The filename of the mosaic you want to read in.")
+    parser.add_option('--ratio_errors',action="store_true",dest="do_ratio_errors",default=True,
+                        help="Calculate errors on model fits and ratio of it with image flux measurement (default = False)")
+    parser.add_option('--error_method',type="string", dest="error_method",default="mcmc",
+                        help="How to calculate the ratio errors: mcmc (batched ensemble sampler), laplace (analytic covariance) or emcee (one emcee run per source) (default = mcmc)")
+    parser.add_option('--cores',dest="cores",default=None,type=int,
+                        help="How many cores to share the ratio error calculation between. (default = all available)")
+    parser.add_option('--adaptive',action="store_true",dest="adaptive",default=False,
+                        help="Stop each source's MCMC chain once it has --n_independent independent samples, based on its autocorrelation time (default = False)")
+    parser.add_option('--n_independent',dest="n_independent",default=500,type=int,
+                        help="Number of independent samples wanted with --adaptive (default = 500)")
+    parser.add_option('--mcmc_steps',dest="mcmc_steps",default=500,type=int,
+                        help="Number of MCMC steps, or the cap on them with --adaptive; the first 200, or half if fewer, are burn-in (default = 500)")
+    parser.add_option('--plot',action="store_true",dest="make_plots",default=False,
+                        help="Make fit plots? (default = False)")
+    parser.add_option('--zenith',action="store_true",dest="zenith",default=False,
+                        help="Calculate correction for the special case of zenith.")
+    parser.add_option('--bootstrap',dest="nboot",default=1000,type=int,
+                        help="Number of bootstrap resamples for the errors on the polynomial coefficients; 0 for none. (default = 1000)")
+    return parser
+
+def mosaic_frequency(input_mosaic):
+    '''Observing frequency in MHz, subband (1-5) and central Dec of a mosaic, from its header.'''
+    header = fits.getheader(input_mosaic+'.fits')
+    try:
+        freq_obs = header['CRVAL3']/1e6
+    except:
+        freq_obs = header['FREQ']/1e6
+    if 72. < freq_obs < 103.:
+        subband = 1
+    elif 103.01 < freq_obs < 134.:
+        subband = 2
+    elif 139. < freq_obs < 170.:
+        subband = 3
+    elif 170.01 < freq_obs < 200.:
+        subband = 4
+    elif 200.01 < freq_obs < 231.:
+        subband = 5
+    Dec_strip = header['CRVAL2']
+    return freq_obs, subband, Dec_strip
+
+def polyderivation_limits(cutdir=None):
+    '''The empirical RA and Dec limits in ra_dec_limits_polyderivation.dat, by Dec strip and subband.'''
+    if cutdir is None:
+        cutdir=os.environ['MWA_CODE_BASE']
+    return np.loadtxt(cutdir+'/ra_dec_limits_polyderivation.dat',skiprows=2,unpack=True)
+
+def strip_limits(Dec_strip, subband, limits=None):
+    '''RA_lim1, RA_lim2, Dec_lim1, Dec_lim2 of one mosaic; limits from polyderivation_limits() is read if not given.'''
+    if limits is None:
+        limits = polyderivation_limits()
+    centre_dec, freq_band, RA_lim1, RA_lim2, Dec_lim1, Dec_lim2 = limits
+    cut_ind = np.where((centre_dec == Dec_strip) & (freq_band == subband))
+    return RA_lim1[cut_ind], RA_lim2[cut_ind], Dec_lim1[cut_ind], Dec_lim2[cut_ind]
 
+def own_corrections(input_mosaic, Dec_strip):
+    '''False for the mosaics which use the corrections derived from another mosaic.'''
     week=input_mosaic.split("_")[1][0:8]
-    if Dec_strip == -40. or Dec_strip == -55. or Dec_strip == -72. or ( week != "20131107" and week != "20131111" and week != "20131125" and week != "20130822" ):
-        print "Will automatically use corrections from another mosaic."
-        sys.exit(0)
+    return not (Dec_strip == -40. or Dec_strip == -55. or Dec_strip == -72. or ( week != "20131107" and week != "20131111" and week != "20131125" and week != "20130822" ))
+
+# Positions and error ellipses of the VLSSr sources in marco_all_VLSSsrcs.fits
+reference_values = ('RAJ2000','DEJ2000','MajAxis','MinAxis','PA')
+
+def reference_catalogue():
+    '''marco_all_VLSSsrcs.fits in $MWA_CODE_BASE, from its saved reference_index, with its ellipses indexed.'''
+    reference = reference_index.load(os.environ['MWA_CODE_BASE']+'/marco_all_VLSSsrcs.fits', ra='RAJ2000', dec='DEJ2000')
+    reference.ellipses(*reference_values[2:])
+    return reference
+
+def crossmatch(input_mosaic, reference=None):
+    '''
+    Join the Aegean components and islands of a mosaic and match them to marco_all_VLSSsrcs.fits.
+    reference: reference_catalogue(), loaded here if not given.
+    '''
+    print "#----------------------------------------------------------#"
+    print 'Crossmatching mosaic with literature.'
+
+    if reference is None:
+        reference = reference_catalogue()
+    # Components with their islands, as stilts matcher=exact on island (find=best, join=1and2)
+    tot = sky_match.match_exact(sky_match.read_table(input_mosaic+'_comp.vot'), sky_match.read_table(input_mosaic+'_isle.vot'), 'island')
+    # Match the error ellipses of the VLSSr sources and the Aegean components, as stilts matcher=skyellipse
+    values, index = reference.ellipses(*reference_values[2:])
+    sky_match.match_ellipses(reference.table, tot, values1=reference_values, values2=('ra_1','dec_1','a','b','pa_1'),
+        index1=index).write('marco_all_VLSSsrcs+'+input_mosaic+'.fits', overwrite=True)
+    return 'marco_all_VLSSsrcs+'+input_mosaic+'.fits'
+
+def derive_ratios(input_mosaic, options, freq_obs, limits, cores=1, reference=None):
+    '''
+    Fit the SEDs of the crossmatched sources, and write the flux density ratios of the good ones
+    to <input_mosaic>_fluxdentable.fits and, within the RA and Dec limits, _fluxdentable_decut.fits.
+    limits: RA_lim1, RA_lim2, Dec_lim1, Dec_lim2 from strip_limits(). reference: reference_catalogue().
+    '''
+    tbdata = reference_photometry.read_columns(crossmatch(input_mosaic, reference), reference_photometry.reference_columns(wsrt=True) +
+        ['peak_flux_1', 'err_peak_flux', 'int_flux_1', 'err_int_flux_1', 'int_flux_2', 'eta', 'flags_1', 'a', 'b', 'err_a', 'components', 'local_rms_1', 'isolated'])
 
     print "#----------------------------------------------------------#"
     print 'Analysing '+input_mosaic
@@ -92,31 +133,16 @@ if not os.path.exists(input_mosaic+'_fluxdentable_decut.fits'):
     VLSSr_Name = np.array(tbdata['ID_vlss'])
     RA = np.array(tbdata['RAJ2000_vlss']) #VLSSr positions
     Dec = np.array(tbdata['DEJ2000_vlss'])
-    RA_NVSS = np.array(tbdata['RAJ2000'])
-    RA_NVSS = np.where(np.isnan(RA_NVSS), 0, RA_NVSS)
-    Dec_NVSS = np.array(tbdata['DEJ2000'])
-    Dec_NVSS = np.where(np.isnan(Dec_NVSS), 0, Dec_NVSS)
-    S_74 = np.array(tbdata['S_vlss']) # Integrated flux of VLSSr.
-    S_74_err = np.sqrt((np.array(tbdata['e_S_vlss'])**2 + (S_74*0.1)**2))
-    S_1400 = np.array(tbdata['S'])
-    S_1400 = np.where(np.isnan(S_1400), 0, S_1400)
-    S_1400_err = np.array(tbdata['e_S'])
-    S_1400_err = np.where(np.isnan(S_1400_err), 0, S_1400_err)
-    S_843_north = np.array(tbdata['S_sumss_north'])
-    S_843_north = np.where(np.isnan(S_843_north), 0, S_843_north)
-    S_843_north_err = np.array(tbdata['e_S_sumss_north'])
-    S_843_north_err = np.where(np.isnan(S_843_north_err), 0, S_843_north_err)
-    S_408 = np.array(tbdata['S_mrc'])
-    S_408 = np.where(np.isnan(S_408), 0, S_408)
-    S_408_err = np.array(tbdata['e_S_mrc'])
-    S_408_err = np.where(np.isnan(S_408_err), 0, S_408_err)
-    S_160 = np.array(tbdata['S_culgoora160'])
-    S_160 = np.where(np.isnan(S_160), 0, S_160)
-    S_80 = np.array(tbdata['S_culgoora80'])
-    S_80 = np.where(np.isnan(S_80), 0, S_80)
-    S_325 = np.array(tbdata['S_wsrt'])
-    S_325 = np.where(np.isnan(S_325), 0, S_325)
-    S_325_err = (0.06**2 + (4./S_325)**2)**0.5 # from eqn 9 Rengelink et al. (1997)
+    # Literature fluxes with NaNs set to zero, and their errors including the CCA values from Slee 1977
+    ref = reference_photometry.reference_fluxes(tbdata, wsrt=True)
+    RA_NVSS, Dec_NVSS = ref['RA_NVSS'], ref['Dec_NVSS']
+    S_74, S_74_err = ref['S_74'], ref['S_74_err']
+    S_80, S_80_err = ref['S_80'], ref['S_80_err']
+    S_160, S_160_err = ref['S_160'], ref['S_160_err']
+    S_325, S_325_err = ref['S_325'], ref['S_325_err']
+    S_408, S_408_err = ref['S_408'], ref['S_408_err']
+    S_843_north, S_843_north_err = ref['S_843_north'], ref['S_843_north_err']
+    S_1400, S_1400_err = ref['S_1400'], ref['S_1400_err']
     S_196 = np.array(tbdata['peak_flux_1']) # MWA from aegean
     S_196_err = np.array(tbdata['err_peak_flux'])
     S_196_int = np.array(tbdata['int_flux_1'])
@@ -132,174 +158,45 @@ if not os.path.exists(input_mosaic+'_fluxdentable_decut.fits'):
     S_196_isle_int = S_196_isle_int / eta 
     isolated_flag = np.array(tbdata['isolated'])
 
-    # Working out the uncertainties on CCA values
-    S_160_err = np.zeros(len(S_160))
-    S_80_err = np.zeros(len(S_80))
-    for i in range(len(S_160)):
-        if S_160[i] > 0:
-            #fixing up errors as per Table 3 in Slee 1977. Assuming average of two
-            if S_160[i] <= 3:
-                S_160_err[i] = 0.27*S_160[i]
-            elif S_160[i] > 3 and S_160[i] <= 5:
-                S_160_err[i] = 0.23*S_160[i]
-            elif S_160[i] > 5 and S_160[i] <= 12:
-                S_160_err[i] = 0.17*S_160[i]
-            elif S_160[i] > 12 and S_160[i] <= 20:
-                S_160_err[i] = 0.10*S_160[i]
-            elif S_160[i] > 20:
-                S_160_err[i] = 0.9*S_160[i]
-
-        if S_80[i] > 0:
-            if S_80[i] <= 10:
-                S_80_err[i] = 0.32*S_80[i]
-            elif S_80[i] > 10 and S_80[i] <= 20:
-                S_80_err[i] = 0.20*S_80[i]
-            elif S_80[i] > 20:
-                S_80_err[i] = 0.10*S_80[i]
-
-    freq = np.array([74., 80., 160., freq_obs, 325., 408., 843., 1400.])
-    flux = np.vstack((S_74,S_80, S_160, S_196_int, S_325, S_408,S_843_north,S_1400))
-    flux_err = np.vstack((S_74_err,S_80_err, S_160_err, S_196_int_err,S_325_err,
-        S_408_err,S_843_north_err,S_1400_err))
+    freq, flux, flux_err = reference_photometry.flux_stack(ref, freq_obs, S_196_int, S_196_int_err, wsrt=True)
 
     print "#----------------------------------------------------------#"
     print 'Fitting powerlaw to flux points, excluding MWA points'
 
-    p0pow = [7,-0.7]
-
     def powlaw(freq, a, alpha): # defining powlaw as S = a*nu^alpha.
         return a*(freq**alpha)
-    do_errors = True
-    srcsind=[]
-    alpha, redchisq_val, MWAfreqfit_predicted, MWAfreqfit_predicted_err, ratio, ratio_err, hour_angle, hour_angle_sym, az, alt= [np.zeros(np.shape(flux[1])[0]) for dummy in range(10)]
-    for i in range(np.shape(flux[1])[0]): # arange(6040,6100):#
-
-        fluxposind = np.where(flux[:,i] > 0)
-        fluxplot = flux[:,i][fluxposind]
-        freqplot = freq[fluxposind]
-        flux_errplot = flux_err[:,i][fluxposind]
-        ind_nomwa = np.where((freq != freq_obs) & (flux[:,i] > 0) & (freq != 80.) & (freq != 160.)& (freq != 325.)) # Fitting to only non zero and non_MWA points and non-texas or 
-        fluxfit = flux[:,i][ind_nomwa]
-        freqfit = freq[ind_nomwa]
-        flux_errfit = flux_err[:,i][ind_nomwa]
-        
-        if len(fluxfit) >= 3 or (Dec[i] > 18. and isolated_flag[i] == True):
-            
-            try:
-                poptpowlaw, pcovpowlaw = opt.curve_fit(powlaw, freqfit, fluxfit, p0 = p0pow, sigma = flux_errfit, maxfev = 10000)            
-            except ValueError: # If curve fit can not find a good fit, skip the source.
-                print 'Skipping because can not find good fit.'
-                continue
-
-            redchisq_val[i] = redchisq(fluxfit,powlaw(freqfit,*poptpowlaw),flux_errfit,2)[0]
-            # if redchisq_val[i] <= 2.5 and err_a[i] >=0 and flags_1[i] == 0 and S_196_isle_int[i]/S_196[i] < 1.4 and S_196_int[i]/S_196[i] < 1.5 and poptpowlaw[1] > 0.1 and S_196[i] > 500.: #and S_196_int[i]/S_196[i] > 1. and S_196_int[i]/S_196[i] < 1.5 # Only want to find point sources that are well fitted by a powerlaw and have three or more points (excluding MWA points).
-            # if redchisq_val[i] <= 2.5 and err_a[i] >=0 and flags_1[i] == 0 and components[i] == 1 and semi_major[i]/(2*semi_minor[i]) <= 1 and poptpowlaw[1] > 0.1 and S_196[i] > 5.:
-            if redchisq_val[i] <= 2.5 and err_a[i] >=0 and flags_1[i] == 0 and components[i] == 1 and abs(poptpowlaw[1]) > 0.1 and 8*rms[i]/S_196_int[i] <= 1. and S_74[i] > 2.0:    #semi_major[i]/(2*semi_minor[i]) <= 1
-
-                print VLSSr_Name[i]+' meets the criteria.'
-
-                MWAfreqfit_predicted[i] = powlaw(freq_obs,*poptpowlaw)
-                ratio[i] = MWAfreqfit_predicted[i] / S_196_int[i]
-                alpha[i] = poptpowlaw[1]
-
-                if options.do_ratio_errors:
-                    
-                    # Calculating uncertainties on fit and ratio
-
-                    x = freqfit
-                    y = fluxfit
-                    yerr = flux_errfit
-
-                    def lnlike(theta,x,y,yerr):
-                        S_norm,specind= theta # Model parameters have to be included in lnlike. This implentation makes it veristile.
-                        model = powlaw(x,S_norm,specind)
-                        inv_sigma = 1.0/(yerr**2)
-                        return -0.5*(np.sum((y-model)**2*inv_sigma - np.log(inv_sigma)))  
-
-                    # Use the scipy.opt model to find the optimum of this likelihood function
-
-                    nll = lambda *args: -lnlike(*args)
-                    p0guess = list(poptpowlaw) # Guessing the parameters of the model. This can be educated guess (i.e from least-square fit)
-                    result = opt.fmin(nll,p0guess, args=(x,y,yerr), full_output='true')
-                    S_norm_ml, specind_ml = result[0]    
-
-                    def lnprior(theta):
-                        S_norm, specind = theta
-                        if poptpowlaw[0]/100. < S_norm < poptpowlaw[0]*100. and abs(poptpowlaw[1]/100.) < abs(specind) < abs(poptpowlaw[1]*100.):
-                            return 0.00    
-                        return -np.inf
-
-                    # Combining this prior with the definition of the likelihood function, the probablity fucntion is:
-
-                    def lnprob(theta, x, y, yerr):
-                        lp = lnprior(theta)
-                        if not np.isfinite(lp):
-                            return -np.inf
-                        return lp + lnlike(theta, x, y, yerr)
-
-                    # Now implement emcee
-
-                    ndim, nwalkers, nsteps =  2, 100, 500
-
-                    # Initialising the walkers in a Gaussian ball around maximum likelihood result
-                    pos = [result[0]+ 1e-4*np.random.randn(ndim) for p in range(nwalkers)]
-
-                    # Next two lines useful for debugging if emcee falls over
-                    # print 'lnprior1', map(lambda p: lnprior(p), pos)
-                    # print 'lnlike', map(lambda p: lnlike(p, x, y, yerr), pos)
-
-                    # print "Before emcee: "+str(datetime.datetime.now())
-                    sampler = emcee.EnsembleSampler(nwalkers, ndim, lnprob, args = (x,y,yerr))
-                    sampler.run_mcmc(pos, nsteps) # This is the workhorse step.
-                    # print "After emcee: "+str(datetime.datetime.now())
-
-                    # Now plotting the walks of the walkers with each step, for each parameter. 
-                    # If they have converged on a good value they should have clumped together.
-
-                    # fig = plt.figure(2,figsize=(10, 10))
-                    # fig.clf()
-                    # for j in range(ndim):
-                    #     ax = fig.add_subplot(ndim,1,j+1)
-                    #     ax.plot(np.array([sampler.chain[:,i,j] for i in range(nsteps)]),"k", alpha = 0.3)
-                    #     ax.set_ylabel((r'$S_{norm}$',r'$\alpha$')[j], fontsize = 15)
-                            
-                    # Usually burn in period is well and truly over by 300 steps. So I will exclude those.
-                    samples = sampler.chain[:,200:,:].reshape((-1,ndim))
-
-                    # Plotting the histograms of the fit.
-                    # trifig = triangle.corner(samples, labels = [r'$S_{norm}$',r'$\alpha$'])
-
-                    # Finally to get the final uncertainties you do
-                    S_norm_powlaw_mcmc, specind_powlaw_mcmc = map(lambda v: (v[1], v[2]-v[1], v[1]-v[0]), zip(*np.percentile(samples,[16,50,84], axis = 0))) # Uncertainites based on the 16th, 50th and 84th percentile.
-                        
-                    # Finding upper (84th percentile) and lower (16th percentile) values for all frequencies
-                    fit_powlaw = [S_norm_powlaw_mcmc[0], specind_powlaw_mcmc[0]]
-                    
-                    # Calculating uncertainity at 
-                    flux_store = np.zeros((100,1))
-                    lower_flux_powlaw, upper_flux_powlaw = np.zeros(1), np.zeros(1)
-                    j=0
-                    for S_norm, specind in samples[np.random.randint(len(samples), size=100)]:
-                        flux_store[j] = powlaw(freq_obs, S_norm,specind)
-                        lower_flux_powlaw, upper_flux_powlaw = np.percentile(flux_store[:],[16,84], axis = 0)
-                        j = j+1    
-                    srcsind.append(i)
-
-                    MWAfreqfit_predicted_err[i] = upper_flux_powlaw - lower_flux_powlaw
-                    ratio_err[i] = ratio[i]*np.sqrt((S_196_int_err[i] / S_196_int[i])**2 + (MWAfreqfit_predicted_err[i] / MWAfreqfit_predicted[i])**2)
-                    alpha[i] = specind
-                    
-                    # sedplots.sed(powlaw,poptpowlaw,freqplot,fluxplot,flux_errplot, freq_labels = True, savefig = False, title = VLSSr_Name[i]+r' $\alpha$ = '+str(round(alpha[i],3))+r' $ \chi_{\rm{red}}$  = '+str(round(redchisq_val[i])))#+' ObsID = '+str(aegeanfiles[j]))
-                    # if not os.path.exists(os.getcwd()+'/figures/'):
-                    #     os.makedirs(os.getcwd()+'/figures/')
-                    # #     print 'Creating directory ', os.getcwd()+'/'+directory+'/figures/'+VLSSr_Name[i]+' and saving figures in png format with title names.'
-                    # plt.savefig(os.getcwd()+'/figures/'+VLSSr_Name[i]+'.png')
-                else:
-                    srcsind.append(i)
 
+    # Fitting to only non zero and non_MWA points and non-texas or CCA points, all sources at once.
+    fitmask = ((freq != freq_obs) & (freq != 80.) & (freq != 160.) & (freq != 325.))[:,np.newaxis] & (flux > 0)
+    amp_fit, alpha_fit, cov_fit, chisq_fit, redchisq_fit, npts_fit = sed_fit.fit_powlaw(freq, flux, flux_err, use=fitmask)
 
-        else:
-            print 'Less than three flux values. Skipping...'
+    eligible = np.isfinite(alpha_fit) & ((np.sum(fitmask, axis=0) >= 3) | ((Dec > 18.) & (isolated_flag == True)))
+    print 'Skipping '+str(np.sum(~eligible))+' sources with less than three flux values or no good fit.'
+
+    alpha, redchisq_val, MWAfreqfit_predicted, MWAfreqfit_predicted_err, ratio, ratio_err = [np.zeros(np.shape(flux[1])[0]) for dummy in range(6)]
+    mcmc_steps = np.zeros(len(alpha), dtype=int)
+    mcmc_tau = np.zeros(len(alpha))
+    redchisq_val[eligible] = chisq_fit[eligible] # redchisq()[0] as before, i.e. the chi-square
+
+    # Only want to find point sources that are well fitted by a powerlaw and have three or more points (excluding MWA points).
+    with np.errstate(divide='ignore', invalid='ignore'):
+        accepted = eligible & (redchisq_val <= 2.5) & (err_a >= 0) & (flags_1 == 0) & (components == 1) & (np.abs(alpha_fit) > 0.1) & (8*rms/S_196_int <= 1.) & (S_74 > 2.0)
+    srcsind = np.where(accepted)[0]
+    print str(len(srcsind))+' sources meet the criteria.'
+
+    MWAfreqfit_predicted[srcsind] = powlaw(freq_obs, amp_fit[srcsind], alpha_fit[srcsind])
+    ratio[srcsind] = MWAfreqfit_predicted[srcsind] / S_196_int[srcsind]
+    alpha[srcsind] = alpha_fit[srcsind]
+
+    if options.do_ratio_errors:
+
+        # Calculating uncertainties on fit and ratio for all the accepted sources at once
+        print 'Calculating uncertainties using '+options.error_method+' on '+str(cores)+' cores'
+        MWAfreqfit_predicted_err[srcsind], alpha[srcsind], mcmc_steps[srcsind], mcmc_tau[srcsind] = sed_posterior.predicted_flux_err(freq, flux[:,srcsind], flux_err[:,srcsind],
+            fitmask[:,srcsind], amp_fit[srcsind], alpha_fit[srcsind], freq_obs, method=options.error_method,
+            seeds=sed_posterior.source_seeds(VLSSr_Name[srcsind]), cores=cores,
+            nsteps=options.mcmc_steps, n_independent=options.n_independent if options.adaptive else None)
+        ratio_err[srcsind] = ratio[srcsind]*np.sqrt((S_196_int_err[srcsind] / S_196_int[srcsind])**2 + (MWAfreqfit_predicted_err[srcsind] / MWAfreqfit_predicted[srcsind])**2)
 
     # Saving file of sources into .fits
 
@@ -334,11 +231,13 @@ if not os.path.exists(input_mosaic+'_fluxdentable_decut.fits'):
     col28 = fits.Column(name='redchisq', format = 'E', array = redchisq_val[srcsind])
     col29 = fits.Column(name='alpha', format = 'E', array = alpha[srcsind])
     col42 = fits.Column(name='rms', format = 'E', array = rms[srcsind])
+    col45 = fits.Column(name='mcmc_steps', format = 'J', array = mcmc_steps[srcsind])
+    col46 = fits.Column(name='mcmc_tau', format = 'E', array = mcmc_tau[srcsind])
 
     cols = fits.ColDefs([col1, col13, col14, col2, col43,
         col3, col4, col44, col19, col20, col21, col27, col5, col6, col30, col31,col32, col33,
         col38, col39, col7, col8, col9, col10, 
-        col11, col12, col23, col24, col28, col29, col42])
+        col11, col12, col23, col24, col28, col29, col42, col45, col46])
     tbhdu = fits.new_table(cols)  
     print "#----------------------------------------------------------#"
     print 'Saving to a fits file.'  
@@ -347,17 +246,7 @@ if not os.path.exists(input_mosaic+'_fluxdentable_decut.fits'):
     print 'Note that you should eyeball dec V ratio to make sure sensible result.'
 
     # Making dec cut for sources with high SNR properties. Reading in empirical limts.
-
-    cutdir=os.environ['MWA_CODE_BASE']
-
-    centre_dec, freq_band, RA_lim1, RA_lim2, Dec_lim1, Dec_lim2 = np.loadtxt(cutdir+'/ra_dec_limits_polyderivation.dat',skiprows=2,unpack=True) 
-
-    dec_freq_comb = [centre_dec, freq_band]
-    cut_ind = np.where((centre_dec == Dec_strip) & (freq_band == subband))
-    RA_lim1 = RA_lim1[cut_ind]
-    RA_lim2 = RA_lim2[cut_ind]
-    Dec_lim1 = Dec_lim1[cut_ind]
-    Dec_lim2 = Dec_lim2[cut_ind]
+    RA_lim1, RA_lim2, Dec_lim1, Dec_lim2 = limits
 
     #  cuts -- pretty much universal since we'll never want to use the Galactic plane to do this
     # Set to 22h - 04h
@@ -404,255 +293,276 @@ if not os.path.exists(input_mosaic+'_fluxdentable_decut.fits'):
     col28 = fits.Column(name='redchisq', format = 'E', array = redchisq_val[srcsind][Dec_cut])
     col29 = fits.Column(name='alpha', format = 'E', array = alpha[srcsind][Dec_cut])
     col42 = fits.Column(name='rms', format = 'E', array = rms[srcsind][Dec_cut])
+    col45 = fits.Column(name='mcmc_steps', format = 'J', array = mcmc_steps[srcsind][Dec_cut])
+    col46 = fits.Column(name='mcmc_tau', format = 'E', array = mcmc_tau[srcsind][Dec_cut])
 
     cols = fits.ColDefs([col1, col13, col14, col2, col43,
         col3, col4, col44, col19, col20, col21, col27, col5, col6, col30, col31,col32, col33,
         col38, col39, col7, col8, col9, col10, 
-        col11, col12, col23, col24, col28, col29, col42])#, col22])
+        col11, col12, col23, col24, col28, col29, col42, col45, col46])#, col22])
 
     tbhdu = fits.new_table(cols)    
     tbhdu.writeto(input_mosaic+'_fluxdentable_decut.fits', clobber = True) 
     print 'Wrote to '+input_mosaic+'_fluxdentable_decut.fits'
 
-print 'Working out best fit polynomial.'
-
-hdulist = fits.open(input_mosaic+'_fluxdentable_decut.fits')
-tbdata = hdulist[1].data
-hdulist.close()
-dec = np.array(tbdata['Dec'])
-# Modified to use integrated flux densities
-ratio = np.array(tbdata['S_'+str(int(round(freq_obs)))+'_model']/tbdata['S_'+str(int(round(freq_obs)))+'_integrated_aegean'])
-ratio_err = np.array(tbdata['ratio_err'])
-
-def zero_curvefit(dec,a):
-    return a
-
-def lin_curvefit(dec, a, b): # defining quadratic
-    return b*dec + a
-
-def quad_curvefit(dec, a, b, c): # defining quadratic
-    return c*np.power(dec,2) + b*dec + a
+def fit_polynomials(input_mosaic, options, freq_obs, limits=None):
+    '''
+    Fit polynomials in Dec to the ratios in <input_mosaic>_fluxdentable_decut.fits and write
+    them to <input_mosaic>_poly_coefficients.fits. limits are only needed with options.make_plots.
+    '''
+    print 'Working out best fit polynomial.'
 
-def quad_curvefit_zenith(dec, a, c): # defining quadratic
-    return c*(np.power(dec,2) + 53.4*dec) + a
-
-def cubic_curvefit(dec, a, b, c, d): # defining cubic
-    return d*np.power(dec,3) + c*np.power(dec,2) + b*dec + a
-
-def quart_curvefit(dec, a, b, c, d, e): # defining quart
-    return e*np.power(dec,4) + d*np.power(dec,3) + c*np.power(dec,2) + b*dec + a
-
-redchisq_decfits = np.zeros(6)
-a_fit, b_fit, c_fit, d_fit, e_fit = [np.zeros(6) for i in range(5)] 
-
-p_guess_zero = [ 1.5]
-poptzero, pcovzero = opt.curve_fit(zero_curvefit, dec, ratio, p0 = p_guess_zero, sigma = ratio_err, maxfev = 10000)
-redchisq_decfits[0] = redchisq(ratio,zero_curvefit(dec,*poptzero),ratio_err,2)[0]
-a_fit[0] = poptzero[0]
-
-p_guess_lin = [ 1.5,  -7e-02]
-poptlin, pcovlin = opt.curve_fit(lin_curvefit, dec, ratio, p0 = p_guess_lin, sigma = ratio_err, maxfev = 10000)
-redchisq_decfits[1] = redchisq(ratio,lin_curvefit(dec,*poptlin),ratio_err,2)[0]
-a_fit[1], b_fit[1] = poptlin[0], poptlin[1]
-
-p_guess_quad = [ 1.5,  -7e-02,  -2e-03]
-poptquad, pcovquad = opt.curve_fit(quad_curvefit, dec, ratio, p0 = p_guess_quad, sigma = ratio_err, maxfev = 10000)
-redchisq_decfits[2] = redchisq(ratio,quad_curvefit(dec,*poptquad),ratio_err,2)[0]
-a_fit[2], b_fit[2], c_fit[2] = poptquad[0], poptquad[1], poptquad[2]
-
-print input_mosaic+' quad_fit = '+str(poptquad) 
-
-p_guess_cubic = [ 1.5,  -7e-04,  -2e-03, -5.e-05]
-poptcubic, pcovcubic = opt.curve_fit(cubic_curvefit, dec, ratio, p0 = p_guess_cubic, sigma = ratio_err, maxfev = 10000)
-redchisq_decfits[4] = redchisq(ratio,cubic_curvefit(dec,*poptcubic),ratio_err,2)[0]
-a_fit[4], b_fit[4], c_fit[4], d_fit[4] = poptcubic[0], poptcubic[1], poptcubic[2], poptcubic[3]
-
-print input_mosaic+' cubic_fit = '+str(poptcubic)
-
-p_guess_quart = [1.5, 1e-02, 3e-03, 1e-04, 5e-06]
-poptquart, pcovquart = opt.curve_fit(quart_curvefit, dec, ratio, p0 = p_guess_quart, sigma = ratio_err, maxfev = 10000)
-redchisq_decfits[5] = redchisq(ratio,quart_curvefit(dec,*poptquart),ratio_err,2)[0]
-a_fit[5], b_fit[5], c_fit[5], d_fit[5], e_fit[5] = poptquart[0], poptquart[1], poptquart[2], poptquart[3], poptquart[4]
-
-print input_mosaic+' quart_fit = '+str(poptquart)
-
-# Log fits
-
-# log_ratio = np.log(ratio)
-# log_ratio_err = ratio_err / ratio
-
-# p_guess_quad = [ 1.5,  -7e-02,  -2e-03]
-# log_poptquad, log_pcovquad = opt.curve_fit(quad_curvefit, dec, log_ratio, p0 = p_guess_quad, sigma = log_ratio_err, maxfev = 10000)
+    hdulist = fits.open(input_mosaic+'_fluxdentable_decut.fits')
+    tbdata = hdulist[1].data
+    hdulist.close()
+    dec = np.array(tbdata['Dec'])
+    # Modified to use integrated flux densities
+    ratio = np.array(tbdata['S_'+str(int(round(freq_obs)))+'_model']/tbdata['S_'+str(int(round(freq_obs)))+'_integrated_aegean'])
+    ratio_err = np.array(tbdata['ratio_err'])
+
+    def zero_curvefit(dec,a):
+        return a
+
+    def lin_curvefit(dec, a, b): # defining quadratic
+        return b*dec + a
+
+    def quad_curvefit(dec, a, b, c): # defining quadratic
+        return c*np.power(dec,2) + b*dec + a
+
+    def quad_curvefit_zenith(dec, a, c): # defining quadratic
+        return c*(np.power(dec,2) + 53.4*dec) + a
+
+    def cubic_curvefit(dec, a, b, c, d): # defining cubic
+        return d*np.power(dec,3) + c*np.power(dec,2) + b*dec + a
+
+    def quart_curvefit(dec, a, b, c, d, e): # defining quart
+        return e*np.power(dec,4) + d*np.power(dec,3) + c*np.power(dec,2) + b*dec + a
+
+    redchisq_decfits = np.zeros(6)
+    a_fit, b_fit, c_fit, d_fit, e_fit = [np.zeros(6) for i in range(5)] 
+    a_err, b_err, c_err, d_err, e_err = [np.zeros(6) for i in range(5)]
+
+    # Zeroth to quartic order from one QR decomposition; rows 0, 1, 2, 4 and 5 of the table
+    coeffs, covs, chisq = dec_polyfit.fit_orders(dec, ratio, ratio_err, max_order=4)
+    poptzero, poptlin, poptquad, poptcubic, poptquart = coeffs
+    rows = [0, 1, 2, 4, 5]
+    redchisq_decfits[rows] = chisq
+    for row, popt in zip(rows, coeffs):
+        for fit, value in zip([a_fit, b_fit, c_fit, d_fit, e_fit], popt):
+            fit[row] = value
+    if options.nboot > 0:
+        for row, perr in zip(rows, dec_polyfit.bootstrap_errors(dec, ratio, ratio_err, max_order=4, nboot=options.nboot, seed=0)):
+            for err, value in zip([a_err, b_err, c_err, d_err, e_err], perr):
+                err[row] = value
+
+    print input_mosaic+' quad_fit = '+str(poptquad) 
+    print input_mosaic+' cubic_fit = '+str(poptcubic)
+    print input_mosaic+' quart_fit = '+str(poptquart)
+
+    # Log fits
+
+    # log_ratio = np.log(ratio)
+    # log_ratio_err = ratio_err / ratio
+
+    # p_guess_quad = [ 1.5,  -7e-02,  -2e-03]
+    # log_poptquad, log_pcovquad = opt.curve_fit(quad_curvefit, dec, log_ratio, p0 = p_guess_quad, sigma = log_ratio_err, maxfev = 10000)
+
+    # p_guess_cubic = [ 1.5,  -7e-04,  -2e-03, -5.e-05]
+    # log_poptcubic, log_pcovcubic = opt.curve_fit(cubic_curvefit, dec, log_ratio, p0 = p_guess_cubic, sigma = log_ratio_err, maxfev = 10000)
+
+    w = 1. / ratio_err
+    SNR = np.log10(w)
+
+    if options.make_plots:
+
+        RA_lim1, RA_lim2, Dec_lim1, Dec_lim2 = limits
+
+        if options.zenith:
+
+            poptquad_zenith, pcovquad_zenith, redchisq_decfits[3] = dec_polyfit.fit_basis([1., np.power(dec,2) + 53.4*dec], ratio, ratio_err)
+            a_fit[3], c_fit[3] = poptquad_zenith[0], poptquad_zenith[1]
+
+            plt.rcParams['figure.figsize'] = 20, 5 # Setting figure size. Have to close window for it to have effect.
+            plt.figure() # A new figure for each mosaic processed in this interpreter
+            gs = plt.GridSpec(1,6)
+            ax = plt.subplot(gs[0])
+            ax1 = plt.subplot(gs[1])
+            ax2 = plt.subplot(gs[2])
+            ax3 = plt.subplot(gs[3])
+            ax4 = plt.subplot(gs[4])
+            ax5 = plt.subplot(gs[5])
+            # ax.scatter(dec, ratio, marker='+',color = 'k',c=SNR, cmap=plt.cm.Greys)#, c=SNR, cmap=plt.cm.Greys)
+            # ax1.scatter(dec, ratio, marker='+',color ='k',c=SNR, cmap=plt.cm.Greys)#, c=SNR, cmap=plt.cm.Greys)
+            # ax2.scatter(dec, ratio, marker='+',color ='k',c=SNR, cmap=plt.cm.Greys)#, c=SNR, cmap=plt.cm.Greys)
+            # ax3.scatter(dec, ratio, marker='+',color ='k',c=SNR, cmap=plt.cm.Greys)
+            # ax4.scatter(dec, ratio, marker='+',color ='k',c=SNR, cmap=plt.cm.Greys)
+            # ax5.scatter(dec, ratio, marker='+',color ='k',c=SNR, cmap=plt.cm.Greys)
+            ax.scatter(dec, ratio, marker='o',color = 'k',c=SNR, cmap=plt.cm.Greys)#, c=SNR, cmap=plt.cm.Greys)
+            ax1.scatter(dec, ratio, marker='o',color ='k',c=SNR, cmap=plt.cm.Greys)#, c=SNR, cmap=plt.cm.Greys)
+            ax2.scatter(dec, ratio, marker='o',color ='k',c=SNR, cmap=plt.cm.Greys)#, c=SNR, cmap=plt.cm.Greys)
+            ax3.scatter(dec, ratio, marker='o',color ='k',c=SNR, cmap=plt.cm.Greys)
+            ax4.scatter(dec, ratio, marker='o',color ='k',c=SNR, cmap=plt.cm.Greys)
+            ax5.scatter(dec, ratio, marker='o',color ='k',c=SNR, cmap=plt.cm.Greys)
+            dec_long = np.arange(Dec_lim1,Dec_lim2,0.1)
+            dec_long = np.array(dec_long)
+            ax.plot(dec_long,np.ones(len(dec_long))*zero_curvefit(dec_long, *poptzero), 'saddlebrown', linewidth = 3, label="zeroth order fit")
+            ax1.plot(dec_long,lin_curvefit(dec_long, *poptlin), 'darkblue', linewidth = 3, label="linear fit")
+            ax2.plot(dec_long,quad_curvefit_zenith(dec_long, *poptquad_zenith), 'darkorange', linewidth = 3, label="Quadratic forced TP fit")
+            ax3.plot(dec_long,quad_curvefit(dec_long, *poptquad), 'darkgreen', linewidth = 3, label="Quadratic fit")
+            ax4.plot(dec_long,cubic_curvefit(dec_long, *poptcubic), 'darkred', linewidth = 3, label="Cubic fit")
+            ax5.plot(dec_long,quart_curvefit(dec_long, *poptquart), 'darkmagenta', linewidth = 3, label="Quartic fit")
+            ax.legend(loc='upper right', fontsize=10) # make a legend in the best location
+            ax1.legend(loc='upper right', fontsize=10) # make a legend in the best location
+            ax2.legend(loc='upper right', fontsize=10) # make a legend in the best location
+            ax3.legend(loc='upper right', fontsize=10) # make a legend in the best location
+            ax4.legend(loc='upper right', fontsize=10) # make a legend in the best location
+            ax5.legend(loc='upper right', fontsize=10) # make a legend in the best location
+            ax.tick_params(axis='y', labelsize=15)
+            ax.tick_params(axis='x', labelsize=10)
+            ax1.tick_params(axis='y', labelsize=15)
+            ax1.tick_params(axis='x', labelsize=10)
+            ax2.tick_params(axis='y', labelsize=15)
+            ax2.tick_params(axis='x', labelsize=10)
+            ax3.tick_params(axis='y', labelsize=15)
+            ax3.tick_params(axis='x', labelsize=10)
+            ax4.tick_params(axis='y', labelsize=15)
+            ax4.tick_params(axis='x', labelsize=10)
+            ax5.tick_params(axis='y', labelsize=15)
+            ax5.tick_params(axis='x', labelsize=10)
+            ax.set_xlabel('Dec. (degrees)', fontsize = 10)
+            ax1.set_xlabel('Dec. (degrees)', fontsize = 10)
+            ax2.set_xlabel('Dec. (degrees)', fontsize = 10)
+            ax3.set_xlabel('Dec. (degrees)', fontsize = 10)
+            ax4.set_xlabel('Dec. (degrees)', fontsize = 10)
+            ax5.set_xlabel('Dec. (degrees)', fontsize = 10)
+            ax.set_ylabel('Ratio', fontsize = 15)
+            plt.savefig(input_mosaic+'_polyfits_int.png')
+            plt.close()
 
-# p_guess_cubic = [ 1.5,  -7e-04,  -2e-03, -5.e-05]
-# log_poptcubic, log_pcovcubic = opt.curve_fit(cubic_curvefit, dec, log_ratio, p0 = p_guess_cubic, sigma = log_ratio_err, maxfev = 10000)
+        else:
 
-w = 1. / ratio_err
-SNR = np.log10(w)
+            plt.rcParams['figure.figsize'] = 20, 5 # Setting figure size. Have to close window for it to have effect.
+            plt.figure() # A new figure for each mosaic processed in this interpreter
+            gs = plt.GridSpec(1,5)
+            ax = plt.subplot(gs[0])
+            ax1 = plt.subplot(gs[1])
+            ax2 = plt.subplot(gs[2])
+            ax3 = plt.subplot(gs[3])
+            ax4 = plt.subplot(gs[4])
+            # ax.errorbar(dec, ratio, ratio_err, marker='.',linestyle='none', color = 'k',alpha=0.5)#, c=SNR, cmap=plt.cm.Greys)
+            # ax1.errorbar(dec, ratio,ratio_err, marker='.',linestyle='none', color ='k',alpha=0.5)#, c=SNR, cmap=plt.cm.Greys)
+            # ax2.errorbar(dec, ratio,ratio_err, marker='.',linestyle='none',color ='k',alpha=0.5)#, c=SNR, cmap=plt.cm.Greys)
+            # ax3.errorbar(dec, ratio, ratio_err,marker='.',linestyle='none',color ='k',alpha=0.5)
+            # ax4.errorbar(dec, ratio, ratio_err,marker='.',linestyle='none',color ='k',alpha=0.5)
+            ax.scatter(dec, ratio, marker='o',color = 'k',c=SNR, cmap=plt.cm.Greys)#, c=SNR, cmap=plt.cm.Greys)
+            ax1.scatter(dec, ratio, marker='o',color ='k',c=SNR, cmap=plt.cm.Greys)#, c=SNR, cmap=plt.cm.Greys)
+            ax2.scatter(dec, ratio, marker='o',color ='k',c=SNR, cmap=plt.cm.Greys)#, c=SNR, cmap=plt.cm.Greys)
+            ax3.scatter(dec, ratio, marker='o',color ='k',c=SNR, cmap=plt.cm.Greys)
+            ax4.scatter(dec, ratio, marker='o',color ='k',c=SNR, cmap=plt.cm.Greys)
+            dec_long = np.arange(Dec_lim1,Dec_lim2,0.1)
+            dec_long = np.array(dec_long)
+            if ratio.max() > 4.0:
+                ax.set_ylim(ratio.min(),2.5)
+                ax1.set_ylim(ratio.min(),2.5)
+                ax2.set_ylim(ratio.min(),2.5)
+                ax3.set_ylim(ratio.min(),2.5)
+                ax4.set_ylim(ratio.min(),2.5)
+            ax.plot(dec_long,np.ones(len(dec_long))*zero_curvefit(dec_long, *poptzero), 'saddlebrown', linewidth = 3, label="zeroth order fit")
+            ax1.plot(dec_long,lin_curvefit(dec_long, *poptlin), 'darkblue', linewidth = 3, label="linear fit")
+            ax2.plot(dec_long,quad_curvefit(dec_long, *poptquad), 'darkgreen', linewidth = 3, label="Quadratic fit")
+            ax3.plot(dec_long,cubic_curvefit(dec_long, *poptcubic), 'darkred', linewidth = 3, label="Cubic fit")
+            ax4.plot(dec_long,quart_curvefit(dec_long, *poptquart), 'darkmagenta', linewidth = 3, label="Quartic fit")
+            # ax2.plot(dec_long,np.exp(quad_curvefit(dec_long, *log_poptquad)), 'darkgreen', linestyle = '--', linewidth = 3, label="Quadratic fit")
+            # ax3.plot(dec_long,np.exp(cubic_curvefit(dec_long, *log_poptcubic)), 'darkred', linestyle = '--', linewidth = 3, label="Cubic fit")
+            ax.legend(loc='upper right', fontsize=10) # make a legend in the best location
+            ax1.legend(loc='upper right', fontsize=10) # make a legend in the best location
+            ax2.legend(loc='upper right', fontsize=10) # make a legend in the best location
+            ax3.legend(loc='upper right', fontsize=10) # make a legend in the best location
+            ax4.legend(loc='upper right', fontsize=10) # make a legend in the best location
+            ax.tick_params(axis='y', labelsize=15)
+            ax.tick_params(axis='x', labelsize=10)
+            ax1.tick_params(axis='y', labelsize=15)
+            ax1.tick_params(axis='x', labelsize=10)
+            ax2.tick_params(axis='y', labelsize=15)
+            ax2.tick_params(axis='x', labelsize=10)
+            ax3.tick_params(axis='y', labelsize=15)
+            ax3.tick_params(axis='x', labelsize=10)
+            ax4.tick_params(axis='y', labelsize=15)
+            ax4.tick_params(axis='x', labelsize=10)
+            ax.set_xlabel('Dec. (degrees)', fontsize = 10)
+            ax1.set_xlabel('Dec. (degrees)', fontsize = 10)
+            ax2.set_xlabel('Dec. (degrees)', fontsize = 10)
+            ax3.set_xlabel('Dec. (degrees)', fontsize = 10)
+            ax4.set_xlabel('Dec. (degrees)', fontsize = 10)
+            ax.set_ylabel('Ratio', fontsize = 15)
+            cb = plt.colorbar(ax3.scatter(dec, ratio, marker='o',color ='k',c=SNR, cmap=plt.cm.Greys))
+            cb.set_label('1/log(ratio_err)',fontsize = 15)
+            plt.savefig(input_mosaic+'_polyfits_int.png')
+            plt.close()
+
+    fit_name = ['zeroth','linear','quadratic','quadratic_zenith','cubic','quartic'] 
 
-if options.make_plots:
+    print "#----------------------------------------------------------#"
+    print 'Saving correction to '+input_mosaic+'_poly_coefficients.fits'
+
+    col1 = fits.Column(name='fit', format = '16A', array = fit_name)
+    col2 = fits.Column(name='a', format = 'E', array = a_fit)
+    col3 = fits.Column(name='b', format = 'E', array = b_fit)
+    col4 = fits.Column(name='c', format = 'E', array = c_fit)
+    col5 = fits.Column(name='d', format = 'E', array = d_fit)
+    col6 = fits.Column(name='e', format = 'E', array = e_fit)
+    col7 = fits.Column(name='red_chi_sq', format = 'E', array = redchisq_decfits)
+    # Bootstrap errors of the coefficients; zero for the zenith quadratic
+    col8 = fits.Column(name='a_err', format = 'E', array = a_err)
+    col9 = fits.Column(name='b_err', format = 'E', array = b_err)
+    col10 = fits.Column(name='c_err', format = 'E', array = c_err)
+    col11 = fits.Column(name='d_err', format = 'E', array = d_err)
+    col12 = fits.Column(name='e_err', format = 'E', array = e_err)
+    cols = fits.ColDefs([col1, col2, col3, col4, col5,col6,col7,col8,col9,col10,col11,col12])
+    tbhdu = fits.new_table(cols)    
+    tbhdu.writeto(input_mosaic+'_poly_coefficients.fits', clobber = True) 
+
+def process_mosaic(input_mosaic, options, limits=None, cores=1, reference=None):
+    '''
+    Derive the Dec-dependent flux scale correction of one mosaic, reusing its
+    _fluxdentable_decut.fits if it exists. limits: polyderivation_limits(), and reference:
+    reference_catalogue(), each loaded here if needed and not given. Returns the _poly_coefficients.fits filename, or None for the mosaics which
+    use the corrections from another mosaic.
+    '''
+    freq_obs, subband, Dec_strip = mosaic_frequency(input_mosaic)
+
+    # Checking if file with ratios already exists. If they do, skip to straight fitting.
+    if not os.path.exists(input_mosaic+'_fluxdentable_decut.fits'):
+        if not own_corrections(input_mosaic, Dec_strip):
+            print "Will automatically use corrections from another mosaic."
+            return None
+        if limits is None:
+            limits = polyderivation_limits()
+        derive_ratios(input_mosaic, options, freq_obs, strip_limits(Dec_strip, subband, limits), cores=cores, reference=reference)
+
+    if options.make_plots:
+        fit_polynomials(input_mosaic, options, freq_obs, strip_limits(Dec_strip, subband, limits))
+    else:
+        fit_polynomials(input_mosaic, options, freq_obs)
+    return input_mosaic+'_poly_coefficients.fits'
 
-    # Reading in dec limits for plotting again in case the file does exist
-    header = fits.getheader(input_mosaic+'.fits')
-    try:
-        freq_obs = header['CRVAL3']/1e6
-    except:
-        freq_obs = header['FREQ']/1e6
-    if 72. < freq_obs < 103.:
-        subband = 1
-    elif 103.01 < freq_obs < 134.:
-        subband = 2
-    elif 139. < freq_obs < 170.:
-        subband = 3
-    elif 170.01 < freq_obs < 200.:
-        subband = 4
-    elif 200.01 < freq_obs < 231.:
-        subband = 5
-    Dec_strip = header['CRVAL2']
+if __name__ == '__main__':
 
-    cutdir=os.environ['MWA_CODE_BASE']
+    print "#----------------------------------------------------------#"
+    print '''Fixing declination dependent flux scale in GLEAM mosaic. Ensure you have votables from Aegean. 
+You need to already run the source finder Aegean on the mosiac and have *_comp.vot and *_isle.vot 
+in your working directory. You get the *_isle.vot table from using the --island option in Aegean.
+Also ensure that the file marco_all_VLSSsrcs.fits is in $MWA_CODE_BASE. You also need the
+python package emcee for --error_method=emcee.'''
 
-    centre_dec, freq_band, RA_lim1, RA_lim2, Dec_lim1, Dec_lim2 = np.loadtxt(cutdir+'/ra_dec_limits_polyderivation.dat',skiprows=2,unpack=True) 
-    dec_freq_comb = [centre_dec, freq_band]
-    cut_ind = np.where((centre_dec == Dec_strip) & (freq_band == subband))
-    RA_lim1 = RA_lim1[cut_ind]
-    RA_lim2 = RA_lim2[cut_ind]
-    Dec_lim1 = Dec_lim1[cut_ind]
-    Dec_lim2 = Dec_lim2[cut_ind]
-
-    if options.zenith:
-
-        p_guess_quad_zenith = [ 1.5, -1]
-        poptquad_zenith, pcovquad_zenith = opt.curve_fit(quad_curvefit_zenith, dec, ratio, p0 = p_guess_quad_zenith, sigma = ratio_err, maxfev = 10000)
-        redchisq_decfits[3] = redchisq(ratio,quad_curvefit_zenith(dec,*poptquad_zenith),ratio_err,2)[0]
-        a_fit[3], c_fit[3] = poptquad_zenith[0], poptquad_zenith[1]
-
-        plt.rcParams['figure.figsize'] = 20, 5 # Setting figure size. Have to close window for it to have effect.
-        gs = plt.GridSpec(1,6)
-        ax = plt.subplot(gs[0])
-        ax1 = plt.subplot(gs[1])
-        ax2 = plt.subplot(gs[2])
-        ax3 = plt.subplot(gs[3])
-        ax4 = plt.subplot(gs[4])
-        ax5 = plt.subplot(gs[5])
-        # ax.scatter(dec, ratio, marker='+',color = 'k',c=SNR, cmap=plt.cm.Greys)#, c=SNR, cmap=plt.cm.Greys)
-        # ax1.scatter(dec, ratio, marker='+',color ='k',c=SNR, cmap=plt.cm.Greys)#, c=SNR, cmap=plt.cm.Greys)
-        # ax2.scatter(dec, ratio, marker='+',color ='k',c=SNR, cmap=plt.cm.Greys)#, c=SNR, cmap=plt.cm.Greys)
-        # ax3.scatter(dec, ratio, marker='+',color ='k',c=SNR, cmap=plt.cm.Greys)
-        # ax4.scatter(dec, ratio, marker='+',color ='k',c=SNR, cmap=plt.cm.Greys)
-        # ax5.scatter(dec, ratio, marker='+',color ='k',c=SNR, cmap=plt.cm.Greys)
-        ax.scatter(dec, ratio, marker='o',color = 'k',c=SNR, cmap=plt.cm.Greys)#, c=SNR, cmap=plt.cm.Greys)
-        ax1.scatter(dec, ratio, marker='o',color ='k',c=SNR, cmap=plt.cm.Greys)#, c=SNR, cmap=plt.cm.Greys)
-        ax2.scatter(dec, ratio, marker='o',color ='k',c=SNR, cmap=plt.cm.Greys)#, c=SNR, cmap=plt.cm.Greys)
-        ax3.scatter(dec, ratio, marker='o',color ='k',c=SNR, cmap=plt.cm.Greys)
-        ax4.scatter(dec, ratio, marker='o',color ='k',c=SNR, cmap=plt.cm.Greys)
-        ax5.scatter(dec, ratio, marker='o',color ='k',c=SNR, cmap=plt.cm.Greys)
-        dec_long = np.arange(Dec_lim1,Dec_lim2,0.1)
-        dec_long = np.array(dec_long)
-        ax.plot(dec_long,np.ones(len(dec_long))*zero_curvefit(dec_long, *poptzero), 'saddlebrown', linewidth = 3, label="zeroth order fit")
-        ax1.plot(dec_long,lin_curvefit(dec_long, *poptlin), 'darkblue', linewidth = 3, label="linear fit")
-        ax2.plot(dec_long,quad_curvefit_zenith(dec_long, *poptquad_zenith), 'darkorange', linewidth = 3, label="Quadratic forced TP fit")
-        ax3.plot(dec_long,quad_curvefit(dec_long, *poptquad), 'darkgreen', linewidth = 3, label="Quadratic fit")
-        ax4.plot(dec_long,cubic_curvefit(dec_long, *poptcubic), 'darkred', linewidth = 3, label="Cubic fit")
-        ax5.plot(dec_long,quart_curvefit(dec_long, *poptquart), 'darkmagenta', linewidth = 3, label="Quartic fit")
-        ax.legend(loc='upper right', fontsize=10) # make a legend in the best location
-        ax1.legend(loc='upper right', fontsize=10) # make a legend in the best location
-        ax2.legend(loc='upper right', fontsize=10) # make a legend in the best location
-        ax3.legend(loc='upper right', fontsize=10) # make a legend in the best location
-        ax4.legend(loc='upper right', fontsize=10) # make a legend in the best location
-        ax5.legend(loc='upper right', fontsize=10) # make a legend in the best location
-        ax.tick_params(axis='y', labelsize=15)
-        ax.tick_params(axis='x', labelsize=10)
-        ax1.tick_params(axis='y', labelsize=15)
-        ax1.tick_params(axis='x', labelsize=10)
-        ax2.tick_params(axis='y', labelsize=15)
-        ax2.tick_params(axis='x', labelsize=10)
-        ax3.tick_params(axis='y', labelsize=15)
-        ax3.tick_params(axis='x', labelsize=10)
-        ax4.tick_params(axis='y', labelsize=15)
-        ax4.tick_params(axis='x', labelsize=10)
-        ax5.tick_params(axis='y', labelsize=15)
-        ax5.tick_params(axis='x', labelsize=10)
-        ax.set_xlabel('Dec. (degrees)', fontsize = 10)
-        ax1.set_xlabel('Dec. (degrees)', fontsize = 10)
-        ax2.set_xlabel('Dec. (degrees)', fontsize = 10)
-        ax3.set_xlabel('Dec. (degrees)', fontsize = 10)
-        ax4.set_xlabel('Dec. (degrees)', fontsize = 10)
-        ax5.set_xlabel('Dec. (degrees)', fontsize = 10)
-        ax.set_ylabel('Ratio', fontsize = 15)
-        plt.savefig(input_mosaic+'_polyfits_int.png')
+    parser = option_parser()
+    (options, args) = parser.parse_args()
+    if options.mcmc_steps < 1:
+        parser.error("--mcmc_steps must be at least 1")
 
+    if options.cores is None:
+        cores = multiprocessing.cpu_count()
     else:
+        cores = options.cores
 
-        plt.rcParams['figure.figsize'] = 20, 5 # Setting figure size. Have to close window for it to have effect.
-        gs = plt.GridSpec(1,5)
-        ax = plt.subplot(gs[0])
-        ax1 = plt.subplot(gs[1])
-        ax2 = plt.subplot(gs[2])
-        ax3 = plt.subplot(gs[3])
-        ax4 = plt.subplot(gs[4])
-        # ax.errorbar(dec, ratio, ratio_err, marker='.',linestyle='none', color = 'k',alpha=0.5)#, c=SNR, cmap=plt.cm.Greys)
-        # ax1.errorbar(dec, ratio,ratio_err, marker='.',linestyle='none', color ='k',alpha=0.5)#, c=SNR, cmap=plt.cm.Greys)
-        # ax2.errorbar(dec, ratio,ratio_err, marker='.',linestyle='none',color ='k',alpha=0.5)#, c=SNR, cmap=plt.cm.Greys)
-        # ax3.errorbar(dec, ratio, ratio_err,marker='.',linestyle='none',color ='k',alpha=0.5)
-        # ax4.errorbar(dec, ratio, ratio_err,marker='.',linestyle='none',color ='k',alpha=0.5)
-        ax.scatter(dec, ratio, marker='o',color = 'k',c=SNR, cmap=plt.cm.Greys)#, c=SNR, cmap=plt.cm.Greys)
-        ax1.scatter(dec, ratio, marker='o',color ='k',c=SNR, cmap=plt.cm.Greys)#, c=SNR, cmap=plt.cm.Greys)
-        ax2.scatter(dec, ratio, marker='o',color ='k',c=SNR, cmap=plt.cm.Greys)#, c=SNR, cmap=plt.cm.Greys)
-        ax3.scatter(dec, ratio, marker='o',color ='k',c=SNR, cmap=plt.cm.Greys)
-        ax4.scatter(dec, ratio, marker='o',color ='k',c=SNR, cmap=plt.cm.Greys)
-        dec_long = np.arange(Dec_lim1,Dec_lim2,0.1)
-        dec_long = np.array(dec_long)
-        if ratio.max() > 4.0:
-            ax.set_ylim(ratio.min(),2.5)
-            ax1.set_ylim(ratio.min(),2.5)
-            ax2.set_ylim(ratio.min(),2.5)
-            ax3.set_ylim(ratio.min(),2.5)
-            ax4.set_ylim(ratio.min(),2.5)
-        ax.plot(dec_long,np.ones(len(dec_long))*zero_curvefit(dec_long, *poptzero), 'saddlebrown', linewidth = 3, label="zeroth order fit")
-        ax1.plot(dec_long,lin_curvefit(dec_long, *poptlin), 'darkblue', linewidth = 3, label="linear fit")
-        ax2.plot(dec_long,quad_curvefit(dec_long, *poptquad), 'darkgreen', linewidth = 3, label="Quadratic fit")
-        ax3.plot(dec_long,cubic_curvefit(dec_long, *poptcubic), 'darkred', linewidth = 3, label="Cubic fit")
-        ax4.plot(dec_long,quart_curvefit(dec_long, *poptquart), 'darkmagenta', linewidth = 3, label="Quartic fit")
-        # ax2.plot(dec_long,np.exp(quad_curvefit(dec_long, *log_poptquad)), 'darkgreen', linestyle = '--', linewidth = 3, label="Quadratic fit")
-        # ax3.plot(dec_long,np.exp(cubic_curvefit(dec_long, *log_poptcubic)), 'darkred', linestyle = '--', linewidth = 3, label="Cubic fit")
-        ax.legend(loc='upper right', fontsize=10) # make a legend in the best location
-        ax1.legend(loc='upper right', fontsize=10) # make a legend in the best location
-        ax2.legend(loc='upper right', fontsize=10) # make a legend in the best location
-        ax3.legend(loc='upper right', fontsize=10) # make a legend in the best location
-        ax4.legend(loc='upper right', fontsize=10) # make a legend in the best location
-        ax.tick_params(axis='y', labelsize=15)
-        ax.tick_params(axis='x', labelsize=10)
-        ax1.tick_params(axis='y', labelsize=15)
-        ax1.tick_params(axis='x', labelsize=10)
-        ax2.tick_params(axis='y', labelsize=15)
-        ax2.tick_params(axis='x', labelsize=10)
-        ax3.tick_params(axis='y', labelsize=15)
-        ax3.tick_params(axis='x', labelsize=10)
-        ax4.tick_params(axis='y', labelsize=15)
-        ax4.tick_params(axis='x', labelsize=10)
-        ax.set_xlabel('Dec. (degrees)', fontsize = 10)
-        ax1.set_xlabel('Dec. (degrees)', fontsize = 10)
-        ax2.set_xlabel('Dec. (degrees)', fontsize = 10)
-        ax3.set_xlabel('Dec. (degrees)', fontsize = 10)
-        ax4.set_xlabel('Dec. (degrees)', fontsize = 10)
-        ax.set_ylabel('Ratio', fontsize = 15)
-        cb = plt.colorbar(ax3.scatter(dec, ratio, marker='o',color ='k',c=SNR, cmap=plt.cm.Greys))
-        cb.set_label('1/log(ratio_err)',fontsize = 15)
-        plt.savefig(input_mosaic+'_polyfits_int.png')
-
-fit_name = ['zeroth','linear','quadratic','quadratic_zenith','cubic','quartic'] 
-
-print "#----------------------------------------------------------#"
-print 'Saving correction to '+input_mosaic+'_poly_coefficients.fits'
-
-col1 = fits.Column(name='fit', format = '16A', array = fit_name)
-col2 = fits.Column(name='a', format = 'E', array = a_fit)
-col3 = fits.Column(name='b', format = 'E', array = b_fit)
-col4 = fits.Column(name='c', format = 'E', array = c_fit)
-col5 = fits.Column(name='d', format = 'E', array = d_fit)
-col6 = fits.Column(name='e', format = 'E', array = e_fit)
-col7 = fits.Column(name='red_chi_sq', format = 'E', array = redchisq_decfits)
-cols = fits.ColDefs([col1, col2, col3, col4, col5,col6,col7])
-tbhdu = fits.new_table(cols)    
-tbhdu.writeto(input_mosaic+'_poly_coefficients.fits', clobber = True) 
+    process_mosaic(options.mosaic, options, cores=cores)
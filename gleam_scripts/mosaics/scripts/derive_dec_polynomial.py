@@ -13,6 +13,7 @@ from optparse import OptionParser
 from scipy.optimize import curve_fit
 import os
 import sys
+import dec_polyfit
 
 print "#----------------------------------------------------------#"
 print '''Fixing declination dependent flux scale in GLEAM mosaic. Ensure you have votables from Aegean. 
@@ -193,7 +194,7 @@ except IndexError:
 ## NB: 4th power has to go at the end so as not to break everything else
 #    polycoeffs=[l,m,n,p,k]
 #else:
-polycoeffs=np.polyfit(x,y,3,w=w)
+polycoeffs=dec_polyfit.polyfit(x,y,3,w=w)
 print polycoeffs
 
 if options.write_coefficients:
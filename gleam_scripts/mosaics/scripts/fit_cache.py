@@ -0,0 +1,131 @@
+"""
+Persistent cache of per-source fit results
+
+Fit results are stored in an sqlite file, keyed by the SHA1 of everything the
+fit depends on: the source's photometry vector, the frequency grid and the
+fit options. A rerun after changing a selection cut, or with one new mosaic
+added, only fits the sources it has not seen before with the same inputs.
+The cache holds at most max_entries results; the least recently used ones
+are evicted first.
+
+Usage example
+====
+import fit_cache
+cache = fit_cache.FitCache('sed_fits.sqlite', max_entries=100000)
+keys = cache.keys([flux, flux_err], common=[freq, freq_obs, 'mcmc', 500])
+pred_err, alpha = cache.cached(keys, lambda index: compute(flux[:,index], flux_err[:,index]))
+print(cache.report())
+cache.close()
+====
+"""
+import hashlib
+import sqlite3
+import time
+
+import numpy as np
+
+def _update(h, item):
+    '''Feed one key item (array, string or number) to the hash h.'''
+    if isinstance(item, np.ndarray):
+        h.update(str(item.dtype).encode())
+        h.update(str(item.shape).encode())
+        h.update(np.ascontiguousarray(item).tobytes())
+    else:
+        h.update(repr(item).encode())
+    h.update(b'|')
+
+class FitCache(object):
+    '''
+    Least-recently-used store of fit results, one row of floats per key.
+    '''
+    def __init__(self, filename, max_entries=100000, namespace=''):
+        self.filename = filename
+        self.max_entries = max_entries
+        self.namespace = namespace
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.db = sqlite3.connect(filename, timeout=60.)
+        self.db.execute('CREATE TABLE IF NOT EXISTS fits (key TEXT PRIMARY KEY, value BLOB, used REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS fits_used ON fits (used)')
+        self.db.commit()
+
+    def keys(self, per_source, common=()):
+        '''
+        One key per source. per_source: arrays whose last axis runs over the sources, e.g. the
+        (n_freq, n_src) flux, error and mask stacks, or the (n_src,) seeds. common: the frequency
+        grid, fit options and anything else shared by all the sources.
+        '''
+        prefix = hashlib.sha1()
+        _update(prefix, self.namespace)
+        for item in common:
+            _update(prefix, np.asarray(item) if isinstance(item, (list, tuple)) else item)
+        per_source = [np.asarray(item) for item in per_source]
+        nsrc = per_source[0].shape[-1]
+        keys = []
+        for i in range(nsrc):
+            h = prefix.copy()
+            for item in per_source:
+                _update(h, item[..., i])
+            keys.append(h.hexdigest())
+        return keys
+
+    def get(self, keys):
+        '''Cached values for keys, as a dictionary of float arrays; records hits and misses.'''
+        found = {}
+        keys = list(keys)
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start+500]
+            rows = self.db.execute('SELECT key, value FROM fits WHERE key IN (%s)' % ','.join('?'*len(chunk)), chunk).fetchall()
+            for key, value in rows:
+                found[str(key)] = np.frombuffer(bytes(value), dtype=float)
+        now = time.time()
+        self.db.executemany('UPDATE fits SET used = ? WHERE key = ?', [(now, key) for key in found])
+        self.db.commit()
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put(self, keys, values):
+        '''Store one row of values per key, then evict the least recently used beyond max_entries.'''
+        now = time.time()
+        self.db.executemany('INSERT OR REPLACE INTO fits (key, value, used) VALUES (?, ?, ?)',
+            [(key, sqlite3.Binary(np.asarray(value, dtype=float).tobytes()), now) for key, value in zip(keys, values)])
+        excess = self.db.execute('SELECT COUNT(*) FROM fits').fetchone()[0] - self.max_entries
+        if excess > 0:
+            self.db.execute('DELETE FROM fits WHERE key IN (SELECT key FROM fits ORDER BY used ASC LIMIT ?)', (excess,))
+            self.evictions += excess
+        self.db.commit()
+
+    def cached(self, keys, compute):
+        '''
+        Look up every key and call compute(index) only for the sources which missed, where index
+        is an array into keys. compute returns a tuple of (len(index),) arrays. Returns the same
+        tuple of arrays for all the keys.
+        '''
+        found = self.get(keys)
+        missing = np.array([i for i, key in enumerate(keys) if key not in found], dtype=int)
+        computed = None
+        if len(missing) > 0:
+            computed = [np.asarray(x) for x in compute(missing)]
+            self.put([keys[i] for i in missing], np.column_stack(computed))
+        elif len(keys) == 0:
+            computed = [np.asarray(x) for x in compute(missing)]
+        nout = len(computed) if computed is not None else len(next(iter(found.values())))
+        out = [np.zeros(len(keys)) for dummy in range(nout)]
+        for i, key in enumerate(keys):
+            if key in found:
+                for k in range(nout):
+                    out[k][i] = found[key][k]
+        if len(missing) > 0:
+            for k in range(nout):
+                out[k][missing] = computed[k]
+        return tuple(out)
+
+    def report(self):
+        '''Hit, miss and eviction counts of this run and the number of entries stored.'''
+        entries = self.db.execute('SELECT COUNT(*) FROM fits').fetchone()[0]
+        return 'Fit cache %s: %d hits, %d misses, %d evicted, %d entries' % (self.filename, self.hits, self.misses, self.evictions, entries)
+
+    def close(self):
+        self.db.close()
@@ -8,12 +8,16 @@ import glob
 
 import astropy.io.fits as fits
 from astropy import wcs
+import sky_coords
+import image_tiles
 
 #tables and votables
 from astropy.io.votable import parse_single_table
 
 from optparse import OptionParser
 
+import dec_polyfit
+
 usage="Usage: %prog [options] <file>\n"
 parser = OptionParser(usage=usage)
 parser.add_option('--plot',action="store_true",dest="make_plots",default=False,
@@ -24,6 +28,14 @@ parser.add_option('--order',dest="poly_order",default=5,type=int,
                   help="Set the order of the polynomial fit. (default = 5)")
 parser.add_option('--write',action="store_true",dest="write_coefficients",default=False,
                     help="Write coefficients to file? (default = False)")
+parser.add_option('--coord_cache',type="string", dest="coord_cache", default=None,
+                    help="Directory in which to cache the RA/Dec maps of each projection, so that mosaics sharing it reuse them (default = no cache)")
+parser.add_option('--coord_cache_size',dest="coord_cache_size", default=20.,type=float,
+                    help="Maximum size of the coordinate cache in GB; the least recently used maps are deleted (default = 20)")
+parser.add_option('--tile_rows','--tile-rows',dest="tile_rows",default=256,type=int,
+                    help="Number of rows corrected at a time with --rescale (default = 256)")
+parser.add_option('--threads',dest="threads",default=1,type=int,
+                    help="Number of tiles of rows to correct at once with --rescale, on separate threads (default = 1)")
 (options, args) = parser.parse_args()
 
 tables = sorted(glob.glob('*_XY*_comp.vot'))
@@ -70,13 +82,13 @@ for tablefile in tables:
 
     N=len(data['dec_X'])
 
-    P,res,rank,sv,cond = np.ma.polyfit(np.ma.array(x),np.ma.array(y),options.poly_order,full=True,w=w)
+    P = dec_polyfit.polyfit(np.ma.array(x),np.ma.array(y),options.poly_order,w=w)
     fitmodel = np.poly1d(P)
 # Remove outliers
     modsub = np.abs(y - fitmodel(x))
     indices = np.where(modsub<0.2)
 
-    P,res,rank,sv,cond = np.ma.polyfit(np.ma.array(x[indices]),np.ma.array(y[indices]),options.poly_order,full=True,w=w[indices])
+    P = dec_polyfit.polyfit(np.ma.array(x[indices]),np.ma.array(y[indices]),options.poly_order,w=w[indices])
     fitmodel = np.poly1d(P)
 
 
@@ -133,24 +145,19 @@ for tablefile in tables:
     # wcs in format [x,y,stokes,freq]; stokes and freq are length 1 if they exist
         w=wcs.WCS(hdu_in[0].header)
 
-        #create an array but don't set the values (they are random)
-        indexes = np.empty( (hdu_in[0].data.shape[0]*hdu_in[0].data.shape[1],2),dtype=int)
-        #since I know exactly what the index array needs to look like I can construct
-        # it faster than list comprehension would allow
-        #we do this only once and then recycle it
-        idx = np.array([ (j,0) for j in xrange(hdu_in[0].data.shape[1])])
-        j=hdu_in[0].data.shape[1]
-        for i in xrange(hdu_in[0].data.shape[0]):
-            idx[:,1]=i
-            indexes[i*j:(i+1)*j] = idx
-    #put ALL the pixles into our vectorized functions and minimised our overheads
-        ra,dec = w.wcs_pix2world(indexes,1).transpose()
-        XXcorr=np.zeros(dec.shape)
-        for i in range(0,options.poly_order+1):
-            XXcorr+=P[i]*pow(dec,options.poly_order-i)
-#        XXcorr=(P[0]*pow(dec,3)+P[1]*pow(dec,2)+P[2]*(dec)+P[3])
-        reshapedXXcorr=XXcorr.reshape(hdu_in[0].data.shape[0],hdu_in[0].data.shape[1])
-        hdu_in[0].data=np.array(reshapedXXcorr*hdu_in[0].data,dtype=np.float32)
+        # RA and Dec of every pixel, from the cache or generated a block of rows at a time
+        if options.coord_cache:
+            coords = sky_coords.sky_coords(w,hdu_in[0].data.shape,cache_dir=options.coord_cache,cache_size=options.coord_cache_size*1e9)
+        else:
+            coords = None
+        def XXcorr(rows,ra,dec):
+            corr=np.zeros(dec.shape)
+            for i in range(0,options.poly_order+1):
+                corr+=P[i]*pow(dec,options.poly_order-i)
+#            corr=(P[0]*pow(dec,3)+P[1]*pow(dec,2)+P[2]*(dec)+P[3])
+            return corr
+        data=hdu_in[0].data
+        hdu_in[0].data=image_tiles.correct_image(data,w,XXcorr,out=np.empty(data.shape,dtype=np.float32),tile_rows=options.tile_rows,threads=options.threads,coords=coords)
         hdu_in.writeto(newXfits)
         hdu_in.close()
 
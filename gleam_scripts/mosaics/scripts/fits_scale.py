@@ -0,0 +1,83 @@
+"""
+Rescale a FITS image by a scalar without rewriting its pixels
+
+A uniform flux correction (rescale_flux.py, rescale_zerofits.py, the MRC ratio
+of correct_mrc.py) used to multiply every pixel and write the whole file out
+again. FITS already has a keyword for this: the physical value of a pixel is
+BZERO + BSCALE*stored value, for floating-point images too. rescale_file()
+multiplies BSCALE (and BZERO) by the factor and writes the new header over the
+old one in place, so only the header blocks are touched. Only if the new header
+no longer fits in the blocks of the old one is the file rewritten, by astropy.
+
+astropy applies BSCALE and BZERO whenever it reads the data, so the scripts in
+this project, ds9 and Aegean all see the rescaled fluxes; the tiled readers in
+image_tiles.py read the stored values and apply scaling() a tile at a time.
+Writing the data out again with astropy applies the scale and drops the
+keywords.
+
+Usage example
+====
+import fits_scale
+fits_scale.rescale_file('mosaic.fits', 1.05, history='rescale_flux.py: multiplied by 1.05')
+bscale, bzero = fits_scale.scaling(header)
+====
+"""
+from astropy.io import fits
+
+def scaling(header):
+    '''(BSCALE, BZERO) of a header, i.e. physical = BZERO + BSCALE*stored.'''
+    return float(header.get('BSCALE', 1.)), float(header.get('BZERO', 0.))
+
+def rescale_header(header, factor, comment=None):
+    '''Multiply the physical values described by header by factor, via BSCALE and BZERO.'''
+    bscale, bzero = scaling(header)
+    header['BSCALE'] = (bscale*factor, comment) if comment else bscale*factor
+    if bzero != 0.:
+        header['BZERO'] = bzero*factor
+    return header
+
+def rescale_file(filename, factor, history=None, comment=None, updates=None, remove=()):
+    '''
+    Multiply the primary image of filename by factor by rewriting its header in place.
+
+    history: HISTORY card to add. comment: comment of the BSCALE card. updates: dict of other
+    keywords to set, e.g. corrected CRVALs; remove: keywords to delete, if present. Returns True
+    if only the header blocks were rewritten, False if the whole file had to be.
+    '''
+    hdu_in = fits.open(filename, do_not_scale_image_data=True)
+    try:
+        header = hdu_in[0].header.copy()
+        data_offset = hdu_in.fileinfo(0)['datLoc']
+    finally:
+        hdu_in.close()
+
+    rescale_header(header, factor, comment)
+    if updates:
+        for key in updates:
+            header[key] = updates[key]
+    for key in remove:
+        if key in header:
+            del header[key]
+    if history:
+        header.add_history(history)
+
+    header_bytes = header.tostring()
+    # Blank cards fill any blocks freed up, so the data section does not move
+    while len(header_bytes) < data_offset:
+        header.add_blank(bottom=True)
+        header_bytes = header.tostring()
+    if not isinstance(header_bytes, bytes):
+        header_bytes = header_bytes.encode('ascii')
+
+    if len(header_bytes) == data_offset:
+        with open(filename, 'r+b') as f:
+            f.write(header_bytes)
+        return True
+
+    hdu_in = fits.open(filename, mode='update', do_not_scale_image_data=True)
+    try:
+        hdu_in[0].header = header
+        hdu_in.flush()
+    finally:
+        hdu_in.close()
+    return False
@@ -9,6 +9,8 @@ import scipy.optimize as opt
 import scipy.stats as stats
 from astropy.io import fits
 from astropy import wcs
+import sky_coords
+import image_tiles
 from optparse import OptionParser
 import os
 import sys
@@ -20,6 +22,16 @@ parser.add_option('--mosaic',type="string", dest="mosaic",
                     help="The filename of the mosaic you want to read in.")
 #parser.add_option('--zenith',action="store_true",dest="zenith",default=False,
 #                    help="Calculate correction for the special case of zenith.")
+parser.add_option('--coord_cache',type="string", dest="coord_cache", default=None,
+                    help="Directory in which to cache the RA/Dec maps of each projection, so that mosaics sharing it reuse them (default = no cache)")
+parser.add_option('--coord_cache_size',dest="coord_cache_size", default=20.,type=float,
+                    help="Maximum size of the coordinate cache in GB; the least recently used maps are deleted (default = 20)")
+parser.add_option('--stream',action="store_true",dest="stream",default=False,
+                    help="Memory-map the mosaic and write the corrected mosaic a block of rows at a time, for mosaics too large to correct in memory (default = False)")
+parser.add_option('--tile_rows','--tile-rows',dest="tile_rows",default=256,type=int,
+                    help="Number of rows corrected at a time (default = 256)")
+parser.add_option('--threads',dest="threads",default=1,type=int,
+                    help="Number of tiles of rows to correct at once, on separate threads (default = 1)")
 (options, args) = parser.parse_args()
 
 input_mosaic = options.mosaic
@@ -93,6 +105,35 @@ c  = np.array(tbdata['c'])
 d  = np.array(tbdata['d'])
 e  = np.array(tbdata['d'])
 
+# Correction as a function of the RA and Dec of each pixel
+if Dec_strip == -26.7 or Dec_strip == -27.0 or Dec_strip == -26.0:
+   # Dealing with special case of zenith -- quadratic fit pinned at zenith
+    print "Applying zenith correction to Dec"+str(Dec_strip)
+    def correction(ra,dec):
+        return (c[3]*(np.power(dec,2)+53.4*dec)+a[3])
+elif Dec_strip == -40. or Dec_strip == -55. or Dec_strip == -72.:
+    print "Applying mirror correction to Dec"+str(Dec_strip)
+    # Reflecting cubic around the x-axis and shifting to new centre dec
+    def correction(ra,dec):
+        return (-d[4]*np.power((dec-(2*dec_zenith)),3)+c[4]*np.power((dec-(2*dec_zenith)),2)-b[4]*((dec-(2*dec_zenith)))+a[4])
+else:
+    print "Applying normal correction to Dec"+str(Dec_strip)
+    def correction(ra,dec):
+        return (d[4]*np.power(dec,3)+c[4]*np.power(dec,2)+b[4]*(dec)+a[4])
+
+if options.stream:
+    # Same header fix, but only in the header written with the corrected data
+    header = fits.getheader(input_mosaic+'.fits')
+    if modheader:
+        for key in ['CRPIX3','CRVAL3','CDELT3','CUNIT3','CTYPE3']:
+            del header[key]
+    if options.coord_cache:
+        coords = sky_coords.sky_coords(wcs.WCS(header),(header['NAXIS2'],header['NAXIS1']),cache_dir=options.coord_cache,cache_size=options.coord_cache_size*1e9)
+    else:
+        coords = None
+    image_tiles.apply_correction(input_mosaic+'.fits',input_mosaic+'_polyapplied.fits',correction,header=header,tile_rows=options.tile_rows,coords=coords,threads=options.threads)
+    sys.exit(0)
+
 # Fixing header problem. Removing third axis.
 if modheader:
     outfile = input_mosaic+"_fixedheader.fits"
@@ -111,31 +152,12 @@ else:
     # wcs in format [x,y,stokes,freq]; stokes and freq are length 1 if they exist
 w=wcs.WCS(hdu_in[0].header)
 
-#create an array but don't set the values (they are random)
-indexes = np.empty( (hdu_in[0].data.shape[0]*hdu_in[0].data.shape[1],2),dtype=int)
-#since I know exactly what the index array needs to look like I can construct
-# it faster than list comprehension would allow
-#we do this only once and then recycle it
-idx = np.array([ (j,0) for j in xrange(hdu_in[0].data.shape[1])])
-j=hdu_in[0].data.shape[1]
-for i in xrange(hdu_in[0].data.shape[0]):
-    idx[:,1]=i
-    indexes[i*j:(i+1)*j] = idx
-#put ALL the pixles into our vectorized functions and minimised our overheads
-ra,dec = w.wcs_pix2world(indexes,1).transpose()
-if Dec_strip == -26.7 or Dec_strip == -27.0 or Dec_strip == -26.0:
-   # Dealing with special case of zenith -- quadratic fit pinned at zenith
-    print "Applying zenith correction to Dec"+str(Dec_strip)
-    corr=(c[3]*(np.power(dec,2)+53.4*dec)+a[3])
-elif Dec_strip == -40. or Dec_strip == -55. or Dec_strip == -72.:
-    print "Applying mirror correction to Dec"+str(Dec_strip)
-    # Reflecting cubic around the x-axis and shifting to new centre dec
-    corr=(-d[4]*np.power((dec-(2*dec_zenith)),3)+c[4]*np.power((dec-(2*dec_zenith)),2)-b[4]*((dec-(2*dec_zenith)))+a[4])
+# RA and Dec of every pixel, from the cache or generated a block of rows at a time
+if options.coord_cache:
+    coords = sky_coords.sky_coords(w,hdu_in[0].data.shape,cache_dir=options.coord_cache,cache_size=options.coord_cache_size*1e9)
 else:
-    print "Applying normal correction to Dec"+str(Dec_strip)
-    corr=(d[4]*np.power(dec,3)+c[4]*np.power(dec,2)+b[4]*(dec)+a[4])
-
-reshapedcorr=corr.reshape(hdu_in[0].data.shape[0],hdu_in[0].data.shape[1])
-hdu_in[0].data=np.array(reshapedcorr*hdu_in[0].data,dtype=np.float32)
+    coords = None
+data=hdu_in[0].data
+hdu_in[0].data=image_tiles.correct_image(data,w,lambda rows,ra,dec: correction(ra,dec),out=np.empty(data.shape,dtype=np.float32),tile_rows=options.tile_rows,threads=options.threads,coords=coords)
 hdu_in.writeto(input_mosaic+'_polyapplied.fits',clobber=True)
 hdu_in.close(input_mosaic+'_polyapplied.fits')
@@ -4,7 +4,7 @@
 
 import datetime
 import os
-import emcee
+import multiprocessing
 import matplotlib
 matplotlib.use('Agg')
 import numpy as np
@@ -14,6 +14,12 @@ import scipy.stats as stats
 from astropy.io import fits
 from astropy.modeling import models, fitting
 from optparse import OptionParser
+import reference_photometry
+import sky_match
+import reference_index
+import sed_fit
+import sed_posterior
+import fit_cache
 
 # Setting font. If this breaks on the supercomputer, just uncomment these two lines.
 # from matplotlib import rc
@@ -28,14 +34,36 @@ parser.add_option('--fitsfile',type="string", dest="fitsfile",
                     help="The filename of the fits file you want to read in. Default = catalogue.fits")
 parser.add_option('--ratio_errors',action="store_true",dest="do_ratio_errors",default=True,
                     help="Calculate errors on model fits and ratio of it with image flux measurement (default = True). Keep true if already have *fluxdentable in directory.")
+parser.add_option('--error_method',type="string", dest="error_method",default="mcmc",
+                    help="How to calculate the ratio errors: mcmc (batched ensemble sampler), laplace (analytic covariance) or emcee (one emcee run per source) (default = mcmc)")
+parser.add_option('--cores',dest="cores",default=None,type=int,
+                    help="How many cores to share the ratio error calculation between. (default = all available)")
+parser.add_option('--adaptive',action="store_true",dest="adaptive",default=False,
+                    help="Stop each source's MCMC chain once it has --n_independent independent samples, based on its autocorrelation time (default = False)")
+parser.add_option('--n_independent',dest="n_independent",default=500,type=int,
+                    help="Number of independent samples wanted with --adaptive (default = 500)")
+parser.add_option('--mcmc_steps',dest="mcmc_steps",default=500,type=int,
+                    help="Number of MCMC steps, or the cap on them with --adaptive; the first 200, or half if fewer, are burn-in (default = 500)")
+parser.add_option('--cache',type="string", dest="cache",default=None,
+                    help="sqlite file of cached fit results keyed by the photometry, frequencies and fit options. The fluxdentable is then always rebuilt, reusing the cached fits (default = no cache)")
+parser.add_option('--cache_size',dest="cache_size",default=100000,type=int,
+                    help="Maximum number of fit results kept in the cache; the least recently used are evicted (default = 100000)")
 parser.add_option('--peak',action="store_false",dest="int",default=True,
                     help="Use peak flux rather than int flux (default = False)")
 parser.add_option('--printaverage',action="store_true",dest="printaverage",default=False,
                     help="Print the average flux ratio correction (default = False)")
 (options, args) = parser.parse_args()
 
+if options.mcmc_steps < 1:
+    parser.error("--mcmc_steps must be at least 1")
+
 input_mosaic = options.mosaic
 
+if options.cores is None:
+    cores = multiprocessing.cpu_count()
+else:
+    cores = options.cores
+
 print 'Before '+input_mosaic+': '+str(datetime.datetime.now())
 
 # Checking if fluxdentable exists
@@ -47,6 +75,11 @@ else:
     suffix="peak"
     check_file = os.path.exists(input_mosaic+'_fluxdentable_'+suffix+'.fits')
 
+# With a fit cache the table is rebuilt, so that changed inputs are picked up, and only new fits are run
+if options.cache:
+    cache = fit_cache.FitCache(options.cache, max_entries=options.cache_size, namespace='flux_comparison')
+    check_file = False
+
 if not check_file:
 
     # Getting freq.
@@ -60,12 +93,13 @@ if not check_file:
     except:
         freq_obs = header['FREQ']/1e6
 
-    os.system('stilts tmatch2 matcher=skyellipse in1=$MWA_CODE_BASE/marco_all_VLSSsrcs.fits in2='+input_mosaic+'_comp.vot out=marco_all_VLSSsrcs+'+input_mosaic+'.fits values1="RAJ2000 DEJ2000 MajAxis MinAxis PA" values2="ra dec a b pa" params=20')
+    # Match the error ellipses of the VLSSr sources and the Aegean components, as stilts matcher=skyellipse
+    marco = reference_index.load(os.environ['MWA_CODE_BASE']+'/marco_all_VLSSsrcs.fits', ra='RAJ2000', dec='DEJ2000').table
+    sky_match.match_ellipses(marco, sky_match.read_table(input_mosaic+'_comp.vot'),
+        values1=('RAJ2000','DEJ2000','MajAxis','MinAxis','PA'), values2=('ra','dec','a','b','pa')).write('marco_all_VLSSsrcs+'+input_mosaic+'.fits', overwrite=True)
 
-    hdulist = fits.open('marco_all_VLSSsrcs+'+input_mosaic+'.fits')
-    hdulist.verify('fix')
-    tbdata = hdulist[1].data
-    hdulist.close()
+    tbdata = reference_photometry.read_columns('marco_all_VLSSsrcs+'+input_mosaic+'.fits', reference_photometry.reference_columns() +
+        ['peak_flux', 'err_peak_flux', 'int_flux', 'err_int_flux', 'err_a', 'local_rms', 'flags', 'isolated'])
 
     print "#----------------------------------------------------------#"
     print 'Analysing '+input_mosaic
@@ -73,31 +107,15 @@ if not check_file:
     VLSSr_Name = np.array(tbdata['ID_vlss'])
     RA_VLSSr = np.array(tbdata['RAJ2000_vlss']) #VLSSr positions
     Dec_VLSSr = np.array(tbdata['DEJ2000_vlss'])
-    RA = np.array(tbdata['RAJ2000'])
-    RA = np.where(np.isnan(RA), 0, RA)
-    Dec = np.array(tbdata['DEJ2000'])
-    Dec = np.where(np.isnan(Dec), 0, Dec)
-    S_74 = np.array(tbdata['S_vlss']) # Integrated flux of VLSSr.
-    S_74_err = np.sqrt((np.array(tbdata['e_S_vlss'])**2 + (S_74*0.1)**2))
-    S_1400 = np.array(tbdata['S'])
-    S_1400 = np.where(np.isnan(S_1400), 0, S_1400)
-    S_1400_err = np.array(tbdata['e_S'])
-    S_1400_err = np.where(np.isnan(S_1400_err), 0, S_1400_err)
-    S_843_north = np.array(tbdata['S_sumss_north'])
-    S_843_north = np.where(np.isnan(S_843_north), 0, S_843_north)
-    S_843_north_err = np.array(tbdata['e_S_sumss_north'])
-    S_843_north_err = np.where(np.isnan(S_843_north_err), 0, S_843_north_err)
-    S_408 = np.array(tbdata['S_mrc'])
-    S_408 = np.where(np.isnan(S_408), 0, S_408)
-    S_408_err = np.array(tbdata['e_S_mrc'])
-    S_408_err = np.where(np.isnan(S_408_err), 0, S_408_err)
-    S_160 = np.array(tbdata['S_culgoora160'])
-    S_160 = np.where(np.isnan(S_160), 0, S_160)
-    S_80 = np.array(tbdata['S_culgoora80'])
-    S_80 = np.where(np.isnan(S_80), 0, S_80)
-    # S_325 = np.array(tbdata['S_wsrt'])
-    # S_325 = np.where(np.isnan(S_325), 0, S_325)
-    # S_325_err = (0.06**2 + (4./S_325)**2)**0.5 # from eqn 9 Rengelink et al. (1997)
+    # Literature fluxes with NaNs set to zero, and their errors including the CCA values from Slee 1977
+    ref = reference_photometry.reference_fluxes(tbdata)
+    RA, Dec = ref['RA_NVSS'], ref['Dec_NVSS']
+    S_74, S_74_err = ref['S_74'], ref['S_74_err']
+    S_80, S_80_err = ref['S_80'], ref['S_80_err']
+    S_160, S_160_err = ref['S_160'], ref['S_160_err']
+    S_408, S_408_err = ref['S_408'], ref['S_408_err']
+    S_843_north, S_843_north_err = ref['S_843_north'], ref['S_843_north_err']
+    S_1400, S_1400_err = ref['S_1400'], ref['S_1400_err']
     S_196 = np.array(tbdata['peak_flux']) # MWA from aegean
     S_196_err = np.array(tbdata['err_peak_flux'])
     S_196_int = np.array(tbdata['int_flux'])
@@ -107,31 +125,6 @@ if not check_file:
     flags_1 = np.array(tbdata['flags'])
     isolated_flag = np.array(tbdata['isolated'])
 
-    # Working out the uncertainties on CCA values
-    S_160_err = np.zeros(len(S_160))
-    S_80_err = np.zeros(len(S_80))
-    for i in range(len(S_160)):
-        if S_160[i] > 0:
-            #fixing up errors as per Table 3 in Slee 1977. Assuming average of two
-            if S_160[i] <= 3:
-                S_160_err[i] = 0.27*S_160[i]
-            elif S_160[i] > 3 and S_160[i] <= 5:
-                S_160_err[i] = 0.23*S_160[i]
-            elif S_160[i] > 5 and S_160[i] <= 12:
-                S_160_err[i] = 0.17*S_160[i]
-            elif S_160[i] > 12 and S_160[i] <= 20:
-                S_160_err[i] = 0.10*S_160[i]
-            elif S_160[i] > 20:
-                S_160_err[i] = 0.9*S_160[i]
-
-        if S_80[i] > 0:
-            if S_80[i] <= 10:
-                S_80_err[i] = 0.32*S_80[i]
-            elif S_80[i] > 10 and S_80[i] <= 20:
-                S_80_err[i] = 0.20*S_80[i]
-            elif S_80[i] > 20:
-                S_80_err[i] = 0.10*S_80[i]
-
     if options.int:
         flux_obs = S_196_int
         flux_obs_err = S_196_int_err
@@ -139,155 +132,53 @@ if not check_file:
         flux_obs = S_196
         flux_obs_err = S_196_err
 
-    freq = np.array([74., 80., 160., freq_obs, 408., 843., 1400.])
-    flux = np.vstack((S_74,S_80, S_160, flux_obs, S_408,S_843_north,S_1400))
-    flux_err = np.vstack((S_74_err,S_80_err, S_160_err, flux_obs_err,
-        S_408_err,S_843_north_err,S_1400_err))
+    freq, flux, flux_err = reference_photometry.flux_stack(ref, freq_obs, flux_obs, flux_obs_err)
 
     print "#----------------------------------------------------------#"
     print 'Fitting powerlaw to flux points, excluding MWA points'
 
-    p0pow = [7,-0.7]
-
-    def redchisq(ydata,ymod,sd,deg):
-        chisq=np.sum(((ydata-ymod)/sd)**2)
-        nu=ydata.size-1-deg
-        return [chisq, chisq/nu]#, chisq/nu
-
     def powlaw(freq, a, alpha): # defining powlaw as S = a*nu^alpha.
         return a*(freq**alpha)
 
-    srcsind=[]
-    alpha, redchisq_val, MWAfreqfit_predicted, MWAfreqfit_predicted_err, ratio, ratio_err, hour_angle, hour_angle_sym, az, alt= [np.zeros(np.shape(flux[1])[0]) for dummy in range(10)]
-
-    for i in range(np.shape(flux[1])[0]):
-
-        fluxposind = np.where(flux[:,i] > 0)
-        fluxplot = flux[:,i][fluxposind]
-        freqplot = freq[fluxposind]
-        flux_errplot = flux_err[:,i][fluxposind]
-        ind_nomwa = np.where((freq != freq_obs) & (flux[:,i] > 0) & (freq != 80.) & (freq != 160.)& (freq != 325.)) # Fitting to only non zero and non_MWA points and non-texas or 
-        fluxfit = flux[:,i][ind_nomwa]
-        freqfit = freq[ind_nomwa]
-        flux_errfit = flux_err[:,i][ind_nomwa]
-
-        if len(fluxfit) >= 3 or (Dec[i] > 18. and isolated_flag[i] == True and Dec[i] < 30.):
-         
-            try:
-                poptpowlaw, pcovpowlaw = opt.curve_fit(powlaw, freqfit, fluxfit, p0 = p0pow, sigma = flux_errfit, maxfev = 10000)            
-                redchisq_val[i] = redchisq(fluxfit,powlaw(freqfit,*poptpowlaw),flux_errfit,2)[0]
-            except ValueError: # If curve fit can not find a good fit, skip the source.
-                print 'Skipping because can not find good fit.'
-                continue
-
-            if redchisq_val[i] <= 2.5 and err_a[i] >=0 and flags_1[i] == 0 and abs(poptpowlaw[1]) > 0.1 and 8*rms[i]/flux_obs[i] <= 1. and S_74[i] > 2.0:
-
-                print VLSSr_Name[i]+' meets the criteria.'
-
-                MWAfreqfit_predicted[i] = powlaw(freq_obs,*poptpowlaw)
-                ratio[i] = MWAfreqfit_predicted[i] / flux_obs[i]
-                alpha[i] = poptpowlaw[1]
-                srcsind.append(i)
-                
-                if options.do_ratio_errors:
-                    
-                    # Calculating uncertainties on fit and ratio
-
-                    x = freqfit
-                    y = fluxfit
-                    yerr = flux_errfit
-
-                    def lnlike(theta,x,y,yerr):
-                        S_norm,specind= theta # Model parameters have to be included in lnlike. This implentation makes it veristile.
-                        model = powlaw(x,S_norm,specind)
-                        inv_sigma = 1.0/(yerr**2)
-                        return -0.5*(np.sum((y-model)**2*inv_sigma - np.log(inv_sigma)))  
-
-                    # Use the scipy.opt model to find the optimum of this likelihood function
-
-                    nll = lambda *args: -lnlike(*args)
-                    p0guess = list(poptpowlaw) # Guessing the parameters of the model. This can be educated guess (i.e from least-square fit)
-                    result = opt.fmin(nll,p0guess, args=(x,y,yerr), full_output='true')
-                    S_norm_ml, specind_ml = result[0]    
-
-                    def lnprior(theta):
-                        S_norm, specind = theta
-                        if poptpowlaw[0]/100. < S_norm < poptpowlaw[0]*100. and abs(poptpowlaw[1]/100.) < abs(specind) < abs(poptpowlaw[1]*100.):
-                            return 0.00    
-                        return -np.inf
-
-                    # Combining this prior with the definition of the likelihood function, the probablity fucntion is:
-
-                    def lnprob(theta, x, y, yerr):
-                        lp = lnprior(theta)
-                        if not np.isfinite(lp):
-                            return -np.inf
-                        return lp + lnlike(theta, x, y, yerr)
-
-                    # Now implement emcee
-
-                    ndim, nwalkers, nsteps =  2, 100, 500
-
-                    # Initialising the walkers in a Gaussian ball around maximum likelihood result
-                    pos = [result[0]+ 1e-4*np.random.randn(ndim) for p in range(nwalkers)]
-
-                    # Next two lines useful for debugging if emcee falls over
-                    # print 'lnprior1', map(lambda p: lnprior(p), pos)
-                    # print 'lnlike', map(lambda p: lnlike(p, x, y, yerr), pos)
-
-                    # print "Before emcee: "+str(datetime.datetime.now())
-                    sampler = emcee.EnsembleSampler(nwalkers, ndim, lnprob, args = (x,y,yerr))
-                    sampler.run_mcmc(pos, nsteps) # This is the workhorse step.
-                    # print "After emcee: "+str(datetime.datetime.now())
-
-                    # Now plotting the walks of the walkers with each step, for each parameter. 
-                    # If they have converged on a good value they should have clumped together.
-
-                    # fig = plt.figure(2,figsize=(10, 10))
-                    # fig.clf()
-                    # for j in range(ndim):
-                    #     ax = fig.add_subplot(ndim,1,j+1)
-                    #     ax.plot(np.array([sampler.chain[:,i,j] for i in range(nsteps)]),"k", alpha = 0.3)
-                    #     ax.set_ylabel((r'$S_{norm}$',r'$\alpha$')[j], fontsize = 15)
-                            
-                    # Usually burn in period is well and truly over by 300 steps. So I will exclude those.
-                    samples = sampler.chain[:,200:,:].reshape((-1,ndim))
-
-                    # Plotting the histograms of the fit.
-                    # trifig = triangle.corner(samples, labels = [r'$S_{norm}$',r'$\alpha$'])
-
-                    # Finally to get the final uncertainties you do
-                    S_norm_powlaw_mcmc, specind_powlaw_mcmc = map(lambda v: (v[1], v[2]-v[1], v[1]-v[0]), zip(*np.percentile(samples,[16,50,84], axis = 0))) # Uncertainites based on the 16th, 50th and 84th percentile.
-                        
-                    # Finding upper (84th percentile) and lower (16th percentile) values for all frequencies
-                    fit_powlaw = [S_norm_powlaw_mcmc[0], specind_powlaw_mcmc[0]]
-                    
-                    # Calculating uncertainity at 
-                    flux_store = np.zeros((100,1))
-                    lower_flux_powlaw, upper_flux_powlaw = np.zeros(1), np.zeros(1)
-                    ii=0
-                    for S_norm, specind in samples[np.random.randint(len(samples), size=100)]:
-                        flux_store[ii] = powlaw(freq_obs, S_norm,specind)
-                        lower_flux_powlaw, upper_flux_powlaw = np.percentile(flux_store[:],[16,84], axis = 0)
-                        ii = ii+1    
-
-                    MWAfreqfit_predicted_err[i] = upper_flux_powlaw - lower_flux_powlaw
-                    ratio_err[i] = ratio[i]*np.sqrt((flux_obs_err[i] / flux_obs[i])**2 + (MWAfreqfit_predicted_err[i] / MWAfreqfit_predicted[i])**2)
-                    alpha[i] = specind
-                    
-                    # sedplots.sed(powlaw,poptpowlaw,freqplot,fluxplot,flux_errplot, freq_labels = True, savefig = False, title = VLSSr_Name[i]+r' $\alpha$ = '+str(round(alpha[i],3))+r' $ \chi_{\rm{red}}$  = '+str(round(redchisq_val[i])))#+' ObsID = '+str(aegeanfiles[j]))
-                    # if not os.path.exists(os.getcwd()+'/figures/'):
-                    #     os.makedirs(os.getcwd()+'/figures/')
-                    # #     print 'Creating directory ', os.getcwd()+'/'+directory+'/figures/'+VLSSr_Name[i]+' and saving figures in png format with title names.'
-                    # plt.savefig(os.getcwd()+'/figures/'+VLSSr_Name[i]+'.png')
+    # Fitting to only non zero and non_MWA points and non-texas or CCA points, all sources at once.
+    fitmask = ((freq != freq_obs) & (freq != 80.) & (freq != 160.) & (freq != 325.))[:,np.newaxis] & (flux > 0)
+    amp_fit, alpha_fit, cov_fit, chisq_fit, redchisq_fit, npts_fit = sed_fit.fit_powlaw(freq, flux, flux_err, use=fitmask)
+
+    eligible = np.isfinite(alpha_fit) & ((np.sum(fitmask, axis=0) >= 3) | ((Dec > 18.) & (isolated_flag == True) & (Dec < 30.)))
+    print 'Skipping '+str(np.sum(~eligible))+' sources with less than three flux values or no good fit.'
+
+    alpha, redchisq_val, MWAfreqfit_predicted, MWAfreqfit_predicted_err, ratio, ratio_err = [np.zeros(np.shape(flux[1])[0]) for dummy in range(6)]
+    mcmc_steps = np.zeros(len(alpha), dtype=int)
+    mcmc_tau = np.zeros(len(alpha))
+    redchisq_val[eligible] = chisq_fit[eligible] # redchisq()[0] as before, i.e. the chi-square
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        accepted = eligible & (redchisq_val <= 2.5) & (err_a >= 0) & (flags_1 == 0) & (np.abs(alpha_fit) > 0.1) & (8*rms/flux_obs <= 1.) & (S_74 > 2.0)
+    srcsind = np.where(accepted)[0]
+    print str(len(srcsind))+' sources meet the criteria.'
+
+    MWAfreqfit_predicted[srcsind] = powlaw(freq_obs, amp_fit[srcsind], alpha_fit[srcsind])
+    ratio[srcsind] = MWAfreqfit_predicted[srcsind] / flux_obs[srcsind]
+    alpha[srcsind] = alpha_fit[srcsind]
+
+    if options.do_ratio_errors:
+
+        # Calculating uncertainties on fit and ratio for all the accepted sources at once
+        print 'Calculating uncertainties using '+options.error_method+' on '+str(cores)+' cores'
+        seeds = sed_posterior.source_seeds(VLSSr_Name[srcsind])
+        def ratio_errors(index):
+            return sed_posterior.predicted_flux_err(freq, flux[:,srcsind[index]], flux_err[:,srcsind[index]],
+                fitmask[:,srcsind[index]], amp_fit[srcsind[index]], alpha_fit[srcsind[index]], freq_obs, method=options.error_method,
+                seeds=seeds[index], cores=cores,
+                nsteps=options.mcmc_steps, n_independent=options.n_independent if options.adaptive else None)
+        if options.cache:
+            keys = cache.keys([flux[:,srcsind], flux_err[:,srcsind], fitmask[:,srcsind], seeds],
+                common=[freq, freq_obs, options.error_method, options.mcmc_steps, options.n_independent if options.adaptive else None])
+            errors = cache.cached(keys, ratio_errors)
         else:
-            print 'Less than three flux values. Skipping...'
-
-                # sedplots.sed(powlaw,poptpowlaw,freqplot,fluxplot,flux_errplot, freq_labels = True, savefig = False, title = VLSSr_Name[i]+r' $\alpha$ = '+str(round(alpha[i],3))+r' $ \chi_{\rm{red}}$  = '+str(round(redchisq_val[i],2)))#+' ObsID = '+str(aegeanfiles[j]))
-                # if not os.path.exists(os.getcwd()+'/sed_figures/'):
-                #     os.makedirs(os.getcwd()+'/sed_figures/')
-                #     print 'Creating directory ', os.getcwd()+'/sed_figures/'+VLSSr_Name[i]+' and saving figures in png format with title names.'
-                # plt.savefig(os.getcwd()+'/sed_figures/'+VLSSr_Name[i]+'.png')
+            errors = ratio_errors(np.arange(len(srcsind)))
+        MWAfreqfit_predicted_err[srcsind], alpha[srcsind], mcmc_steps[srcsind], mcmc_tau[srcsind] = errors
+        ratio_err[srcsind] = ratio[srcsind]*np.sqrt((flux_obs_err[srcsind] / flux_obs[srcsind])**2 + (MWAfreqfit_predicted_err[srcsind] / MWAfreqfit_predicted[srcsind])**2)
 
     col1 = fits.Column(name='VLSSr Name', format = '22A', array = VLSSr_Name[srcsind])
     col2 = fits.Column(name='S_'+str(int(round(freq_obs)))+'_model', format = 'E', array = MWAfreqfit_predicted[srcsind])
@@ -317,14 +208,19 @@ if not check_file:
     col28 = fits.Column(name='redchisq', format = 'E', array = redchisq_val[srcsind])
     col29 = fits.Column(name='alpha', format = 'E', array = alpha[srcsind])
     col42 = fits.Column(name='rms', format = 'E', array = rms[srcsind])
+    col45 = fits.Column(name='mcmc_steps', format = 'J', array = mcmc_steps[srcsind])
+    col46 = fits.Column(name='mcmc_tau', format = 'E', array = mcmc_tau[srcsind])
 
     cols = fits.ColDefs([col1, col13, col14, col2, col43,
         col3, col4, col44, col19, col20, col21, col5, col6, col30, col31,col32, col33,
-        col7, col8, col9, col10, col11, col12, col23, col24, col28, col29, col42])#, col22])
+        col7, col8, col9, col10, col11, col12, col23, col24, col28, col29, col42, col45, col46])#, col22])
     
     tbhdu = fits.new_table(cols)
     tbhdu.writeto(input_mosaic+'_fluxdentable_'+suffix+'.fits', clobber = True) 
     print 'Wrote to '+input_mosaic+'_fluxdentable_'+suffix+'.fits'
+    if options.cache:
+        print cache.report()
+        cache.close()
 else:
     print input_mosaic+'_fluxdentable* exists. Will not recalculate errors but read in existing table.'
 
@@ -411,6 +307,7 @@ a_fit[1], b_fit[1] = poptlin[0], poptlin[1]
 
 # Fitting ratio properly
 if options.do_ratio_errors:
+    import emcee
     x = dec
     yerr = ratio_err / ratio
     y = np.log(ratio)
@@ -14,6 +14,7 @@ from astropy.io import fits
 from astropy.coordinates import SkyCoord
 from astropy.modeling import models, fitting
 from optparse import OptionParser
+import reference_photometry
 
 # Setting font. If this breaks on the supercomputer, just uncomment these two lines.
 # from matplotlib import rc
@@ -99,10 +100,8 @@ Dec_strip = header['CRVAL2']
 # Dec_min = Dec_min[cut_ind]
 # Dec_max = Dec_max[cut_ind]
 
-hdulist = fits.open('marco_all_VLSSsrcs+'+input_mosaic+'.fits')
-hdulist.verify('fix')
-tbdata = hdulist[1].data
-hdulist.close()
+tbdata = reference_photometry.read_columns('marco_all_VLSSsrcs+'+input_mosaic+'.fits', ['ID', 'RAJ2000', 'DEJ2000', 'DEJ2000_vlss',
+    'S_vlss', 'e_S_vlss', 'S_mrc', 'e_S_mrc', 'S', 'e_S', 'flags_1', 'isolated', 'components', 'int_flux_1', 'peak_flux_1', 'local_rms_1'])
 
 def filter_GalacticPlane(table):
     """
@@ -0,0 +1,207 @@
+"""
+Apply a per-pixel correction to a mosaic a block of rows at a time
+
+The correction scripts used to read the whole mosaic, build a full-size
+float64 correction map, multiply and write a new file, which for a full-sky
+mosaic needs several times its size in memory. Here the input is memory-mapped,
+the output FITS file is preallocated on disk (header first, then the data
+section extended to its full padded length) and memory-mapped for writing,
+and the correction is evaluated and applied one tile of rows at a time. The
+peak memory is then a few tiles, whatever the size of the mosaic.
+
+The correction is a function of the RA and Dec of the pixels of a tile, as
+given by sky_coords.sky_tiles(), or sliced from precomputed (e.g. cached)
+maps. The output is float32, as written by the in-memory scripts. Several
+corrections, e.g. the steps of correct_mosaic.py, can be chained in one pass.
+A BSCALE or BZERO in the input, e.g. from fits_scale.py, is applied to each
+tile, so the mosaic is still memory-mapped rather than scaled as a whole.
+
+The tiles can be processed concurrently on a pool of threads: numpy and the
+WCS transformations release the GIL, and each thread only holds its own tile,
+so the memory is bounded by threads x tile_rows rows. The same executor,
+correct_image(), serves in-memory images. Files can also be modified in place
+through open_fits(), e.g. blank_SCP.py writing NaNs with run_sky_tiles().
+
+Usage example
+====
+import image_tiles
+image_tiles.apply_correction('mosaic.fits', 'mosaic_polyapplied.fits', lambda ra, dec: np.exp(a + b*dec), tile_rows=256)
+image_tiles.apply_chain('mosaic.fits', 'mosaic_corrected.fits', [lambda rows, ra, dec: factor, blank])
+image_tiles.correct_image(hdu[0].data, w, lambda rows, ra, dec: weight(dec), threads=20)
+data = image_tiles.open_fits('snapshot.fits')
+====
+"""
+import multiprocessing
+import threading
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+from astropy.io import fits
+from astropy import wcs
+
+import sky_coords
+import fits_scale
+
+def image_view(data):
+    '''The (ny, nx) view of an image with any leading axes of length 1, e.g. frequency and Stokes.'''
+    if int(np.prod(data.shape[:-2])) != 1:
+        raise ValueError("image has more than one plane: shape %s" % (data.shape,))
+    return data.reshape(data.shape[-2:])
+
+def create_fits(filename, header, shape, dtype='>f4'):
+    '''
+    Write header as the primary header of a new FITS file with a float32 image of the given
+    shape (numpy order), extend the file to the full size of the data section without writing
+    it, and return the data as a writable memmap. Any existing file is overwritten.
+    '''
+    header = header.copy()
+    header['BITPIX'] = -32
+    header['NAXIS'] = len(shape)
+    for axis, length in enumerate(shape[::-1]):
+        header['NAXIS%d' % (axis + 1)] = length
+    for key in ('BSCALE', 'BZERO', 'BLANK'):
+        if key in header:
+            del header[key]
+    header_bytes = header.tostring()
+    if not isinstance(header_bytes, bytes):
+        header_bytes = header_bytes.encode('ascii')
+
+    nbytes = int(np.prod(shape))*np.dtype(dtype).itemsize
+    padded = -(-nbytes//2880)*2880
+    with open(filename, 'wb') as f:
+        f.write(header_bytes)
+        # Zero-filled (and sparse where the filesystem allows it) up to the end of the padding
+        f.seek(len(header_bytes) + padded - 1)
+        f.write(b'\0')
+    return np.memmap(filename, dtype=dtype, mode='r+', offset=len(header_bytes), shape=tuple(shape))
+
+def open_fits(filename, mode='r+'):
+    '''
+    The stored values of the primary image of an existing floating-point FITS file as a memmap,
+    writable in place with mode r+. BSCALE and BZERO, if any, are not applied.
+    '''
+    hdu_in = fits.open(filename, do_not_scale_image_data=True)
+    try:
+        header = hdu_in[0].header
+        offset = hdu_in.fileinfo(0)['datLoc']
+    finally:
+        hdu_in.close()
+    dtypes = {-32: '>f4', -64: '>f8'}
+    if header['BITPIX'] not in dtypes:
+        raise ValueError("%s is not a floating-point image: BITPIX = %d" % (filename, header['BITPIX']))
+    shape = tuple(header['NAXIS%d' % axis] for axis in range(header['NAXIS'], 0, -1))
+    return np.memmap(filename, dtype=dtypes[header['BITPIX']], mode=mode, offset=offset, shape=shape)
+
+def run_tiles(func, shape, tile_rows=256, threads=1):
+    '''
+    Call func(rows) for every slice of at most tile_rows rows of an image of shape (..., ny, nx),
+    on a pool of threads (all the cores if None). Exceptions are raised in the caller.
+    '''
+    slices = list(sky_coords.row_slices(tuple(shape[-2:]), tile_rows))
+    if threads is None:
+        threads = multiprocessing.cpu_count()
+    if threads <= 1 or len(slices) <= 1:
+        for rows in slices:
+            func(rows)
+        return
+    pool = ThreadPool(min(threads, len(slices)))
+    try:
+        for dummy in pool.imap_unordered(func, slices):
+            pass
+    finally:
+        pool.close()
+        pool.join()
+
+def run_sky_tiles(func, w, shape, tile_rows=256, threads=1, coords=None, skip=None):
+    '''
+    Call func(rows, ra, dec) for every tile of rows of an image of shape (ny, nx) with celestial
+    WCS w, as run_tiles(). coords: as for apply_factors(). skip(rows): optional; if True, func is
+    called with ra and dec None, without computing them.
+    '''
+    w = sky_coords.celestial(w)
+    local = threading.local()
+
+    def tile(rows):
+        if coords is False or (skip is not None and skip(rows)):
+            ra, dec = None, None
+        elif coords is None:
+            # WCS objects are not shared between threads
+            if not hasattr(local, 'w'):
+                local.w = w.deepcopy()
+            ra, dec = sky_coords.tile_coords(local.w, shape, rows)
+        else:
+            ra, dec = coords[0][rows], coords[1][rows]
+        func(rows, ra, dec)
+
+    run_tiles(tile, shape, tile_rows, threads)
+
+def correct_image(image, w, factor, out=None, tile_rows=256, threads=1, coords=None, bscale=1., bzero=0.):
+    '''
+    out[rows] = factor(rows, ra, dec)*image[rows] for every tile of rows of the 2D image, with
+    celestial WCS w, on threads threads. out defaults to image itself, i.e. in place. coords: as
+    for apply_factors(). bscale and bzero: the FITS scaling of the stored values in image, if
+    read without applying it. Returns out.
+    '''
+    scaled = (bscale != 1. or bzero != 0.)
+    if out is None:
+        out = image
+
+    def tile(rows, ra, dec):
+        if scaled:
+            out[rows] = factor(rows, ra, dec)*(bzero + bscale*image[rows])
+        else:
+            out[rows] = factor(rows, ra, dec)*image[rows]
+
+    run_sky_tiles(tile, w, image.shape, tile_rows, threads, coords)
+    return out
+
+def apply_factors(infile, outfile, factor, header=None, tile_rows=256, coords=None, threads=1):
+    '''
+    Write outfile = factor(rows, ra, dec)*image of infile, as float32, tile_rows rows at a time,
+    where rows is the slice of the image covered by the (rows, nx) ra and dec of the tile.
+
+    header: the header to write and take the WCS from (default that of infile), e.g. with the
+    degenerate frequency axis removed. coords: optional (ra, dec) maps of the whole image, e.g.
+    memmaps from the sky_coords cache, sliced instead of computing the coordinates of each tile,
+    or False if factor does not use them, in which case ra and dec are None. threads: see
+    run_tiles(). Any BSCALE and BZERO of infile are applied.
+    '''
+    # The stored values stay memory-mapped; the scaling is applied a tile at a time
+    hdu_in = fits.open(infile, memmap=True, do_not_scale_image_data=True)
+    try:
+        if header is None:
+            header = hdu_in[0].header
+        bscale, bzero = fits_scale.scaling(hdu_in[0].header)
+        data = hdu_in[0].data
+        image = image_view(data)
+        out = create_fits(outfile, header, data.shape)
+        correct_image(image, wcs.WCS(header), factor, out.reshape(image.shape), tile_rows, threads, coords, bscale, bzero)
+        out.flush()
+        del out
+    finally:
+        hdu_in.close()
+
+def apply_correction(infile, outfile, correction, header=None, tile_rows=256, coords=None, threads=1):
+    '''Write outfile = correction(ra, dec)*image of infile, as float32; see apply_factors().'''
+    apply_factors(infile, outfile, lambda rows, ra, dec: correction(ra, dec), header, tile_rows, coords, threads)
+
+def apply_rows(infile, outfile, row_factor, header=None, tile_rows=256, threads=1):
+    '''
+    Write outfile = row_factor[y]*image[y] for every row y of infile, as float32, e.g. for a
+    correction which depends only on Dec in an image where Dec is constant along the rows.
+    '''
+    row_factor = np.asarray(row_factor)
+    apply_factors(infile, outfile, lambda rows, ra, dec: row_factor[rows, np.newaxis], header, tile_rows, False, threads)
+
+def apply_chain(infile, outfile, steps, header=None, tile_rows=256, coords=None, threads=1):
+    '''
+    Apply a chain of corrections in one pass: steps is the ordered list of factor(rows, ra, dec)
+    functions, as for apply_factors(), whose product multiplies each tile. A factor can be a
+    scalar (a rescaling) or contain NaN (blanking).
+    '''
+    def factor(rows, ra, dec):
+        total = np.ones(ra.shape)
+        for step in steps:
+            total = total*step(rows, ra, dec)
+        return total
+    apply_factors(infile, outfile, factor, header, tile_rows, coords, threads)
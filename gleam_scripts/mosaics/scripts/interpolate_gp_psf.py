@@ -11,6 +11,7 @@ import numpy as np
 
 from astropy.io import fits
 from astropy import wcs
+import sky_coords
 from optparse import OptionParser
 
 from astropy.coordinates import SkyCoord
@@ -45,20 +46,12 @@ blur = psf[0].data[3]
 
 w_psf = wcs.WCS(psf[0].header,naxis=2)
 
-#create an array but don't set the values (they are random)
-indexes = np.empty( (psf[0].data.shape[1]*psf[0].data.shape[2],2),dtype=int)
-#since I know exactly what the index array needs to look like I can construct
-# it faster than list comprehension would allow
-#we do this only once and then recycle it
-idx = np.array([ (j,0) for j in xrange(psf[0].data.shape[2])])
-j=psf[0].data.shape[2]
-for i in xrange(psf[0].data.shape[1]):
-    idx[:,1]=i
-    indexes[i*j:(i+1)*j] = idx
+# The (x, y) index of each location in the PSF map, in row-major order
+indexes = sky_coords.pixel_indices(psf[0].data.shape[1:])
 
 # The RA and Dec co-ordinates of each location in the PSF map
 # Each one is a 1D array of shape 64800 (from 180 (Dec) x 360 (RA))
-ra_psf,dec_psf = w_psf.wcs_pix2world(indexes,1).transpose()
+ra_psf,dec_psf = [x.ravel() for x in sky_coords.sky_coords(w_psf,psf[0].data.shape[1:])]
 # A 1D array of co-ordinates at each location
 c_psf = SkyCoord(ra=ra_psf, dec=dec_psf, unit=(u.degree, u.degree))
 
@@ -12,6 +12,7 @@ from astropy.table import Table, Column
 from astropy.io.votable import writeto as writetoVO
 
 import re
+import sky_match
 
 prefix="Week"
 suffix="_white_lownoise_comp.vot"
@@ -21,18 +22,28 @@ table2=prefix+"2"+suffix
 table3=prefix+"3"+suffix
 table4=prefix+"4"+suffix
 
+# The skyellipse matches are made in process by sky_match; each catalogue is read once, when first needed
+catalogues={}
+def overlap(in1,in2,output,join='1and2'):
+    for table in in1,in2:
+        if table not in catalogues:
+            catalogues[table]=sky_match.read_table(table)
+    fixcols='all' if join=='1and2' else 'none'
+    match=sky_match.match_ellipses(catalogues[in1],catalogues[in2],find='all',join=join,fixcols=fixcols)
+    match.write(output,format='votable',overwrite=True)
+
 # Crossmatch 1 with 2, 2 with 3, 3 with 4, 4 with 1, saving only things which overlap
 if not os.path.exists('a1_2.vot'):
-    os.system('stilts tmatch2 matcher=skyellipse params=30 in1='+table1+' in2='+table2+' out=a1_2.vot values1="ra dec a b pa" values2="ra dec a b pa" ofmt=votable find=all fixcols=all join=1and2')
-    os.system('stilts tmatch2 matcher=skyellipse params=30 in1='+table2+' in2='+table3+' out=a2_3.vot values1="ra dec a b pa" values2="ra dec a b pa" ofmt=votable find=all fixcols=all join=1and2')
-    os.system('stilts tmatch2 matcher=skyellipse params=30 in1='+table3+' in2='+table4+' out=a3_4.vot values1="ra dec a b pa" values2="ra dec a b pa" ofmt=votable find=all fixcols=all join=1and2')
-    os.system('stilts tmatch2 matcher=skyellipse params=30 in1='+table4+' in2='+table1+' out=a4_1.vot values1="ra dec a b pa" values2="ra dec a b pa" ofmt=votable find=all fixcols=all join=1and2')
+    overlap(table1,table2,'a1_2.vot')
+    overlap(table2,table3,'a2_3.vot')
+    overlap(table3,table4,'a3_4.vot')
+    overlap(table4,table1,'a4_1.vot')
 # Crossmatch 2 with 1, 3 with 2, 4 with 3, 1 with 4, saving only things which overlap
 if not os.path.exists('a2_1.vot'):
-    os.system('stilts tmatch2 matcher=skyellipse params=30 in1='+table2+' in2='+table1+' out=a2_1.vot values1="ra dec a b pa" values2="ra dec a b pa" ofmt=votable find=all fixcols=all join=1and2')
-    os.system('stilts tmatch2 matcher=skyellipse params=30 in1='+table3+' in2='+table2+' out=a3_2.vot values1="ra dec a b pa" values2="ra dec a b pa" ofmt=votable find=all fixcols=all join=1and2')
-    os.system('stilts tmatch2 matcher=skyellipse params=30 in1='+table4+' in2='+table3+' out=a4_3.vot values1="ra dec a b pa" values2="ra dec a b pa" ofmt=votable find=all fixcols=all join=1and2')
-    os.system('stilts tmatch2 matcher=skyellipse params=30 in1='+table1+' in2='+table4+' out=a1_4.vot values1="ra dec a b pa" values2="ra dec a b pa" ofmt=votable find=all fixcols=all join=1and2')
+    overlap(table2,table1,'a2_1.vot')
+    overlap(table3,table2,'a3_2.vot')
+    overlap(table4,table3,'a4_3.vot')
+    overlap(table1,table4,'a1_4.vot')
 
 # Grab each xmatch and select the values with the lowest RMSs (for now -- lowest resid_std might be best)
 ands=["a1_2.vot","a2_3.vot","a3_4.vot","a4_1.vot"]
@@ -59,16 +70,16 @@ for amatch,rmatch in zip(ands,revands):
 # Not using XOR means we don't have to rename the columns later
 # Crossmatch 1 with 2, 2 with 3, 3 with 4, 4 with 1, saving only things which DON'T overlap
 if not os.path.exists('x1_2.vot'):
-    os.system('stilts tmatch2 matcher=skyellipse params=30 in1='+table1+' in2='+table2+' out=x1_2.vot values1="ra dec a b pa" values2="ra dec a b pa" ofmt=votable find=all fixcols=none join=1not2')
-    os.system('stilts tmatch2 matcher=skyellipse params=30 in1='+table2+' in2='+table3+' out=x2_3.vot values1="ra dec a b pa" values2="ra dec a b pa" ofmt=votable find=all fixcols=none join=1not2')
-    os.system('stilts tmatch2 matcher=skyellipse params=30 in1='+table3+' in2='+table4+' out=x3_4.vot values1="ra dec a b pa" values2="ra dec a b pa" ofmt=votable find=all fixcols=none join=1not2')
-    os.system('stilts tmatch2 matcher=skyellipse params=30 in1='+table4+' in2='+table1+' out=x4_1.vot values1="ra dec a b pa" values2="ra dec a b pa" ofmt=votable find=all fixcols=none join=1not2')
+    overlap(table1,table2,'x1_2.vot',join='1not2')
+    overlap(table2,table3,'x2_3.vot',join='1not2')
+    overlap(table3,table4,'x3_4.vot',join='1not2')
+    overlap(table4,table1,'x4_1.vot',join='1not2')
 # Crossmatch 2 with 1, 3 with 2, 4 with 3, 1 with 4, saving only things which DON'T overlap
 if not os.path.exists('x2_1.vot'):
-    os.system('stilts tmatch2 matcher=skyellipse params=30 in1='+table1+' in2='+table2+' out=x2_1.vot values1="ra dec a b pa" values2="ra dec a b pa" ofmt=votable find=all fixcols=none join=2not1')
-    os.system('stilts tmatch2 matcher=skyellipse params=30 in1='+table2+' in2='+table3+' out=x3_2.vot values1="ra dec a b pa" values2="ra dec a b pa" ofmt=votable find=all fixcols=none join=2not1')
-    os.system('stilts tmatch2 matcher=skyellipse params=30 in1='+table3+' in2='+table4+' out=x4_3.vot values1="ra dec a b pa" values2="ra dec a b pa" ofmt=votable find=all fixcols=none join=2not1')
-    os.system('stilts tmatch2 matcher=skyellipse params=30 in1='+table4+' in2='+table1+' out=x1_4.vot values1="ra dec a b pa" values2="ra dec a b pa" ofmt=votable find=all fixcols=none join=2not1')
+    overlap(table1,table2,'x2_1.vot',join='2not1')
+    overlap(table2,table3,'x3_2.vot',join='2not1')
+    overlap(table3,table4,'x4_3.vot',join='2not1')
+    overlap(table4,table1,'x1_4.vot',join='2not1')
 
 # Now we want to get just the 1s, just the 2s, just the 3s, just the 4s
 # Using PA for now, but should change this to UUID when new version becomes available
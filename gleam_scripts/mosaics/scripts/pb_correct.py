@@ -1,12 +1,86 @@
 #!/usr/bin/env python
 
 # Divide one input by another (useful for primary beam correction)
+# With --manifest, correct a batch of (image, beam) pairs, e.g. all the polarisations of
+# each obsid against the beams in pbeams/: the pairs are grouped by beam, and each beam is
+# read once, shared between its images and released after the last of them, so that only the
+# beams of the pairs in progress are held in memory. The images are streamed through
+# memory-mapped tiles, several pairs at once.
 
 import sys
 import os
+import threading
+from multiprocessing.pool import ThreadPool
+import numpy as np
 from astropy.io import fits
+import image_tiles
 from optparse import OptionParser
 
+def read_manifest(manifest):
+    '''(image, beam, output) for each line "image beam [output]" of manifest; # starts a comment.'''
+    pairs=[]
+    for line in open(manifest):
+        fields=line.split('#')[0].split()
+        if not fields:
+            continue
+        if len(fields)<2 or len(fields)>3:
+            raise ValueError("Expected image beam [output] in "+manifest+": "+line.strip())
+        if len(fields)==2:
+            fields.append(fields[0].replace(".fits","_pb.fits"))
+        pairs.append(tuple(fields))
+    return pairs
+
+def group_by_beam(pairs):
+    '''The (image, beam, output) pairs with those of each beam together, in order of first use.'''
+    first={}
+    for i,pair in enumerate(pairs):
+        first.setdefault(pair[1],i)
+    return sorted(pairs,key=lambda pair: first[pair[1]])
+
+class BeamCache(object):
+    '''
+    The (ny, nx) beam of each beam file, read once and shared between threads, and dropped
+    when release() has been called for each of the pairs that use it.
+    '''
+    def __init__(self,pairs):
+        self.beams={}
+        self.locks={}
+        self.uses={}
+        for pair in pairs:
+            self.uses[pair[1]]=self.uses.get(pair[1],0)+1
+        self.lock=threading.Lock()
+
+    def release(self,beam):
+        with self.lock:
+            self.uses[beam]-=1
+            if self.uses[beam]==0:
+                self.beams.pop(beam,None)
+                self.locks.pop(beam,None)
+
+    def get(self,beam):
+        with self.lock:
+            if beam not in self.locks:
+                self.locks[beam]=threading.Lock()
+            lock=self.locks[beam]
+        with lock:
+            if beam not in self.beams:
+                # [1,1,y,x] beams are viewed as [y,x], and broadcast explicitly along the rows of each tile
+                self.beams[beam]=np.array(image_tiles.image_view(fits.getdata(beam)),dtype=np.float32)
+        return self.beams[beam]
+
+def correct_pair(image,beam,output,divide=True,tile_rows=256):
+    '''Write output = image divided (or multiplied) by the (ny, nx) beam array, a tile of rows at a time.'''
+    header=fits.getheader(image)
+    shape=(header['NAXIS2'],header['NAXIS1'])
+    if beam.shape!=shape:
+        raise ValueError("Beam of shape "+str(beam.shape)+" does not match "+image+" of shape "+str(shape))
+    if divide:
+        factor=lambda rows,ra,dec: 1./beam[rows]
+    else:
+        factor=lambda rows,ra,dec: beam[rows]
+    image_tiles.apply_factors(image,output,factor,tile_rows=tile_rows,coords=False)
+    return output
+
 usage="Usage: %prog [options]\n"
 parser = OptionParser(usage=usage)
 parser.add_option('--input',type="string", dest="input",default=None,
@@ -15,13 +89,48 @@ parser.add_option('--output',type="string", dest="output",default=None,
                     help="The output filename (default = input_pb.fits).")
 parser.add_option('--beam',type="string", dest="beam",default=None,
                     help="The beam filename")
+parser.add_option('--manifest',type="string", dest="manifest",default=None,
+                    help="Text file of image beam [output] lines to correct as a batch, instead of --input and --beam (default = None).")
 parser.add_option('--divide',action="store_true",dest="divide",default=True,
                     help="Divide instead of multiply (default = True).")
 parser.add_option('--multiply',action="store_false",dest="divide",
                     help="Multiply instead of divide (default = False).")
+parser.add_option('--tile_rows','--tile-rows',dest="tile_rows",default=256,type=int,
+                    help="Number of rows corrected at a time (default = 256)")
+parser.add_option('--threads',dest="threads",default=1,type=int,
+                    help="Number of tiles of rows, or with --manifest of image/beam pairs, to correct at once, on separate threads (default = 1)")
 (options, args) = parser.parse_args()
 
-if options.input and options.beam:
+if options.manifest:
+    try:
+        pairs=read_manifest(options.manifest)
+    except (IOError,ValueError) as e:
+        print str(e)
+        sys.exit(1)
+    missing=[f for pair in pairs for f in pair[:2] if not os.path.exists(f)]
+    if missing:
+        print "Missing inputs: "+" ".join(sorted(set(missing)))
+        sys.exit(1)
+    pairs=group_by_beam(pairs)
+    beams=BeamCache(pairs)
+    def run(pair):
+        image,beam,output=pair
+        try:
+            return correct_pair(image,beams.get(beam),output,options.divide,options.tile_rows)
+        finally:
+            beams.release(beam)
+    if options.threads>1 and len(pairs)>1:
+        pool=ThreadPool(min(options.threads,len(pairs)))
+        try:
+            for output in pool.imap_unordered(run,pairs):
+                print "Wrote "+output
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for pair in pairs:
+            print "Wrote "+run(pair)
+elif options.input and options.beam:
     input=options.input
     beam=options.beam
     if os.path.exists(input) and os.path.exists(beam):
@@ -35,17 +144,33 @@ if options.input and options.beam:
     else:
         output=input.replace(".fits","_pb.fits")
     
-    if options.divide:
-        try:
-            hdu_in[0].data/=beam_in[0].data
-        except:
-# For flattened fits files
-            hdu_in[0].data/=beam_in[0].data[0][0]
+    try:
+        # Single images of the same size (allowing for degenerate frequency and Stokes axes)
+        # are corrected a tile of rows at a time, in place
+        image=image_tiles.image_view(hdu_in[0].data)
+        beam_image=image_tiles.image_view(beam_in[0].data)
+        tiled=(image.shape==beam_image.shape)
+    except ValueError:
+        tiled=False
+
+    if tiled:
+        def tile(rows):
+            if options.divide:
+                image[rows]/=beam_image[rows]
+            else:
+                image[rows]*=beam_image[rows]
+        image_tiles.run_tiles(tile,image.shape,options.tile_rows,options.threads)
     else:
+        # A single-plane beam is broadcast across the planes of the image; otherwise the
+        # shapes must match
         try:
-            hdu_in[0].data*=beam_in[0].data
-        except:
-            hdu_in[0].data*=beam_in[0].data[0][0]
+            beam_data=image_tiles.image_view(beam_in[0].data)
+        except ValueError:
+            beam_data=beam_in[0].data
+        if options.divide:
+            hdu_in[0].data/=beam_data
+        else:
+            hdu_in[0].data*=beam_data
     hdu_in.writeto(output,clobber=True)
 else:
     print "Input and beam must be specified."
@@ -0,0 +1,87 @@
+"""
+Sample a PSF map (or any 2D map) at sky positions
+
+Positions are converted to the 0-based pixel coordinates of the map with one
+vectorised WCS call, and the map is read with array arithmetic: nearest picks
+the pixel containing each position, and bilinear interpolates between the four
+surrounding pixel centres. Bilinear is NaN-aware: blank neighbours are left out
+and the weights of the others renormalised, so a position is only NaN if all
+four are blank. Positions off the map are NaN (edge='nan') or take the value at
+the nearest edge (edge='clamp'); positions which are not on the sky are NaN.
+
+It serves both mosaics, a tile of pixels at a time, and catalogues.
+
+Usage example
+====
+import psf_resample
+for rows, ra, dec in sky_coords.sky_tiles(w, mosaic.shape):
+    mosaic[rows] *= psf_resample.sample(blur, w_psf, ra, dec, method='bilinear')
+psf_ratio = psf_resample.sample(psf_map, w_psf, data['ra'], data['dec'], edge='clamp')
+====
+"""
+import numpy as np
+
+import sky_coords
+
+def pixel_coords(w, ra, dec):
+    '''0-based (x, y) pixel coordinates of (ra, dec) in the celestial axes of w.'''
+    return sky_coords.celestial(w).wcs_world2pix(np.asarray(ra, dtype=float), np.asarray(dec, dtype=float), 0)
+
+def _prepare(shape, x, y, edge):
+    '''Positions clamped onto the pixel centres, and the mask of those which are NaN.'''
+    ny, nx = shape
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    blank = ~(np.isfinite(x) & np.isfinite(y))
+    if edge == 'nan':
+        with np.errstate(invalid='ignore'):
+            blank |= (x < -0.5) | (x > nx - 0.5) | (y < -0.5) | (y > ny - 0.5)
+    elif edge != 'clamp':
+        raise ValueError("edge must be nan or clamp")
+    x = np.clip(np.where(blank, 0., x), 0, nx - 1)
+    y = np.clip(np.where(blank, 0., y), 0, ny - 1)
+    return x, y, blank
+
+def nearest(image, x, y, edge='nan'):
+    '''Value of the pixel of the 2D image containing each 0-based position (x, y).'''
+    image = np.asarray(image)
+    x, y, blank = _prepare(image.shape, x, y, edge)
+    values = image[np.floor(y + 0.5).astype(int), np.floor(x + 0.5).astype(int)].astype(float)
+    values[blank] = np.nan
+    return values
+
+def bilinear(image, x, y, edge='nan'):
+    '''Bilinear interpolation of the 2D image at each 0-based position (x, y), ignoring NaN pixels.'''
+    image = np.asarray(image)
+    ny, nx = image.shape
+    x, y, blank = _prepare(image.shape, x, y, edge)
+    x0 = np.floor(x).astype(int)
+    y0 = np.floor(y).astype(int)
+    fx = x - x0
+    fy = y - y0
+    x1 = np.minimum(x0 + 1, nx - 1)
+    y1 = np.minimum(y0 + 1, ny - 1)
+    total = np.zeros(x.shape)
+    weights = np.zeros(x.shape)
+    for xi, yi, wt in ((x0, y0, (1 - fx)*(1 - fy)), (x1, y0, fx*(1 - fy)),
+                       (x0, y1, (1 - fx)*fy), (x1, y1, fx*fy)):
+        v = image[yi, xi].astype(float)
+        good = np.isfinite(v) & (wt > 0)
+        total += wt*np.where(good, v, 0.)
+        weights += np.where(good, wt, 0.)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        values = total/weights
+    values[blank | (weights == 0)] = np.nan
+    return values
+
+def sample(image, w, ra, dec, method='nearest', edge='nan'):
+    '''
+    The 2D image, with celestial WCS w, at each (ra, dec), using nearest or bilinear; an
+    array of the shape of ra.
+    '''
+    x, y = pixel_coords(w, ra, dec)
+    if method == 'nearest':
+        return nearest(image, x, y, edge)
+    elif method == 'bilinear':
+        return bilinear(image, x, y, edge)
+    raise ValueError("method must be nearest or bilinear")
@@ -4,8 +4,9 @@ import numpy as np
 import os, sys, re
 
 from astropy.io.votable import writeto as writetoVO
-from astropy.table import Table, Column
-from astropy.io.votable import parse_single_table
+from astropy.table import Table, Column, vstack
+import sky_match
+import reference_index
 
 from optparse import OptionParser
 
@@ -37,58 +38,39 @@ else:
     outputfile=inputfile.replace(".vot","_psf.vot")
 
 # Read the VO table and start processing
+data=sky_match.read_table(inputfile)
 if options.isolate:
+# Drop sources with a neighbour within 10 arcmin
+    data=data[sky_match.isolated(data['ra'],data['dec'],600.)]
     sparse=re.sub(".vot","_isolated.vot",inputfile)
-    os.system('stilts tmatch1 matcher=sky values="ra dec" params=600 \
-               action=keep0 in='+inputfile+' out='+sparse)
-else:
-    sparse=inputfile
+    data.write(sparse,format='votable',overwrite=True)
 
 if options.usemrc:
     catdir=os.environ['MWA_CODE_BASE']+'/MWA_Tools/catalogues'
     MRCvot=catdir+"/MRC.vot"
     VLSSrvot=catdir+"/VLSSr.vot"
+# Only basic aegean headings are kept from the matches
+    keepcols=['ra','dec','peak_flux','err_peak_flux','int_flux','err_int_flux','local_rms','a','err_a','b','err_b','pa','err_pa','residual_std','flags']
 # GLEAM: Get rid of crazy-bright sources, really super-extended sources, and sources with high residuals after fit
-    os.system('stilts tpipe in='+sparse+' cmd=\'select ((local_rms<1.0)&&((int_flux/peak_flux)<2)&&((residual_std/peak_flux)<0.1))\' out=temp_crop.vot')
+    crop=data[np.ma.filled((data['local_rms']<1.0)&((data['int_flux']/data['peak_flux'])<2)&((data['residual_std']/data['peak_flux'])<0.1),False)]
 # MRC: get point like sources (MFLAG is blank)
-    Mmatchvot=re.sub(".vot","_MRC.vot",sparse)
-    os.system('stilts tpipe in='+MRCvot+' cmd=\'select NULL_MFLAG\' cmd=\'addcol PA_MRC "0.0"\' out=mrc_temp.vot')
+    mrc=reference_index.point_sources(reference_index.load(MRCvot)).table
 # Use only isolated sources
-    os.system('stilts tmatch1 matcher=sky values="_RAJ2000 _DEJ2000" params=600 \
-               action=keep0 in=mrc_temp.vot out=mrc_crop.vot')
+    mrc=mrc[sky_match.isolated(mrc['_RAJ2000'],mrc['_DEJ2000'],600.)]
 # Match GLEAM with MRC
-    os.system('stilts tmatch2 matcher=skyellipse params=30 in1=mrc_crop.vot in2=temp_crop.vot out=temp_mrc_match.vot values1="_RAJ2000 _DEJ2000 2*e_RA2000 2*e_DE2000 PA_MRC" values2="ra dec 2*a 2*b pa" ofmt=votable')
-# Keep only basic aegean headings
-    os.system('stilts tpipe in=temp_mrc_match.vot cmd=\'keepcols "ra dec peak_flux err_peak_flux int_flux err_int_flux local_rms a err_a b err_b pa err_pa residual_std flags"\' out='+Mmatchvot)
+    Mmatch=sky_match.match_ellipses(mrc,crop,
+        values1=('_RAJ2000','_DEJ2000',2*sky_match.positions(mrc['e_RA2000']),2*sky_match.positions(mrc['e_DE2000']),0.),
+        values2=('ra','dec',2*sky_match.positions(crop['a']),2*sky_match.positions(crop['b']),'pa'))
 
 # VLSSr: get point-like sources (a and b are < 86", same resolution as MRC); only sources North of Dec +20
-    Vmatchvot=re.sub(".vot","_VLSSr.vot",sparse)
-    os.system('stilts tpipe in='+VLSSrvot+' cmd=\'select ((MajAx<.02389)&&(MinAx<0.02389)&&(_DEJ2000>0)) \' out=vlssr_temp.vot')
+    vlssr=reference_index.load(VLSSrvot).table
+    vlssr=vlssr[np.ma.filled((vlssr['MajAx']<.02389)&(vlssr['MinAx']<0.02389)&(vlssr['_DEJ2000']>0),False)]
 # Use only isolated sources
-    os.system('stilts tmatch1 matcher=sky values="_RAJ2000 _DEJ2000" params=600 \
-               action=keep0 in=vlssr_temp.vot out=vlssr_crop.vot')
+    vlssr=vlssr[sky_match.isolated(vlssr['_RAJ2000'],vlssr['_DEJ2000'],600.)]
 # Match GLEAM with VLSSr
-    os.system('stilts tmatch2 matcher=sky params=120 in1=vlssr_crop.vot in2=temp_crop.vot out=temp_vlssr_match.vot values1="_RAJ2000 _DEJ2000" values2="ra dec" ofmt=votable')
-# Keep only basic aegean headings
-    os.system('stilts tpipe in=temp_vlssr_match.vot cmd=\'keepcols "ra dec peak_flux err_peak_flux int_flux err_int_flux local_rms a err_a b err_b pa_2 err_pa residual_std flags"\' out='+Vmatchvot)
+    Vmatch=sky_match.match(vlssr,crop,120.,ra1='_RAJ2000',dec1='_DEJ2000')
 # Concatenate the MRC and VLSSr matched tables together
-    os.system('stilts tcat in='+Mmatchvot+' in='+Vmatchvot+' out='+outputfile)
-
-    os.remove('temp_crop.vot')
-    os.remove('mrc_temp.vot')
-    os.remove('mrc_crop.vot')
-    os.remove('temp_mrc_match.vot')
-    os.remove('vlssr_temp.vot')
-    os.remove('vlssr_crop.vot')
-    os.remove('temp_vlssr_match.vot')
-    os.remove(Mmatchvot)
-    os.remove(Vmatchvot)
-
-    table = parse_single_table(outputfile)
-    data = table.array
-else:
-    table = parse_single_table(sparse)
-    data = table.array
+    data=vstack([Mmatch[keepcols],Vmatch[keepcols]])
 
 x=data['ra']
 if max(x)>360.:
@@ -98,11 +80,8 @@ y=data['dec']
     
 # Downselect to unresolved sources
 
-mask=[]
 # Filter out any sources where Aegean's flags weren't zero
-indices=np.where((data['flags']==0) & ((data['peak_flux']/data['local_rms'])>=options.minsnr))
-mask.extend(indices[0])
-mask=np.array(mask)
+mask=np.where(np.ma.filled((data['flags']==0) & ((data['peak_flux']/data['local_rms'])>=options.minsnr),False))[0]
 
 vot = Table(data[mask])
 vot.description = "Sources selected for PSF calculation."
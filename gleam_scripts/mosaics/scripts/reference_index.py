@@ -0,0 +1,227 @@
+"""
+Build-once binary index of a reference catalogue (MRC, VLSSr, marco_all_VLSSsrcs)
+
+The snapshot corrections parse the same reference VOTable for every obsid and
+then select and extrapolate it again. load() parses the catalogue once and
+saves its columns, with their masks and units, to an uncompressed .npz next to
+it (or in cache_dir), which later runs read back in milliseconds. The sources
+are stored in order of equal-area sky cells (HEALPix-like: bands of equal width
+in sin(Dec), each split equally in RA), so neighbours on the sky are neighbours
+in the arrays, together with their unit vectors. The KD-tree is rebuilt from
+these on first use; that takes milliseconds, and unlike a pickled tree does not
+depend on the scipy version.
+
+The index records the size, modification time and SHA-1 of the catalogue. It
+is rebuilt when the size or time differ, unless the contents hash the same
+(after a touch, rsync or copy), in which case it is saved again with the new
+time so that later runs need not hash the catalogue. If the index cannot be
+written, the catalogue is used from memory.
+
+point_sources() and mrc_match() are the MRC selection and crossmatch shared by
+correct_mrc.py, correct_mrc_snapshot.py, correct_mrc_flux.py and
+correct_mrc_peaks.py.
+
+Usage example
+====
+import reference_index
+mrc = reference_index.point_sources(reference_index.load(MRCvot))
+match = reference_index.mrc_match(mrc, sky_match.read_table('snapshot_comp.vot'), 154.88e6)
+vlssr = reference_index.load(VLSSrvot).table
+====
+"""
+import os
+import hashlib
+import numpy as np
+from scipy.spatial import cKDTree
+from astropy.table import Table, Column, MaskedColumn
+import sky_match
+
+INDEX_VERSION = 1
+
+def sky_cells(ra, dec, nside=64):
+    '''
+    Equal-area sky cell of each position (in degrees): 2*nside bands of equal width in sin(Dec)
+    from the south pole, each split into 4*nside cells in RA. Positions not finite come last.
+    '''
+    ra = np.asarray(ra, dtype=float)
+    dec = np.asarray(dec, dtype=float)
+    good = np.isfinite(ra) & np.isfinite(dec)
+    with np.errstate(invalid='ignore'):
+        band = np.clip(np.floor((np.sin(np.radians(np.where(good, dec, 0.))) + 1.)*nside), 0, 2*nside - 1)
+        cell = np.clip(np.floor(np.mod(np.where(good, ra, 0.), 360.)/360.*4*nside), 0, 4*nside - 1)
+    return np.where(good, band*4*nside + cell, 8*nside*nside).astype(int)
+
+def file_hash(filename):
+    '''SHA-1 of the contents of filename.'''
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+def index_path(filename, cache_dir=None):
+    '''The .npz index of the catalogue filename.'''
+    root = os.path.splitext(os.path.basename(filename))[0] + '_index.npz'
+    return os.path.join(cache_dir if cache_dir else os.path.dirname(os.path.abspath(filename)), root)
+
+class ReferenceIndex(object):
+    '''
+    A reference catalogue in sky-cell order: table (astropy Table), the unit vectors and cells
+    of its positions, and tree, a KD-tree of them as returned by sky_match.sky_tree().
+    '''
+    def __init__(self, table, ra, dec, vectors, cells):
+        self.table = table
+        self.ra_name = ra
+        self.dec_name = dec
+        self.ra = sky_match.positions(table[ra])
+        self.dec = sky_match.positions(table[dec])
+        self.vectors = vectors
+        self.cells = cells
+        self._tree = None
+        self._ellipses = {}
+
+    @property
+    def tree(self):
+        if self._tree is None:
+            good = np.nonzero(np.isfinite(self.vectors).all(axis=1))[0]
+            self._tree = (cKDTree(self.vectors[good]), good)
+        return self._tree
+
+    def select(self, keep):
+        '''The index of the rows keep (a boolean mask or row numbers), in the same order.'''
+        return ReferenceIndex(self.table[keep], self.ra_name, self.dec_name, self.vectors[keep], self.cells[keep])
+
+    def ellipses(self, a, b, pa):
+        '''
+        (ra, dec, a, b, pa) of the error ellipses of the sources, with a, b and pa each a column
+        name or a constant, and their sky_match.ellipse_index(); built once for each (a, b, pa).
+        '''
+        key = (a, b, pa)
+        if key not in self._ellipses:
+            values = [self.ra, self.dec]
+            for v in (a, b, pa):
+                if isinstance(v, sky_match.string_types):
+                    values.append(sky_match.positions(self.table[v]))
+                else:
+                    values.append(float(v)*np.ones(len(self.table)))
+            self._ellipses[key] = (values, sky_match.ellipse_index(*values))
+        return self._ellipses[key]
+
+def _source_key(filename):
+    info = os.stat(filename)
+    return np.array([info.st_size, info.st_mtime], dtype=float)
+
+def _read_index(path, filename, ra, dec):
+    '''
+    (index, sha1): the ReferenceIndex saved at path, or None if it is missing or out of date,
+    and the SHA-1 of the catalogue if it only matched on that, i.e. its key needs updating.
+    '''
+    if not os.path.exists(path):
+        return None, None
+    saved = np.load(path)
+    try:
+        return _saved_index(saved, filename, ra, dec)
+    finally:
+        saved.close()
+
+def _saved_index(saved, filename, ra, dec):
+    if int(saved['version']) != INDEX_VERSION or [str(x) for x in saved['radec']] != [ra, dec]:
+        return None, None
+    key = _source_key(filename)
+    sha1 = None
+    if not np.array_equal(saved['key'], key):
+        if saved['key'][0] != key[0] or str(saved['sha1']) != file_hash(filename):
+            return None, None
+        sha1 = str(saved['sha1'])
+    columns = []
+    for name, unit in zip(saved['names'], saved['units']):
+        name = str(name)
+        data = saved['col:' + name]
+        if 'mask:' + name in saved.files:
+            columns.append(MaskedColumn(data, name=name, mask=saved['mask:' + name], unit=str(unit) or None))
+        else:
+            columns.append(Column(data, name=name, unit=str(unit) or None))
+    return ReferenceIndex(Table(columns), ra, dec, saved['vectors'], saved['cells']), sha1
+
+def _write_index(path, filename, index, sha1=None):
+    '''
+    Save index to path, through a temporary file so that concurrent jobs never read half of one.
+    sha1: of the catalogue, if already known.
+    '''
+    arrays = {'version': INDEX_VERSION, 'key': _source_key(filename), 'sha1': sha1 if sha1 else file_hash(filename),
+              'radec': np.array([index.ra_name, index.dec_name]), 'vectors': index.vectors, 'cells': index.cells}
+    names, units = [], []
+    for name in index.table.colnames:
+        col = index.table[name]
+        data = np.ma.filled(col, '' if col.dtype.kind in 'OSU' else 0) if hasattr(col, 'mask') else np.asarray(col)
+        if data.dtype.kind == 'O':
+            data = np.array([str(x) for x in data])
+        arrays['col:' + name] = data
+        mask = np.ma.getmaskarray(col)
+        if mask.any():
+            arrays['mask:' + name] = mask
+        names.append(name)
+        units.append(str(col.unit) if col.unit is not None else '')
+    arrays['names'] = np.array(names)
+    arrays['units'] = np.array(units)
+    temp = path.replace('.npz', '_' + str(os.getpid()) + '.npz')
+    np.savez(temp, **arrays)
+    os.rename(temp, path)
+
+def load(filename, ra='_RAJ2000', dec='_DEJ2000', cache_dir=None):
+    '''
+    The ReferenceIndex of the catalogue filename, with positions in the columns ra and dec,
+    from its saved index if that is up to date, and otherwise parsed and saved.
+    '''
+    path = index_path(filename, cache_dir)
+    index, sha1 = _read_index(path, filename, ra, dec)
+    if index is not None:
+        if sha1 is not None:
+            # Same contents with a new time: save the new key
+            try:
+                _write_index(path, filename, index, sha1)
+            except (IOError, OSError):
+                pass
+        return index
+    table = sky_match.read_table(filename)
+    cells = sky_cells(sky_match.positions(table[ra]), sky_match.positions(table[dec]))
+    order = np.argsort(cells, kind='mergesort')
+    table = table[order]
+    vectors = sky_match.unit_vectors(sky_match.positions(table[ra]), sky_match.positions(table[dec]))
+    index = ReferenceIndex(table, ra, dec, vectors, cells[order])
+    try:
+        _write_index(path, filename, index)
+    except (IOError, OSError):
+        pass
+    return index
+
+def point_sources(mrc):
+    '''The point-like MRC sources, i.e. with no MFLAG, as stilts select NULL_MFLAG.'''
+    mflag = mrc.table['MFLAG']
+    return mrc.select(np.ma.getmaskarray(mflag) | (np.char.strip(np.ma.filled(mflag, '').astype(str)) == ''))
+
+def mrc_match(mrc, catalogue, freq, flux='int_flux'):
+    '''
+    The matches of the MRC point_sources() with the catalogue sources with local_rms < 1.0, by
+    their error ellipses, as used by the MRC corrections. Sources with int_flux/peak_flux >= 2
+    or RA offsets of a degree or more are dropped. Columns are added for the MRC flux density
+    extrapolated to freq (Hz) with a spectral index of -0.85, S_<MHz>, and for
+    logratio=ln(S_<MHz>/flux), weight=flux/local_rms, delRA and delDec.
+    '''
+    freq_str = "%03.0f" % (freq/1e6)
+    catalogue = catalogue[np.ma.filled(catalogue['local_rms'] < 1.0, False)]
+    values, index = mrc.ellipses('e_RA2000', 'e_DE2000', 0.)
+    values2 = [sky_match.positions(catalogue[col]) for col in ('ra', 'dec', 'a', 'b', 'pa')]
+    i2, i1, score = sky_match.ellipse_pairs(*(values2 + values), index2=index)
+    keep = sky_match.select_pairs(i1, i2, score, 'best')
+    match = sky_match.join_pairs(mrc.table, catalogue, i1[keep], i2[keep], score[keep],
+                                 score_name='Score', score_unit=None)
+    # Exclude extended sources
+    match = match[np.ma.filled((match['int_flux']/match['peak_flux']) < 2, False)]
+    match['S_' + freq_str] = match['S408']*pow((freq/408000000.0), -0.85)
+    # weight is currently S/N
+    match['logratio'] = np.log(match['S_' + freq_str]/match[flux])
+    match['weight'] = match[flux]/match['local_rms']
+    match['delRA'] = match['_RAJ2000'] - match['ra']
+    match['delDec'] = match['_DEJ2000'] - match['dec']
+    return match[np.ma.filled(np.abs(match['delRA']) < 1.0, False)]
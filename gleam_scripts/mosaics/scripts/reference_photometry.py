@@ -0,0 +1,96 @@
+"""
+Reference photometry from the marco_all_VLSSsrcs crossmatches
+
+Reads the literature flux densities of a stilts crossmatch against
+marco_all_VLSSsrcs.fits and builds the flux and flux error matrices used for
+the SED fits: NaNs replaced by zero, 10% added to the VLSSr errors, the
+Slee (1977) uncertainties for the Culgoora points and Rengelink et al. (1997)
+for WSRT. Only the columns asked for are read, from a memory-mapped file.
+
+Usage example
+====
+import reference_photometry
+tbdata = reference_photometry.read_columns('marco_all_VLSSsrcs+'+input_mosaic+'.fits',
+    reference_photometry.reference_columns(wsrt=True) + ['int_flux_1', 'err_int_flux_1'])
+ref = reference_photometry.reference_fluxes(tbdata, wsrt=True)
+freq, flux, flux_err = reference_photometry.flux_stack(ref, freq_obs, tbdata['int_flux_1'], tbdata['err_int_flux_1'], wsrt=True)
+====
+"""
+import numpy as np
+from astropy.io import fits
+
+def reference_columns(wsrt=False):
+    '''Columns of marco_all_VLSSsrcs.fits needed by reference_fluxes().'''
+    columns = ['ID_vlss', 'RAJ2000_vlss', 'DEJ2000_vlss', 'RAJ2000', 'DEJ2000',
+               'S_vlss', 'e_S_vlss', 'S', 'e_S', 'S_sumss_north', 'e_S_sumss_north',
+               'S_mrc', 'e_S_mrc', 'S_culgoora160', 'S_culgoora80']
+    if wsrt:
+        columns.append('S_wsrt')
+    return columns
+
+def read_columns(filename, columns, ext=1):
+    '''
+    Read the named columns of a FITS table into a numpy record array. The file is
+    memory-mapped so that the columns which are not asked for are never converted.
+    '''
+    hdulist = fits.open(filename, memmap=True)
+    hdulist.verify('fix')
+    data = hdulist[ext].data
+    arrays = [np.array(data.field(column)) for column in columns]
+    hdulist.close()
+    return np.rec.fromarrays(arrays, names=[str(column) for column in columns])
+
+def nan_to_zero(x):
+    x = np.array(x, dtype=float)
+    x[np.isnan(x)] = 0.
+    return x
+
+def culgoora160_err(S_160):
+    '''Table 3 of Slee 1977, assuming the average of the two. Zero where there is no flux.'''
+    return np.select([S_160 <= 0, S_160 <= 3, S_160 <= 5, S_160 <= 12, S_160 <= 20],
+                     [0., 0.27*S_160, 0.23*S_160, 0.17*S_160, 0.10*S_160], 0.9*S_160)
+
+def culgoora80_err(S_80):
+    '''Table 3 of Slee 1977. Zero where there is no flux.'''
+    return np.select([S_80 <= 0, S_80 <= 10, S_80 <= 20],
+                     [0., 0.32*S_80, 0.20*S_80], 0.10*S_80)
+
+def reference_fluxes(tbdata, wsrt=False):
+    '''
+    Literature flux densities and errors, in Jy, as a dictionary keyed S_74, S_74_err, S_80, ...,
+    S_1400_err, plus the NVSS positions RA_NVSS and Dec_NVSS. Missing values are zero.
+    '''
+    ref = {}
+    ref['RA_NVSS'] = nan_to_zero(tbdata['RAJ2000'])
+    ref['Dec_NVSS'] = nan_to_zero(tbdata['DEJ2000'])
+    ref['S_74'] = np.array(tbdata['S_vlss'], dtype=float) # Integrated flux of VLSSr.
+    ref['S_74_err'] = np.sqrt(np.array(tbdata['e_S_vlss'], dtype=float)**2 + (ref['S_74']*0.1)**2)
+    ref['S_1400'] = nan_to_zero(tbdata['S'])
+    ref['S_1400_err'] = nan_to_zero(tbdata['e_S'])
+    ref['S_843_north'] = nan_to_zero(tbdata['S_sumss_north'])
+    ref['S_843_north_err'] = nan_to_zero(tbdata['e_S_sumss_north'])
+    ref['S_408'] = nan_to_zero(tbdata['S_mrc'])
+    ref['S_408_err'] = nan_to_zero(tbdata['e_S_mrc'])
+    ref['S_160'] = nan_to_zero(tbdata['S_culgoora160'])
+    ref['S_160_err'] = culgoora160_err(ref['S_160'])
+    ref['S_80'] = nan_to_zero(tbdata['S_culgoora80'])
+    ref['S_80_err'] = culgoora80_err(ref['S_80'])
+    if wsrt:
+        ref['S_325'] = nan_to_zero(tbdata['S_wsrt'])
+        with np.errstate(divide='ignore'):
+            ref['S_325_err'] = (0.06**2 + (4./ref['S_325'])**2)**0.5 # from eqn 9 Rengelink et al. (1997)
+    return ref
+
+def flux_stack(ref, freq_obs, S_obs, S_obs_err, wsrt=False):
+    '''
+    The frequencies and the (n_freq, n_src) flux and flux error matrices, with the
+    MWA measurement S_obs at freq_obs, in the order used by the SED fits.
+    '''
+    bands = [(74., 'S_74'), (80., 'S_80'), (160., 'S_160'), (freq_obs, None)]
+    if wsrt:
+        bands.append((325., 'S_325'))
+    bands += [(408., 'S_408'), (843., 'S_843_north'), (1400., 'S_1400')]
+    freq = np.array([f for f, key in bands])
+    flux = np.vstack([S_obs if key is None else ref[key] for f, key in bands])
+    flux_err = np.vstack([S_obs_err if key is None else ref[key+'_err'] for f, key in bands])
+    return freq, flux, flux_err
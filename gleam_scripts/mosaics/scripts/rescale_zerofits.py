@@ -4,45 +4,73 @@
 # As long as there is only one entry!
 
 import sys
+import shutil
 from numpy import nonzero
 from astropy.io import fits
 from optparse import OptionParser
+import fits_scale
 
-usage="Usage: %prog [options]\n"
-parser = OptionParser(usage=usage)
-parser.add_option('--mosaic',type="string", dest="mosaic",default=None,
-                    help="The filename of the mosaic you want to read in.")
-parser.add_option('--zerofits',type="string", dest="zerofits",default=None,
-                    help="The filename of the zerofits file you want to use.")
-parser.add_option('--output',type="string", dest="output",default=None,
-                    help="The output filename (default = input_rescaled.fits).")
-parser.add_option('--multiply',action="store_true",dest="multiply",default=True,
-                    help="Multiply instead of divide (default = True).")
-parser.add_option('--divide',action="store_false",dest="multiply",default=True,
-                    help="Divide instead of multiply (default = False).")
-(options, args) = parser.parse_args()
-
-if options.mosaic and options.zerofits:
-    input=options.mosaic
-    zerofits=options.zerofits
-
+def zerofits_factor(zerofits):
+    '''The first non-zero Zero_fit entry of a zerofits table.'''
     hdu_in=fits.open(zerofits)
     tbdata=hdu_in[1].data
     factor=tbdata.field('Zero_fit')[nonzero(tbdata.field('Zero_fit'))[0][0]]
+    hdu_in.close()
+    return factor
 
-    hdu_in=fits.open(input)
-    if options.output:
-        output=options.output
-    else:
-        output=input.replace(".fits","_rescaled.fits")
-    
-    if options.multiply:
-        print "Multiplying by a factor of "+str(factor)+"."
-        hdu_in[0].data*=factor
+if __name__ == '__main__':
+
+    usage="Usage: %prog [options]\n"
+    parser = OptionParser(usage=usage)
+    parser.add_option('--mosaic',type="string", dest="mosaic",default=None,
+                        help="The filename of the mosaic you want to read in.")
+    parser.add_option('--zerofits',type="string", dest="zerofits",default=None,
+                        help="The filename of the zerofits file you want to use.")
+    parser.add_option('--output',type="string", dest="output",default=None,
+                        help="The output filename (default = input_rescaled.fits).")
+    parser.add_option('--multiply',action="store_true",dest="multiply",default=True,
+                        help="Multiply instead of divide (default = True).")
+    parser.add_option('--divide',action="store_false",dest="multiply",default=True,
+                        help="Divide instead of multiply (default = False).")
+    parser.add_option('--bscale',action="store_true",dest="bscale",default=False,
+                        help="Record the factor in the BSCALE keyword instead of rewriting the pixels; the output is a copy of the input with only its header changed, so the copy still reads and writes every pixel unless --in_place is given (default = False).")
+    parser.add_option('--in_place',action="store_true",dest="in_place",default=False,
+                        help="With --bscale, rewrite the header of the input mosaic itself instead of writing an output file (default = False).")
+    (options, args) = parser.parse_args()
+
+    if options.mosaic and options.zerofits:
+        input=options.mosaic
+        zerofits=options.zerofits
+
+        factor=zerofits_factor(zerofits)
+
+        if options.output:
+            output=options.output
+        else:
+            output=input.replace(".fits","_rescaled.fits")
+
+        if options.bscale:
+            if options.multiply:
+                print "Multiplying by a factor of "+str(factor)+" in BSCALE."
+                scale=factor
+            else:
+                print "Dividing by a factor of "+str(factor)+" in BSCALE."
+                scale=1./factor
+            if options.in_place:
+                output=input
+            else:
+                shutil.copyfile(input,output)
+            fits_scale.rescale_file(output,scale,history="rescale_zerofits.py: multiplied by "+str(scale)+" from "+zerofits,comment="flux scale from "+zerofits)
+            sys.exit(0)
+
+        hdu_in=fits.open(input)
+        if options.multiply:
+            print "Multiplying by a factor of "+str(factor)+"."
+            hdu_in[0].data*=factor
+        else:
+            print "Dividing by a factor of "+str(factor)+"."
+            hdu_in[0].data/=factor
+        hdu_in.writeto(output,clobber=True)
     else:
-        print "Dividing by a factor of "+str(factor)+"."
-        hdu_in[0].data/=factor
-    hdu_in.writeto(output,clobber=True)
-else:
-    print "Mosaic and zerofits file to use must be specified."
-    sys.exit(1)
+        print "Mosaic and zerofits file to use must be specified."
+        sys.exit(1)
@@ -0,0 +1,76 @@
+"""
+Batched power-law SED fitting
+
+Fits S = a*nu^alpha to every source of a crossmatched table in one pass,
+using the closed-form weighted least-squares solution in log space instead
+of one scipy.optimize.curve_fit call per source.
+
+Usage example
+====
+import sed_fit
+amp, alpha, cov, chisq, redchisq, npts = sed_fit.fit_powlaw(freq, flux, flux_err, use=fitmask)
+====
+"""
+import numpy as np
+
+def powlaw(freq, a, alpha): # defining powlaw as S = a*nu^alpha.
+    return a*(freq**alpha)
+
+def fit_powlaw(freq, flux, flux_err, use=None):
+    '''
+    Fit a power law to every column of the (n_freq, n_src) flux and flux_err stacks.
+
+    freq: (n_freq,) frequencies in MHz.
+    use: optional boolean mask, (n_freq,) or (n_freq, n_src), of points to include.
+    Points with non-positive or non-finite flux or error are always excluded.
+
+    Returns amp, alpha, cov, chisq, redchisq, npts; all (n_src,) except cov, which is
+    the (n_src, 2, 2) covariance of (amp, alpha). chisq is evaluated in linear flux space,
+    as the per-source redchisq() in the scripts does. Sources with fewer than two usable
+    points are returned as NaN.
+    '''
+    freq = np.asarray(freq, dtype=float)
+    flux = np.asarray(flux, dtype=float)
+    flux_err = np.asarray(flux_err, dtype=float)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        good = np.isfinite(flux) & np.isfinite(flux_err) & (flux > 0) & (flux_err > 0)
+        if use is not None:
+            use = np.asarray(use, dtype=bool)
+            if use.ndim == 1:
+                use = use[:, np.newaxis]
+            good &= use
+
+        # Error propagation: error on log(S) = err_S/S
+        x = np.log(freq)[:, np.newaxis]
+        y = np.where(good, np.log(flux), 0.)
+        w = np.where(good, (flux/flux_err)**2, 0.)
+
+    S = w.sum(axis=0)
+    Sx = (w*x).sum(axis=0)
+    Sxx = (w*x*x).sum(axis=0)
+    Sy = (w*y).sum(axis=0)
+    Sxy = (w*x*y).sum(axis=0)
+    npts = good.sum(axis=0)
+
+    det = S*Sxx - Sx**2
+    ok = (npts >= 2) & (det > 0)
+    det = np.where(ok, det, np.nan)
+
+    alpha = (S*Sxy - Sx*Sy)/det
+    amp = np.exp((Sxx*Sy - Sx*Sxy)/det)
+
+    # Covariance of (ln a, alpha), propagated to (a, alpha)
+    cov = np.empty((len(npts), 2, 2))
+    cov[:, 0, 0] = amp**2 * Sxx/det
+    cov[:, 0, 1] = cov[:, 1, 0] = -amp * Sx/det
+    cov[:, 1, 1] = S/det
+
+    with np.errstate(invalid='ignore', over='ignore'):
+        model = powlaw(freq[:, np.newaxis], amp, alpha)
+        resid = np.where(good, (flux - model)/np.where(good, flux_err, 1.), 0.)
+    chisq = np.where(ok, (resid**2).sum(axis=0), np.nan)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        redchisq = chisq/(npts - 2)
+
+    return amp, alpha, cov, chisq, redchisq, npts
@@ -0,0 +1,382 @@
+"""
+Batched posterior uncertainties for power-law SED fits
+
+Replaces the per-source emcee runs used to put errors on the model flux density
+at the observing frequency. The log-likelihood of every walker of every source is
+evaluated in one array operation, and the affine-invariant stretch move of
+emcee (Goodman & Weare 2010) is applied to all sources at once. An analytic
+Laplace (covariance) approximation and the original per-source emcee run are
+also available.
+
+Given per-source seeds, every source draws from its own random stream, so the
+results do not depend on how the sources are chunked or spread over processes.
+
+Usage example
+====
+import sed_posterior
+seeds = sed_posterior.source_seeds(VLSSr_Name)
+pred_err, alpha = sed_posterior.predicted_flux_err(freq, flux, flux_err, fitmask, amp, alpha, freq_obs, seeds=seeds, cores=4)
+====
+"""
+import multiprocessing
+import zlib
+import numpy as np
+import scipy.optimize as opt
+
+methods = ['mcmc', 'laplace', 'emcee']
+
+def powlaw(freq, a, alpha): # defining powlaw as S = a*nu^alpha.
+    return a*(freq**alpha)
+
+def source_seeds(names):
+    '''Stable 32-bit seeds from source names, e.g. the VLSSr IDs.'''
+    seeds = []
+    for name in names:
+        if not isinstance(name, bytes):
+            name = str(name).encode('utf-8')
+        seeds.append(zlib.crc32(name.strip()) & 0xffffffff)
+    return np.array(seeds, dtype=np.int64)
+
+class SourceStreams(object):
+    '''
+    One RandomState per source, with the subset of the RandomState interface used by
+    stretch_sample. The first dimension of every requested shape runs over sources, and each
+    source's block is drawn from its own stream in one call.
+    '''
+    def __init__(self, seeds):
+        self.states = [np.random.RandomState(seed) for seed in seeds]
+
+    def __getitem__(self, index):
+        new = SourceStreams([])
+        new.states = [self.states[i] for i in np.arange(len(self.states))[index]]
+        return new
+
+    def rand(self, nsrc, *shape):
+        return np.array([rs.rand(*shape) for rs in self.states])
+
+    def randn(self, nsrc, *shape):
+        return np.array([rs.randn(*shape) for rs in self.states])
+
+def lnlike(theta, x, y, inv_sigma, lnnorm):
+    '''
+    Log-likelihood of the power law for a batch of walkers.
+    theta: (n_src, n_walkers, 2); y, inv_sigma: (n_src, n_freq), inv_sigma zero for unused points.
+    lnnorm: (n_src,) sum of log(inv_sigma) over the used points.
+    '''
+    model = powlaw(x, theta[..., 0, np.newaxis], theta[..., 1, np.newaxis])
+    with np.errstate(invalid='ignore', over='ignore'):
+        chisq = np.sum((y[:, np.newaxis, :] - model)**2 * inv_sigma[:, np.newaxis, :], axis=-1)
+    return -0.5*(chisq - lnnorm[:, np.newaxis])
+
+def lnprior(theta, popt):
+    '''
+    Box prior around the least-squares fit, as used in the per-source runs:
+    a/100 < S_norm < a*100 and |alpha/100| < |specind| < |alpha*100|.
+    '''
+    S_norm, specind = theta[..., 0], theta[..., 1]
+    a = popt[:, 0, np.newaxis]
+    alpha = np.abs(popt[:, 1, np.newaxis])
+    inside = (a/100. < S_norm) & (S_norm < a*100.) & (alpha/100. < np.abs(specind)) & (np.abs(specind) < alpha*100.)
+    return np.where(inside, 0., -np.inf)
+
+def _lnprob(theta, popt, x, y, inv_sigma, lnnorm):
+    lp = lnprior(theta, popt)
+    ll = lnlike(theta, x, y, inv_sigma, lnnorm)
+    return np.where(np.isfinite(lp), lp + ll, -np.inf)
+
+def _design(freq, flux, flux_err, use):
+    '''Transpose the (n_freq, n_src) stacks to per-source rows with zero weight on unused points.'''
+    use = np.asarray(use, dtype=bool)
+    if use.ndim == 1:
+        use = np.repeat(use[:, np.newaxis], flux.shape[1], axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        inv_sigma = np.where(use & (flux_err > 0), 1.0/flux_err**2, 0.).T
+        lnnorm = np.sum(np.where(inv_sigma > 0, np.log(inv_sigma), 0.), axis=1)
+    y = np.where(use, flux, 0.).T
+    return y, inv_sigma, lnnorm
+
+def ml_powlaw(freq, y, inv_sigma, popt, niter=50):
+    '''
+    Maximum likelihood (S_norm, specind) for every source by damped Gauss-Newton
+    (Levenberg-Marquardt) iterations started from popt. Returns (n_src, 2) and the
+    (n_src, 2, 2) inverse Hessian of -lnlike at the solution.
+    '''
+    x = np.asarray(freq, dtype=float)
+    lnx = np.log(x)
+    theta = np.array(popt, dtype=float)
+    lam = np.ones(len(theta))*1e-3
+
+    def chisq(t):
+        model = powlaw(x, t[:, 0, np.newaxis], t[:, 1, np.newaxis])
+        return np.sum((y - model)**2 * inv_sigma, axis=1)
+
+    def normal_eqs(t):
+        xa = x**t[:, 1, np.newaxis]
+        model = t[:, 0, np.newaxis]*xa
+        J = np.dstack((xa, model*lnx))
+        JTW = J*inv_sigma[..., np.newaxis]
+        A = np.einsum('nfi,nfj->nij', JTW, J)
+        g = np.einsum('nfi,nf->ni', JTW, y - model)
+        return A, g
+
+    # Each source stops updating once its own step is negligible, so a source's result
+    # does not depend on which other sources it is batched with.
+    active = np.ones(len(theta), dtype=bool)
+    with np.errstate(invalid='ignore', over='ignore', divide='ignore'):
+        current = chisq(theta)
+        for it in range(niter):
+            A, g = normal_eqs(theta)
+            damped = A.copy()
+            damped[:, 0, 0] *= 1. + lam
+            damped[:, 1, 1] *= 1. + lam
+            det = damped[:, 0, 0]*damped[:, 1, 1] - damped[:, 0, 1]*damped[:, 1, 0]
+            step = np.empty_like(theta)
+            step[:, 0] = (damped[:, 1, 1]*g[:, 0] - damped[:, 0, 1]*g[:, 1])/det
+            step[:, 1] = (damped[:, 0, 0]*g[:, 1] - damped[:, 1, 0]*g[:, 0])/det
+            trial = theta + step
+            new = chisq(trial)
+            better = active & np.isfinite(new) & (new <= current)
+            theta = np.where(better[:, np.newaxis], trial, theta)
+            current = np.where(better, new, current)
+            lam = np.where(better, lam/10., lam*10.)
+            converged = np.all(np.abs(step) <= 1e-10*np.abs(theta) + 1e-14, axis=1)
+            active &= ~(converged | ~np.isfinite(step).all(axis=1))
+            if not np.any(active):
+                break
+
+        A, g = normal_eqs(theta)
+        det = A[:, 0, 0]*A[:, 1, 1] - A[:, 0, 1]*A[:, 1, 0]
+        cov = np.empty_like(A)
+        cov[:, 0, 0] = A[:, 1, 1]/det
+        cov[:, 1, 1] = A[:, 0, 0]/det
+        cov[:, 0, 1] = cov[:, 1, 0] = -A[:, 0, 1]/det
+    return theta, cov
+
+def integrated_time(chain, c=5.):
+    '''
+    Integrated autocorrelation time, in steps, of a batch of ensembles.
+    chain: (n_steps, n_src, n_walkers, n_dim). The autocorrelation function is averaged over
+    walkers and summed up to the automatic window of Sokal (1989), as in emcee.autocorr.
+    Returns (n_src,), the largest time over the parameters.
+    '''
+    nsteps = chain.shape[0]
+    x = chain - chain.mean(axis=0)
+    nfft = 1
+    while nfft < 2*nsteps:
+        nfft *= 2
+    f = np.fft.rfft(x, n=nfft, axis=0)
+    acf = np.fft.irfft(f*np.conj(f), n=nfft, axis=0)[:nsteps]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        acf = np.nan_to_num(acf/acf[0]).mean(axis=2) # (n_steps, n_src, n_dim)
+    taus = 2.*np.cumsum(acf, axis=0) - 1.
+    window = np.arange(nsteps)[:, np.newaxis, np.newaxis] >= c*taus
+    m = np.where(window.any(axis=0), window.argmax(axis=0), nsteps - 1)
+    tau = taus[m, np.arange(taus.shape[1])[:, np.newaxis], np.arange(taus.shape[2])]
+    return np.max(tau, axis=-1)
+
+def stretch_sample(lnprob, pos, nsteps, burn, a=2., random_state=np.random,
+                   n_independent=None, check_every=25, tau_factor=10., block_size=2**24):
+    '''
+    Affine-invariant ensemble sampler applied to many independent ensembles at once.
+    pos: (n_src, n_walkers, n_dim) starting positions. lnprob(theta, index) maps the walkers
+    (n_active, n_walkers, n_dim) of the sources index to (n_active, n_walkers).
+
+    Every ensemble runs nsteps steps and the first burn are discarded, unless n_independent is
+    given. Then, every check_every steps, the first half of each chain is treated as burn-in
+    and a source stops once the rest is longer than tau_factor autocorrelation times, holds
+    n_independent independent samples, and its autocorrelation time has changed by less than
+    10% since the last check; nsteps is the cap.
+
+    The uniform deviates of the moves (stretch factor, partner and acceptance of every walker)
+    are drawn for a block of steps at a time, all the steps if the block holds no more than
+    block_size numbers, so a SourceStreams is called once per block rather than every step.
+
+    Returns the chain (nsteps, n_src, n_walkers, n_dim) and, per source, the number of steps
+    run, the burn-in to discard and the autocorrelation time.
+    '''
+    p = np.array(pos, dtype=float)
+    nsrc, nwalkers, ndim = p.shape
+    # At least the last step is kept
+    burn = max(0, min(burn, nsteps - 1))
+    half = nwalkers//2
+    chain = np.empty((nsteps, nsrc, nwalkers, ndim))
+    steps = np.zeros(nsrc, dtype=int) + nsteps
+    burns = np.zeros(nsrc, dtype=int) + burn
+    tau = np.zeros(nsrc)
+    act = np.arange(nsrc)
+    rs = random_state
+    lp = lnprob(p, act)
+    nblock = max(1, min(nsteps, block_size//(3*nwalkers*max(nsrc, 1))))
+    for step in range(nsteps):
+        if step % nblock == 0:
+            # (n_active, steps, stretch/partner/acceptance, walkers)
+            block = rs.rand(len(act), min(nblock, nsteps - step), 3, nwalkers)
+        u = block[:, step % nblock]
+        rows = np.arange(len(act))[:, np.newaxis]
+        for first, second in ((slice(0, half), slice(half, nwalkers)), (slice(half, nwalkers), slice(0, half))):
+            s = p[act, first]
+            c = p[act, second]
+            nc = c.shape[1]
+            z = ((a - 1.)*u[:, 0, first] + 1.)**2 / a
+            cc = c[rows, (u[:, 1, first]*nc).astype(int)]
+            q = cc - z[..., np.newaxis]*(cc - s)
+            newlp = lnprob(q, act)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                lnpdiff = (ndim - 1.)*np.log(z) + newlp - lp[act, first]
+                accept = lnpdiff > np.log(u[:, 2, first])
+            p[act, first] = np.where(accept[..., np.newaxis], q, s)
+            lp[act, first] = np.where(accept, newlp, lp[act, first])
+        chain[step, act] = p[act]
+
+        if n_independent is not None and (step + 1) % check_every == 0 and step + 1 < nsteps:
+            # Estimate tau on the second half of the chain, clear of the initial expansion
+            # of the walkers, and only trust it once it has settled between checks.
+            b = (step + 1)//2
+            t = integrated_time(chain[b:step + 1, act])
+            with np.errstate(divide='ignore', invalid='ignore'):
+                done = ((step + 1 - b >= tau_factor*t) & (np.abs(t - tau[act]) < 0.1*t) &
+                        (nwalkers*(step + 1 - b)/t >= n_independent))
+            tau[act] = t
+            steps[act[done]] = step + 1
+            burns[act[done]] = b
+            act = act[~done]
+            block = block[~done]
+            if len(act) == 0:
+                break
+            if isinstance(random_state, SourceStreams):
+                rs = random_state[act]
+
+    if len(act):
+        tau[act] = integrated_time(chain[burn:, act])
+    return chain, steps, np.minimum(burns, steps - 1), tau
+
+def _emcee_one(x, y, yerr, popt, freq_pred, nwalkers, nsteps, burn, ndraw, rs):
+    # The original per-source run, kept as a reference implementation.
+    import emcee
+
+    def lnlike_one(theta, x, y, yerr):
+        S_norm, specind = theta
+        model = powlaw(x, S_norm, specind)
+        inv_sigma = 1.0/(yerr**2)
+        return -0.5*(np.sum((y-model)**2*inv_sigma - np.log(inv_sigma)))
+
+    def lnprob_one(theta, x, y, yerr):
+        S_norm, specind = theta
+        if popt[0]/100. < S_norm < popt[0]*100. and abs(popt[1]/100.) < abs(specind) < abs(popt[1]*100.):
+            return lnlike_one(theta, x, y, yerr)
+        return -np.inf
+
+    nll = lambda *args: -lnlike_one(*args)
+    result = opt.fmin(nll, list(popt), args=(x, y, yerr), full_output='true', disp=False)
+    ndim = 2
+    pos = [result[0] + 1e-4*rs.randn(ndim) for p in range(nwalkers)]
+    sampler = emcee.EnsembleSampler(nwalkers, ndim, lnprob_one, args=(x, y, yerr))
+    sampler.random_state = rs.get_state()
+    sampler.run_mcmc(pos, nsteps)
+    samples = sampler.chain[:, burn:, :].reshape((-1, ndim))
+    draws = samples[rs.randint(len(samples), size=ndraw)]
+    lower, upper = np.percentile(powlaw(freq_pred, draws[:, 0], draws[:, 1]), [16, 84])
+    tau = integrated_time(sampler.chain[:, burn:, :].transpose(1, 0, 2)[:, np.newaxis])[0]
+    return upper - lower, np.percentile(samples[:, 1], 50), tau
+
+def _posterior_chunk(args):
+    '''Errors for one chunk of sources; module level so that it can be sent to a worker process.'''
+    method, freq, y, inv_sigma, lnnorm, popt, freq_pred, nwalkers, nsteps, burn, ndraw, seeds, adaptive = args
+    n = len(popt)
+    if seeds is None:
+        random_state = np.random.mtrand._rand
+    else:
+        random_state = SourceStreams(seeds)
+
+    if method == 'emcee':
+        pred_err, alpha_post, tau = np.zeros(n), np.zeros(n), np.zeros(n)
+        for i in range(n):
+            m = inv_sigma[i] > 0
+            rs = random_state if seeds is None else random_state.states[i]
+            pred_err[i], alpha_post[i], tau[i] = _emcee_one(freq[m], y[i][m], inv_sigma[i][m]**-0.5, popt[i],
+                                                            freq_pred, nwalkers, nsteps, burn, ndraw, rs)
+        return pred_err, alpha_post, np.zeros(n, dtype=int) + nsteps, tau
+
+    theta_ml, cov = ml_powlaw(freq, y, inv_sigma, popt)
+
+    if method == 'laplace':
+        S_ml, alpha_ml = theta_ml[:, 0], theta_ml[:, 1]
+        grad = np.column_stack((freq_pred**alpha_ml, S_ml*freq_pred**alpha_ml*np.log(freq_pred)))
+        var = np.einsum('ni,nij,nj->n', grad, cov, grad)
+        return 2.*np.sqrt(var), alpha_ml, np.zeros(n, dtype=int), np.zeros(n)
+
+    pos = theta_ml[:, np.newaxis, :] + 1e-4*random_state.randn(n, nwalkers, 2)
+    lnprob = lambda t, index: _lnprob(t, popt[index], freq, y[index], inv_sigma[index], lnnorm[index])
+    # Drawn before sampling, which may use more of each stream than the steps it keeps
+    pick = random_state.rand(n, ndraw)
+    if adaptive is None:
+        chain, steps, burns, tau = stretch_sample(lnprob, pos, nsteps, burn, random_state=random_state)
+    else:
+        n_independent, check_every = adaptive
+        chain, steps, burns, tau = stretch_sample(lnprob, pos, nsteps, burn, random_state=random_state,
+                                                  n_independent=n_independent, check_every=check_every)
+
+    # Draw ndraw of each source's post burn-in samples (steps x walkers) at random
+    nkeep = (steps - burns)*nwalkers
+    k = (pick*nkeep[:, np.newaxis]).astype(int)
+    draws = chain[burns[:, np.newaxis] + k//nwalkers, np.arange(n)[:, np.newaxis], k % nwalkers]
+    lower, upper = np.percentile(powlaw(freq_pred, draws[..., 0], draws[..., 1]), [16, 84], axis=1)
+    alpha_post = np.array([np.percentile(chain[burns[i]:steps[i], i, :, 1], 50) for i in range(n)])
+    return upper - lower, alpha_post, steps, tau
+
+def predicted_flux_err(freq, flux, flux_err, use, amp, alpha, freq_pred, method='mcmc',
+                       nwalkers=100, nsteps=500, burn=200, ndraw=100, chunk_size=100,
+                       seeds=None, cores=1, n_independent=None, check_every=25):
+    '''
+    Uncertainty on the power-law model flux density at freq_pred for every source.
+
+    freq, flux, flux_err, use: as for sed_fit.fit_powlaw, (n_freq,) and (n_freq, n_src).
+    amp, alpha: (n_src,) least-squares fit, used to centre the prior and start the walkers.
+    method: 'mcmc' for the batched ensemble sampler, 'laplace' for the covariance at the
+    maximum likelihood, or 'emcee' for one emcee run per source.
+    seeds: optional (n_src,) seeds, see source_seeds(). Each source then has its own random
+    stream and the results are reproducible whatever chunk_size and cores are.
+    cores: number of worker processes the chunks of chunk_size sources are shared between.
+    n_independent: stop each source's 'mcmc' chain once it holds this many independent
+    samples, checking every check_every steps, with nsteps as the cap (see stretch_sample).
+    burn: steps discarded from fixed-length chains, at most half of nsteps.
+
+    The error is the 84th minus 16th percentile of the model flux density at freq_pred over
+    ndraw posterior samples (for 'laplace', twice the propagated standard deviation).
+    Returns pred_err, the posterior median (maximum likelihood for 'laplace') of alpha, the
+    number of steps run and the autocorrelation time in steps, in the order of the input sources.
+    '''
+    if method not in methods:
+        raise ValueError("method must be one of "+", ".join(methods))
+    if nsteps < 1:
+        raise ValueError("nsteps must be at least 1")
+    burn = min(burn, nsteps//2)
+    freq = np.asarray(freq, dtype=float)
+    flux = np.asarray(flux, dtype=float)
+    flux_err = np.asarray(flux_err, dtype=float)
+    popt = np.column_stack((amp, alpha)).astype(float)
+    nsrc = len(popt)
+    if nsrc == 0:
+        return np.zeros(0), np.zeros(0), np.zeros(0, dtype=int), np.zeros(0)
+    if seeds is None and cores > 1:
+        # Forked workers would otherwise share the same global random state
+        seeds = np.random.randint(2**31, size=nsrc)
+    adaptive = None if n_independent is None else (n_independent, check_every)
+
+    y, inv_sigma, lnnorm = _design(freq, flux, flux_err, use)
+
+    jobs = []
+    for start in range(0, nsrc, chunk_size):
+        sl = slice(start, min(start + chunk_size, nsrc))
+        jobs.append((method, freq, y[sl], inv_sigma[sl], lnnorm[sl], popt[sl], freq_pred,
+                     nwalkers, nsteps, burn, ndraw, None if seeds is None else seeds[sl], adaptive))
+
+    if cores > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(min(cores, len(jobs)))
+        results = pool.map(_posterior_chunk, jobs)
+        pool.close()
+        pool.join()
+    else:
+        results = [_posterior_chunk(job) for job in jobs]
+
+    return tuple(np.concatenate([r[j] for r in results]) for j in range(4))
@@ -8,6 +8,9 @@ import glob
 
 import astropy.io.fits as fits
 from astropy import wcs
+import sky_coords
+import dec_table
+import image_tiles
 
 #tables and votables
 from astropy.io.votable import parse_single_table
@@ -20,6 +23,18 @@ parser.add_option('--mosaic',type="string", dest="mosaic",
                     help="The filename of the mosaic you want to read in.")
 parser.add_option('--output',type="string", dest="output", default=None,
                     help="The output filename. Default = input_sigmoid.fits")
+parser.add_option('--coord_cache',type="string", dest="coord_cache", default=None,
+                    help="Directory in which to cache the RA/Dec maps of each projection, so that mosaics sharing it reuse them (default = no cache)")
+parser.add_option('--coord_cache_size',dest="coord_cache_size", default=20.,type=float,
+                    help="Maximum size of the coordinate cache in GB; the least recently used maps are deleted (default = 20)")
+parser.add_option('--dec_lookup',action="store_true",dest="dec_lookup",default=False,
+                    help="Evaluate the weight once per row if Dec is constant along the rows (e.g. CAR), or else on a 1D Dec grid interpolated at each pixel (default = False)")
+parser.add_option('--dec_step',dest="dec_step",default=0.001,type=float,
+                    help="Spacing in degrees of the Dec grid of --dec_lookup (default = 0.001)")
+parser.add_option('--tile_rows','--tile-rows',dest="tile_rows",default=256,type=int,
+                    help="Number of rows corrected at a time (default = 256)")
+parser.add_option('--threads',dest="threads",default=1,type=int,
+                    help="Number of tiles of rows to correct at once, on separate threads (default = 1)")
 (options, args) = parser.parse_args()
 
 input_mosaic=options.mosaic
@@ -32,16 +47,12 @@ centre_dec, freq_band, RA_lim1, RA_lim2, Dec_lim1, Dec_lim2 = n.loadtxt(cutdir+'
 dec_freq_comb = [centre_dec, freq_band]
 
 def wfunc(x,d,lowerlimit,upperlimit):
-    if ((n.log(99)/d)+lowerlimit) < x < (upperlimit-(n.log(99)/d)):
-        return 1.0
-    else:
-        if x < (n.log(99)/d)+lowerlimit:
-            return n.sqrt(1+n.exp(-d*(x-lowerlimit)))
-        elif x > upperlimit-(n.log(99)/d):
-            return n.sqrt(1+n.exp(d*(x-upperlimit)))
-        else:
-            return n.nan
-vwfunc=n.vectorize(wfunc)
+    lower=(n.log(99)/d)+lowerlimit
+    upper=upperlimit-(n.log(99)/d)
+    with n.errstate(over='ignore',invalid='ignore'):
+        return n.where((lower < x) & (x < upper), 1.0,
+               n.where(x < lower, n.sqrt(1+n.exp(-d*(x-lowerlimit))),
+               n.where(x > upper, n.sqrt(1+n.exp(d*(x-upperlimit))), n.nan)))
 
 # Get the dec cuts
 header = fits.getheader(input_mosaic)
@@ -125,20 +136,27 @@ if test:
 # wcs in format [x,y,stokes,freq]; stokes and freq are length 1 if they exist
 w=wcs.WCS(hdu_in[0].header)
 
-#create an array but don't set the values (they are random)
-indexes = n.empty( (hdu_in[0].data.shape[0]*hdu_in[0].data.shape[1],2),dtype=int)
-#since I know exactly what the index array needs to look like I can construct
-# it faster than list comprehension would allow
-#we do this only once and then recycle it
-idx = n.array([ (j,0) for j in xrange(hdu_in[0].data.shape[1])])
-j=hdu_in[0].data.shape[1]
-for i in xrange(hdu_in[0].data.shape[0]):
-    idx[:,1]=i
-    indexes[i*j:(i+1)*j] = idx
-#put ALL the pixles into our vectorized functions and minimise our overheads
-ra,dec = w.wcs_pix2world(indexes,1).transpose()
-wcorr=vwfunc(dec,4,Dec_lim1,Dec_lim2)
-reshapedwcorr=wcorr.reshape(hdu_in[0].data.shape[0],hdu_in[0].data.shape[1])
-hdu_in[0].data=reshapedwcorr*hdu_in[0].data
+if options.dec_lookup:
+    row_dec = dec_table.row_decs(w,hdu_in[0].data.shape)
+else:
+    row_dec = None
+
+if row_dec is not None:
+    # Dec is constant along the rows: one weight per row, broadcast along it
+    reshapedwcorr=wfunc(row_dec,4,Dec_lim1,Dec_lim2)[:,n.newaxis]
+    hdu_in[0].data=reshapedwcorr*hdu_in[0].data
+else:
+    if options.dec_lookup:
+        # Tabulated with the edges of the flat top kept sharp
+        weight=dec_table.DecTable(lambda x: wfunc(x,4,Dec_lim1,Dec_lim2),step=options.dec_step,breaks=[(n.log(99)/4)+Dec_lim1,Dec_lim2-(n.log(99)/4)])
+    else:
+        weight=lambda x: wfunc(x,4,Dec_lim1,Dec_lim2)
+    # RA and Dec of every pixel, from the cache or generated a block of rows at a time
+    if options.coord_cache:
+        coords = sky_coords.sky_coords(w,hdu_in[0].data.shape,cache_dir=options.coord_cache,cache_size=options.coord_cache_size*1e9)
+    else:
+        coords = None
+    data=hdu_in[0].data
+    hdu_in[0].data=image_tiles.correct_image(data,w,lambda rows,ra,dec: weight(dec),out=n.empty(data.shape,dtype=n.result_type(data.dtype,n.float64)),tile_rows=options.tile_rows,threads=options.threads,coords=coords)
 hdu_in.writeto("./"+sigmoid)
 hdu_in.close()
@@ -0,0 +1,150 @@
+"""
+RA and Dec of every pixel of a mosaic, a block of rows at a time
+
+The per-pixel correction scripts used to build an (npix, 2) index array in a
+python loop and convert it with one wcs_pix2world call, which on a large
+mosaic costs several times the image size in temporaries. Here the pixel
+grid of each tile of rows is generated with np.indices and converted on its
+own, so that only one tile is ever held in double precision. The maps can be
+consumed tile by tile, or assembled in memory or in .npy memmaps, in float32
+if requested.
+
+All the subband mosaics of a week share one projection, so the maps can be
+cached on disk as .npy files keyed by a hash of the celestial WCS keywords
+and the image shape. Later stages and mosaics then memory-map them instead
+of calling WCS again. The cache directory is kept under a size limit by
+deleting the least recently used maps.
+
+As in the scripts, the zero-based array indices are passed to WCS with
+origin=1 by default, so the coordinates are unchanged.
+
+Usage example
+====
+import sky_coords
+for rows, ra, dec in sky_coords.sky_tiles(w, hdu[0].data.shape):
+    hdu[0].data[rows] *= correction(dec)
+ra, dec = sky_coords.sky_coords(w, hdu[0].data.shape, dtype=np.float32)
+ra, dec = sky_coords.sky_coords(w, hdu[0].data.shape, cache_dir='coord_cache', cache_size=20e9)
+====
+"""
+import glob
+import hashlib
+import os
+
+import numpy as np
+
+def celestial(w):
+    '''The two celestial axes of a WCS, e.g. for mosaics with frequency and Stokes axes.'''
+    if w.naxis > 2:
+        return w.celestial
+    return w
+
+def pixel_indices(shape):
+    '''The (ny*nx, 2) array of (x, y) indices of every pixel, in row-major order.'''
+    yy, xx = np.indices(shape)
+    return np.column_stack((xx.ravel(), yy.ravel()))
+
+def row_slices(shape, tile_rows=512):
+    '''Slices of at most tile_rows rows covering an image of shape (ny, nx).'''
+    for y0 in range(0, shape[0], tile_rows):
+        yield slice(y0, min(y0 + tile_rows, shape[0]))
+
+def sky_tiles(w, shape, tile_rows=512, origin=1, dtype=np.float64):
+    '''
+    Generator over blocks of rows of an image of shape (ny, nx): yields (rows, ra, dec), where
+    rows is the slice of the image and ra and dec are (rows, nx) arrays of dtype.
+    '''
+    w = celestial(w)
+    shape = tuple(shape[-2:])
+    for rows in row_slices(shape, tile_rows):
+        ra, dec = tile_coords(w, shape, rows, origin, dtype)
+        yield rows, ra, dec
+
+def tile_coords(w, shape, rows, origin=1, dtype=np.float64):
+    '''The (rows, nx) ra and dec arrays of the slice rows of an image of shape (ny, nx).'''
+    yy, xx = np.indices((rows.stop - rows.start, shape[-1]))
+    yy += rows.start
+    ra, dec = celestial(w).wcs_pix2world(xx, yy, origin)
+    return ra.astype(dtype, copy=False), dec.astype(dtype, copy=False)
+
+def wcs_key(w, shape, origin=1, dtype=np.float64):
+    '''Hash of the celestial projection keywords of w, the image shape, origin and dtype.'''
+    wcsprm = celestial(w).wcs
+    items = [list(wcsprm.ctype), list(wcsprm.cunit), wcsprm.crval, wcsprm.crpix, wcsprm.cdelt,
+             wcsprm.get_pc(), wcsprm.lonpole, wcsprm.latpole, wcsprm.get_pv(), wcsprm.radesys,
+             wcsprm.equinox, tuple(shape[-2:]), origin, np.dtype(dtype).str]
+    h = hashlib.sha1()
+    for item in items:
+        h.update(repr(np.asarray(item).tolist() if isinstance(item, np.ndarray) else item).encode())
+    return h.hexdigest()
+
+def evict(cache_dir, cache_size, keep=None):
+    '''
+    Delete the least recently used maps in cache_dir until it holds at most cache_size bytes.
+    Maps still being written (.tmp<pid>) are left to the process writing them.
+    '''
+    entries = []
+    for ra_file in glob.glob(os.path.join(cache_dir, '*_ra.npy')):
+        if '.tmp' in os.path.basename(ra_file):
+            continue
+        dec_file = ra_file[:-len('_ra.npy')]+'_dec.npy'
+        try:
+            size = os.path.getsize(ra_file) + (os.path.getsize(dec_file) if os.path.exists(dec_file) else 0)
+            entries.append((os.path.getmtime(ra_file), size, ra_file, dec_file))
+        except OSError: # removed by another process
+            continue
+    total = sum(entry[1] for entry in entries)
+    for mtime, size, ra_file, dec_file in sorted(entries):
+        if total <= cache_size:
+            break
+        if keep is not None and os.path.basename(ra_file).startswith(keep):
+            continue
+        for filename in (ra_file, dec_file):
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+        total -= size
+
+def sky_coords(w, shape, tile_rows=512, origin=1, dtype=np.float64, filename=None,
+               cache_dir=None, cache_size=20e9):
+    '''
+    The (ny, nx) RA and Dec maps of an image, filled a tile at a time. With filename, they are
+    .npy memmaps filename+'_ra.npy' and filename+'_dec.npy' rather than arrays in memory.
+
+    With cache_dir, the maps are looked up in, or added to, the cache under wcs_key() and
+    returned as copy-on-write memmaps, so that changes to them stay in memory. The cache is
+    then trimmed to cache_size bytes.
+    '''
+    shape = tuple(shape[-2:])
+    if cache_dir is not None:
+        key = wcs_key(w, shape, origin, dtype)
+        prefix = os.path.join(cache_dir, key)
+        if not (os.path.exists(prefix+'_ra.npy') and os.path.exists(prefix+'_dec.npy')):
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            # Written under a temporary name and renamed, so other processes never see part of a map
+            tmp = prefix+'.tmp%d' % os.getpid()
+            ra, dec = sky_coords(w, shape, tile_rows, origin, dtype, filename=tmp)
+            ra.flush()
+            dec.flush()
+            del ra, dec
+            os.rename(tmp+'_dec.npy', prefix+'_dec.npy')
+            os.rename(tmp+'_ra.npy', prefix+'_ra.npy')
+        else:
+            os.utime(prefix+'_ra.npy', None)
+        ra = np.load(prefix+'_ra.npy', mmap_mode='c')
+        dec = np.load(prefix+'_dec.npy', mmap_mode='c')
+        evict(cache_dir, cache_size, keep=key)
+        return ra, dec
+
+    if filename is None:
+        ra = np.empty(shape, dtype=dtype)
+        dec = np.empty(shape, dtype=dtype)
+    else:
+        ra = np.lib.format.open_memmap(filename+'_ra.npy', mode='w+', dtype=dtype, shape=shape)
+        dec = np.lib.format.open_memmap(filename+'_dec.npy', mode='w+', dtype=dtype, shape=shape)
+    for rows, ra_tile, dec_tile in sky_tiles(w, shape, tile_rows, origin, dtype):
+        ra[rows] = ra_tile
+        dec[rows] = dec_tile
+    return ra, dec
@@ -0,0 +1,505 @@
+"""
+Crossmatch two catalogues on the sky, in process, like stilts tmatch2 matcher=sky
+
+Every crossmatch used to be an os.system call to stilts, paying the start-up of
+a JVM and a round trip through temporary VOTables, with any failure only seen
+as a missing file later on. Here the positions of the second table are put in a
+KD-tree of unit vectors; the candidate pairs within the chord of the match
+radius are found in one query, and their separations computed with the
+haversine formula, which is accurate at all separations.
+
+The find and join modes and the column naming follow stilts:
+
+find:  best   each row of either table in at most one pair, the closest first
+       best1  the closest row of table 2 for each row of table 1
+       best2  the closest row of table 1 for each row of table 2
+       all    every pair within the radius
+join:  1and2, 1or2, all1, all2, 1not2, 2not1, 1xor2
+
+match_ellipses() matches error ellipses (ra, dec, a, b, pa), like stilts
+matcher=skyellipse: a and b are the semi-major and semi-minor axes in arcsec and
+pa the position angle of the major axis in degrees east of north. Candidates
+are pruned with the same KD-tree, at the largest possible extent of each pair
+of ellipses, and the ellipses of each candidate pair are compared at once. The
+score is the stilts normalised distance: the separation of the centres divided
+by the sum of the radii of the ellipses along the line joining them, so 0 for
+coincident centres and 1 for ellipses touching on that line. Ellipses which
+only overlap away from that line, found with an exact ellipse-ellipse test, also
+match, with a score of 1: the score stilts documents for touching ellipses, but
+not compared with stilts output for such pairs. The params of stilts is only a
+tuning scale and has no counterpart here.
+
+Column names present in both tables get suffix1 and suffix2 (fixcols='dups'),
+or every column does (fixcols='all'), and the separation of each pair is added
+as Separation, in arcsec. Rows with no partner are masked. The result is an
+astropy Table, so it can be used directly or written in any format.
+
+match_exact() joins rows with equal values of a column, like stilts
+matcher=exact, e.g. the Aegean components and islands on island.
+
+isolated() flags the sources of one table with no other within a radius, like
+stilts tmatch1 action=keep0, from one query_pairs() of the same KD-tree.
+
+For N-way matches against one reference table, as stilts tmatchn multimode=pairs,
+build ellipse_index() of the reference once, match each other table against it
+and put the matched rows side by side with join_columns().
+
+Usage example
+====
+import sky_match
+gleam = sky_match.read_table('GLEAM.vot')
+nvss = sky_match.read_table('NVSS.fits')
+t = sky_match.match(gleam, nvss, 60., ra2='RAJ2000', dec2='DEJ2000', find='best1')
+t.write('GLEAM+NVSS.fits', overwrite=True)
+gleam = gleam[sky_match.isolated(gleam['ra'], gleam['dec'], 600.)]
+t = sky_match.match_ellipses(mrc, gleam, ('_RAJ2000', '_DEJ2000', 'e_RA2000', 'e_DE2000', 0.), ('ra', 'dec', 'a', 'b', 'pa'))
+====
+"""
+import numpy as np
+from scipy.spatial import cKDTree
+from astropy.table import Table, Column, MaskedColumn
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+# Changed whenever ellipse_pairs() would find different pairs or scores, e.g. for caches of matches
+ELLIPSE_VERSION = 2
+
+FIND_MODES = ('best', 'best1', 'best2', 'all')
+JOIN_MODES = ('1and2', '1or2', 'all1', 'all2', '1not2', '2not1', '1xor2')
+
+def read_table(filename):
+    '''The first table of a VOTable or FITS file, as an astropy Table.'''
+    return Table.read(filename)
+
+def positions(column):
+    '''A column of positions as floats, with masked values NaN.'''
+    return np.ma.filled(np.ma.asarray(column).astype(float), np.nan)
+
+def unit_vectors(ra, dec):
+    '''(n, 3) unit vectors of positions in degrees.'''
+    ra = np.radians(np.asarray(ra, dtype=float))
+    dec = np.radians(np.asarray(dec, dtype=float))
+    cos_dec = np.cos(dec)
+    return np.column_stack((cos_dec*np.cos(ra), cos_dec*np.sin(ra), np.sin(dec)))
+
+def separation(ra1, dec1, ra2, dec2):
+    '''Angular separation in degrees, by the haversine formula.'''
+    ra1, dec1, ra2, dec2 = [np.radians(np.asarray(x, dtype=float)) for x in (ra1, dec1, ra2, dec2)]
+    h = np.sin((dec2 - dec1)/2.)**2 + np.cos(dec1)*np.cos(dec2)*np.sin((ra2 - ra1)/2.)**2
+    return np.degrees(2.*np.arcsin(np.sqrt(np.clip(h, 0., 1.))))
+
+def sky_tree(ra, dec):
+    '''KD-tree of the unit vectors of positions in degrees; positions which are not finite are left out.'''
+    good = np.isfinite(np.asarray(ra, dtype=float)) & np.isfinite(np.asarray(dec, dtype=float))
+    return cKDTree(unit_vectors(np.asarray(ra)[good], np.asarray(dec)[good])), np.nonzero(good)[0]
+
+def _chord(radius):
+    '''
+    Chord between unit vectors radius degrees apart, slightly enlarged so no pair is lost to
+    rounding; the haversine separations make the final cut.
+    '''
+    return 2.*np.sin(np.radians(min(radius, 180.))/2.)*(1. + 1e-9) + 1e-15
+
+def sky_pairs(ra1, dec1, ra2, dec2, radius, tree2=None):
+    '''
+    (i1, i2, sep) of every pair of positions (in degrees) within radius degrees of each other;
+    sep in degrees. tree2: optional sky_tree() of (ra2, dec2), to reuse between calls.
+    '''
+    ra1 = np.asarray(ra1, dtype=float)
+    dec1 = np.asarray(dec1, dtype=float)
+    if tree2 is None:
+        tree2 = sky_tree(ra2, dec2)
+    tree, index2 = tree2
+    good1 = np.nonzero(np.isfinite(ra1) & np.isfinite(dec1))[0]
+    chord = _chord(radius)
+    if len(good1) == 0 or len(index2) == 0:
+        empty = np.zeros(0, dtype=int)
+        return empty, empty, np.zeros(0)
+    vectors1 = unit_vectors(ra1[good1], dec1[good1])
+    try:
+        pairs = cKDTree(vectors1).sparse_distance_matrix(tree, chord, output_type='ndarray')
+        i1 = good1[pairs['i'].astype(int)]
+        i2 = index2[pairs['j'].astype(int)]
+    except TypeError:
+        # scipy < 0.19: a list of neighbours per position
+        neighbours = tree.query_ball_point(vectors1, chord)
+        counts = np.array([len(n) for n in neighbours], dtype=int)
+        i1 = np.repeat(good1, counts)
+        if counts.sum():
+            i2 = index2[np.concatenate([n for n in neighbours if len(n)]).astype(int)]
+        else:
+            i2 = np.zeros(0, dtype=int)
+    sep = separation(ra1[i1], dec1[i1], np.asarray(ra2, dtype=float)[i2], np.asarray(dec2, dtype=float)[i2])
+    within = sep <= radius
+    return i1[within], i2[within], sep[within]
+
+def isolated(ra, dec, radius):
+    '''
+    True for the positions (in degrees) with no other within radius arcsec, as stilts tmatch1
+    matcher=sky action=keep0. Positions which are not finite have no neighbours.
+    '''
+    ra = positions(ra)
+    dec = positions(dec)
+    tree, index = sky_tree(ra, dec)
+    try:
+        pairs = tree.query_pairs(_chord(radius/3600.), output_type='ndarray')
+    except TypeError:
+        # scipy < 0.19: a set of pairs
+        pairs = np.array(sorted(tree.query_pairs(_chord(radius/3600.))), dtype=int).reshape(-1, 2)
+    i1 = index[pairs[:, 0]]
+    i2 = index[pairs[:, 1]]
+    close = separation(ra[i1], dec[i1], ra[i2], dec[i2]) <= radius/3600.
+    alone = np.ones(len(ra), dtype=bool)
+    alone[i1[close]] = False
+    alone[i2[close]] = False
+    return alone
+
+def best_of(groups, score):
+    '''Indices of the lowest score in each group, ties going to the first.'''
+    if len(groups) == 0:
+        return np.zeros(0, dtype=int)
+    order = np.lexsort((score, groups))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = groups[order][1:] != groups[order][:-1]
+    return order[first]
+
+def best_pairs(i1, i2, score):
+    '''
+    Indices of the pairs kept so that each row of either table is in at most one pair, taking
+    the pairs in order of increasing score: the mutual best pairs are kept, their rows removed,
+    and so on until none are left.
+    '''
+    keep = np.zeros(len(i1), dtype=bool)
+    live = np.ones(len(i1), dtype=bool)
+    if len(i1) == 0:
+        return np.nonzero(keep)[0]
+    used1 = np.zeros(i1.max() + 1, dtype=bool)
+    used2 = np.zeros(i2.max() + 1, dtype=bool)
+    while live.any():
+        idx = np.nonzero(live)[0]
+        best1 = np.zeros(len(i1), dtype=bool)
+        best1[idx[best_of(i1[idx], score[idx])]] = True
+        best2 = np.zeros(len(i1), dtype=bool)
+        best2[idx[best_of(i2[idx], score[idx])]] = True
+        mutual = best1 & best2
+        keep |= mutual
+        used1[i1[mutual]] = True
+        used2[i2[mutual]] = True
+        live &= ~(used1[i1] | used2[i2])
+    return np.nonzero(keep)[0]
+
+def select_pairs(i1, i2, score, find='best'):
+    '''The indices of the pairs kept by the stilts find mode.'''
+    if find == 'all':
+        return np.lexsort((score, i2, i1))
+    elif find == 'best1':
+        return best_of(i1, score)
+    elif find == 'best2':
+        return best_of(i2, score)
+    elif find == 'best':
+        return best_pairs(i1, i2, score)
+    raise ValueError("find must be one of " + ", ".join(FIND_MODES))
+
+def _column_names(table1, table2, fixcols, suffix1, suffix2):
+    '''Output names of the columns of the two tables.'''
+    names1 = list(table1.colnames)
+    names2 = list(table2.colnames)
+    if fixcols == 'all':
+        return [n + suffix1 for n in names1], [n + suffix2 for n in names2]
+    dups = set(names1) & set(names2)
+    if fixcols == 'dups':
+        return ([n + suffix1 if n in dups else n for n in names1],
+                [n + suffix2 if n in dups else n for n in names2])
+    elif fixcols == 'none':
+        if dups:
+            raise ValueError("Columns in both tables with fixcols=none: " + ", ".join(sorted(dups)))
+        return names1, names2
+    raise ValueError("fixcols must be dups, all or none")
+
+def _take(table, index, names):
+    '''Columns of the rows index of table, renamed to names; rows with index -1 are masked.'''
+    missing = index < 0
+    safe = np.where(missing, 0, index)
+    columns = []
+    for name, newname in zip(table.colnames, names):
+        col = table[name]
+        if len(col):
+            data = np.asarray(col)[safe]
+            mask = np.ma.getmaskarray(col)[safe]
+        else:
+            data = np.zeros((len(index),) + col.shape[1:], dtype=col.dtype)
+            mask = np.ones(data.shape, dtype=bool)
+        mask = mask | missing.reshape((-1,) + (1,)*(data.ndim - 1))
+        if mask.any():
+            columns.append(MaskedColumn(data, name=newname, mask=mask, unit=col.unit, description=col.description))
+        else:
+            columns.append(Column(data, name=newname, unit=col.unit, description=col.description))
+    return columns
+
+def join_pairs(table1, table2, i1, i2, sep=None, join='1and2', fixcols='dups', suffix1='_1', suffix2='_2',
+               score_name='Separation', score_unit='arcsec'):
+    '''
+    Assemble the output table of the pairs (i1, i2) of rows of table1 and table2, with their
+    scores sep (e.g. separations in arcsec), according to the stilts join mode.
+    '''
+    if join not in JOIN_MODES:
+        raise ValueError("join must be one of " + ", ".join(JOIN_MODES))
+    unmatched1 = np.ones(len(table1), dtype=bool)
+    unmatched1[np.asarray(i1, dtype=int)] = False
+    unmatched1 = np.nonzero(unmatched1)[0]
+    unmatched2 = np.ones(len(table2), dtype=bool)
+    unmatched2[np.asarray(i2, dtype=int)] = False
+    unmatched2 = np.nonzero(unmatched2)[0]
+    if join == '1not2':
+        return Table(_take(table1, unmatched1, list(table1.colnames)))
+    if join == '2not1':
+        return Table(_take(table2, unmatched2, list(table2.colnames)))
+    names1, names2 = _column_names(table1, table2, fixcols, suffix1, suffix2)
+
+    rows1, rows2, scores = [], [], []
+    if join != '1xor2':
+        rows1.append(np.asarray(i1, dtype=int))
+        rows2.append(np.asarray(i2, dtype=int))
+        scores.append(np.asarray(sep if sep is not None else np.zeros(len(i1)), dtype=float))
+    if join in ('1or2', 'all1', '1xor2'):
+        rows1.append(unmatched1)
+        rows2.append(-np.ones(len(unmatched1), dtype=int))
+        scores.append(np.nan*np.ones(len(unmatched1)))
+    if join in ('1or2', 'all2', '1xor2'):
+        rows1.append(-np.ones(len(unmatched2), dtype=int))
+        rows2.append(unmatched2)
+        scores.append(np.nan*np.ones(len(unmatched2)))
+    rows1 = np.concatenate(rows1)
+    rows2 = np.concatenate(rows2)
+    scores = np.concatenate(scores)
+
+    columns = _take(table1, rows1, names1) + _take(table2, rows2, names2)
+    if join != '1xor2' and score_name:
+        if np.isnan(scores).any():
+            columns.append(MaskedColumn(scores, name=score_name, mask=np.isnan(scores), unit=score_unit))
+        else:
+            columns.append(Column(scores, name=score_name, unit=score_unit))
+    return Table(columns)
+
+def join_columns(tables, rows, suffixes=None):
+    '''
+    The tables side by side: output row j holds row rows[k][j] of tables[k], or masked values
+    where that is -1. Column names in more than one table get suffixes[k] (default _1, _2, ...),
+    as stilts tmatchn fixcols=dups.
+    '''
+    if suffixes is None:
+        suffixes = ['_' + str(k + 1) for k in range(len(tables))]
+    counts = {}
+    for table in tables:
+        for name in table.colnames:
+            counts[name] = counts.get(name, 0) + 1
+    columns = []
+    for table, index, suffix in zip(tables, rows, suffixes):
+        names = [n + suffix if counts[n] > 1 else n for n in table.colnames]
+        columns += _take(table, np.asarray(index, dtype=int), names)
+    return Table(columns)
+
+def match(table1, table2, radius, ra1='ra', dec1='dec', ra2='ra', dec2='dec', find='best', join='1and2',
+          fixcols='dups', suffix1='_1', suffix2='_2'):
+    '''
+    Crossmatch table1 and table2 (astropy Tables) on the sky, as stilts tmatch2 matcher=sky
+    params=radius: radius in arcsec, positions in the columns ra1, dec1, ra2 and dec2 in degrees.
+    '''
+    if find not in FIND_MODES:
+        raise ValueError("find must be one of " + ", ".join(FIND_MODES))
+    i1, i2, sep = sky_pairs(positions(table1[ra1]), positions(table1[dec1]), positions(table2[ra2]), positions(table2[dec2]), radius/3600.)
+    sep = sep*3600.
+    keep = select_pairs(i1, i2, sep, find)
+    return join_pairs(table1, table2, i1[keep], i2[keep], sep[keep], join, fixcols, suffix1, suffix2)
+
+def exact_pairs(values1, values2):
+    '''(i1, i2) of every pair of rows with equal values, ordered by i1 and then i2.'''
+    values1 = np.asarray(values1)
+    values2 = np.asarray(values2)
+    order2 = np.argsort(values2, kind='mergesort')
+    sorted2 = values2[order2]
+    lo = np.searchsorted(sorted2, values1, side='left')
+    hi = np.searchsorted(sorted2, values1, side='right')
+    counts = hi - lo
+    i1 = np.repeat(np.arange(len(values1)), counts)
+    # Position of each pair within the run of equal values of table 2
+    offset = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    i2 = order2[np.repeat(lo, counts) + offset]
+    return i1, i2
+
+def match_exact(table1, table2, column1, column2=None, find='best', join='1and2', fixcols='dups',
+                suffix1='_1', suffix2='_2'):
+    '''
+    Join the rows of table1 and table2 with equal values in column1 and column2 (default the
+    same name), as stilts tmatch2 matcher=exact. With find=best each row is in at most one
+    pair, ties going to the first rows. No score column is added.
+    '''
+    if find not in FIND_MODES:
+        raise ValueError("find must be one of " + ", ".join(FIND_MODES))
+    i1, i2 = exact_pairs(np.ma.filled(table1[column1]), np.ma.filled(table2[column2 if column2 else column1]))
+    # Masked values match nothing
+    missing = np.ma.getmaskarray(table1[column1])[i1] | np.ma.getmaskarray(table2[column2 if column2 else column1])[i2]
+    i1, i2 = i1[~missing], i2[~missing]
+    score = np.zeros(len(i1))
+    keep = select_pairs(i1, i2, score, find)
+    return join_pairs(table1, table2, i1[keep], i2[keep], score[keep], join, fixcols, suffix1, suffix2,
+                      score_name=None)
+
+def bearing(ra1, dec1, ra2, dec2):
+    '''Position angle in radians, east of north, of (ra2, dec2) from (ra1, dec1); positions in degrees.'''
+    ra1, dec1, ra2, dec2 = [np.radians(np.asarray(x, dtype=float)) for x in (ra1, dec1, ra2, dec2)]
+    return np.arctan2(np.sin(ra2 - ra1)*np.cos(dec2),
+                      np.cos(dec1)*np.sin(dec2) - np.sin(dec1)*np.cos(dec2)*np.cos(ra2 - ra1))
+
+def ellipse_radius(a, b, pa, theta):
+    '''Radius of ellipses with semi-axes a and b and position angle pa (degrees) in the direction theta (radians).'''
+    alpha = theta - np.radians(pa)
+    denominator = np.hypot(b*np.cos(alpha), a*np.sin(alpha))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(denominator > 0, a*b/np.where(denominator > 0, denominator, 1.), 0.)
+
+def _shape(a, b, pa):
+    '''(s11, s12, s22) of the shape matrices a^2 u u^T + b^2 v v^T of ellipses, with u along the major axis (x east, y north).'''
+    pa = np.radians(pa)
+    sin, cos = np.sin(pa), np.cos(pa)
+    return a**2*sin**2 + b**2*cos**2, (a**2 - b**2)*sin*cos, a**2*cos**2 + b**2*sin**2
+
+def _overlap(a1, b1, pa1, x2, y2, a2, b2, pa2, niter=80):
+    '''
+    Whether ellipse 1, centred on the origin of the tangent plane, overlaps ellipse 2 centred on
+    (x2, y2) (x east, y north). For 0 <= s <= 1, the minimum over the plane of s Q1 + (1-s) Q2,
+    with Q the quadratic forms of the ellipses, is F(s) = s(1-s) d^T [(1-s)S1 + s S2]^-1 d (the
+    Perram-Wertheim contact function), with S their shape matrices and d = (x2, y2). As a minimum
+    of functions linear in s, F is concave, and the ellipses overlap exactly when its maximum is
+    at most 1. The maximum is found by golden-section search to within 0.618^niter in s, where F
+    is flat, so the test is exact to rounding: it does not depend on how thin the ellipses are.
+    Parallel segments (a singular (1-s)S1 + s S2) are taken not to overlap; collinear ones
+    overlap on the line joining the centres, which ellipse_pairs() has already checked.
+    '''
+    s11, s12, s22 = _shape(a1, b1, pa1)
+    t11, t12, t22 = _shape(a2, b2, pa2)
+
+    def contact(s):
+        m11 = (1. - s)*s11 + s*t11
+        m12 = (1. - s)*s12 + s*t12
+        m22 = (1. - s)*s22 + s*t22
+        det = m11*m22 - m12**2
+        q = m22*x2**2 - 2.*m12*x2*y2 + m11*y2**2
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(det > 0, s*(1. - s)*q/np.where(det > 0, det, 1.), np.inf)
+
+    golden = (np.sqrt(5.) - 1.)/2.
+    lo = np.zeros(len(x2))
+    hi = np.ones(len(x2))
+    for i in range(niter):
+        left = hi - golden*(hi - lo)
+        right = lo + golden*(hi - lo)
+        rising = contact(left) < contact(right)
+        lo = np.where(rising, left, lo)
+        hi = np.where(rising, hi, right)
+    return contact((lo + hi)/2.) <= 1.
+
+def _size_bins(a, b, valid):
+    '''The largest semi-axis of each ellipse, and its size group (factors of 2 in arcsec).'''
+    extent = np.where(valid, np.maximum(a, b), np.nan)
+    with np.errstate(invalid='ignore'):
+        size_bin = np.floor(np.log2(np.maximum(extent, 1.)))
+    return extent, size_bin
+
+def ellipse_index(ra, dec, a, b, pa):
+    '''
+    KD-trees of the ellipses (ra, dec, a, b, pa), one per size group, as used by ellipse_pairs().
+    Build it once to match many tables against the same ellipses.
+    '''
+    ra, dec, a, b, pa = [np.asarray(x, dtype=float) for x in (ra, dec, a, b, pa)]
+    valid = np.isfinite(a) & np.isfinite(b) & np.isfinite(pa)
+    extent, size_bin = _size_bins(a, b, valid)
+    index = []
+    for size in np.unique(size_bin[valid]):
+        rows = np.nonzero(valid & (size_bin == size))[0]
+        index.append((rows, np.max(extent[rows]), sky_tree(ra[rows], dec[rows])))
+    return index
+
+def ellipse_pairs(ra1, dec1, a1, b1, pa1, ra2, dec2, a2, b2, pa2, index2=None):
+    '''
+    (i1, i2, score) of every pair of overlapping ellipses; positions and pa in degrees, a and b
+    in arcsec. Ellipses with a, b or pa not finite never match. index2: ellipse_index() of the
+    second set of ellipses, if already built.
+    '''
+    ra1, dec1, a1, b1, pa1 = [np.asarray(x, dtype=float) for x in (ra1, dec1, a1, b1, pa1)]
+    ra2, dec2, a2, b2, pa2 = [np.asarray(x, dtype=float) for x in (ra2, dec2, a2, b2, pa2)]
+    valid1 = np.isfinite(a1) & np.isfinite(b1) & np.isfinite(pa1)
+    valid2 = np.isfinite(a2) & np.isfinite(b2) & np.isfinite(pa2)
+    empty = (np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0))
+    if not valid1.any() or not valid2.any():
+        return empty
+
+    # Candidates within the largest possible extent of each pair: the ellipses of both tables
+    # are grouped by size, so that a few large ones do not widen every query
+    extent1, size1 = _size_bins(a1, b1, valid1)
+    if index2 is None:
+        index2 = ellipse_index(ra2, dec2, a2, b2, pa2)
+    i1, i2 = [], []
+    for size in np.unique(size1[valid1]):
+        rows1 = np.nonzero(valid1 & (size1 == size))[0]
+        for rows2, extent, tree in index2:
+            radius = (np.max(extent1[rows1]) + extent)/3600.
+            p1, p2, dummy = sky_pairs(ra1[rows1], dec1[rows1], ra2[rows2], dec2[rows2], radius, tree)
+            i1.append(rows1[p1])
+            i2.append(rows2[p2])
+    i1 = np.concatenate(i1)
+    i2 = np.concatenate(i2)
+    if len(i1) == 0:
+        return empty
+
+    d = separation(ra1[i1], dec1[i1], ra2[i2], dec2[i2])*3600.
+    theta1 = bearing(ra1[i1], dec1[i1], ra2[i2], dec2[i2])
+    theta2 = bearing(ra2[i2], dec2[i2], ra1[i1], dec1[i1])
+    reach = ellipse_radius(a1[i1], b1[i1], pa1[i1], theta1) + ellipse_radius(a2[i2], b2[i2], pa2[i2], theta2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        score = np.where(d > 0, d/np.where(reach > 0, reach, 1.), 0.)
+    score[(reach <= 0) & (d > 0)] = np.inf
+    matched = score <= 1.
+
+    # Overlaps away from the line joining the centres
+    check = np.nonzero(~matched & (d <= np.maximum(a1[i1], b1[i1]) + np.maximum(a2[i2], b2[i2])))[0]
+    if len(check):
+        x2 = d[check]*np.sin(theta1[check])
+        y2 = d[check]*np.cos(theta1[check])
+        e1 = (a1[i1[check]], b1[i1[check]], pa1[i1[check]])
+        e2 = (a2[i2[check]], b2[i2[check]], pa2[i2[check]])
+        # The boundary of each ellipse is sampled for points inside the other
+        overlap = _overlap(*(e1 + (x2, y2) + e2))
+        score[check[overlap]] = 1.
+        matched[check[overlap]] = True
+    return i1[matched], i2[matched], score[matched]
+
+def _values(table, spec):
+    '''A column of table by name, or an array or constant, as floats of its length.'''
+    if isinstance(spec, string_types):
+        return positions(table[spec])
+    return np.asarray(spec, dtype=float)*np.ones(len(table))
+
+def match_ellipses(table1, table2, values1=('ra', 'dec', 'a', 'b', 'pa'), values2=('ra', 'dec', 'a', 'b', 'pa'),
+                   find='best', join='1and2', fixcols='dups', suffix1='_1', suffix2='_2', index1=None):
+    '''
+    Crossmatch the error ellipses of table1 and table2, as stilts tmatch2 matcher=skyellipse.
+    values1 and values2: (ra, dec, a, b, pa) of each table, each a column name or an array or
+    constant, e.g. 2*table['a'] or 0. for a missing position angle. The score is added as Score.
+    index1: ellipse_index() of the ellipses of table1, e.g. of a reference catalogue matched to
+    many tables; otherwise table2 is indexed.
+    '''
+    if find not in FIND_MODES:
+        raise ValueError("find must be one of " + ", ".join(FIND_MODES))
+    ellipses1 = [_values(table1, v) for v in values1]
+    ellipses2 = [_values(table2, v) for v in values2]
+    if index1 is None:
+        i1, i2, score = ellipse_pairs(*(ellipses1 + ellipses2))
+    else:
+        i2, i1, score = ellipse_pairs(*(ellipses2 + ellipses1), index2=index1)
+    keep = select_pairs(i1, i2, score, find)
+    return join_pairs(table1, table2, i1[keep], i2[keep], score[keep], join, fixcols, suffix1, suffix2,
+                      score_name='Score', score_unit=None)
@@ -0,0 +1,180 @@
+"""
+Tests of sky_match.match_ellipses on the hand-derived ellipses in data/
+
+The expected pairs are not stilts output: stilts was not available to generate
+them. skyellipse_1.csv and skyellipse_2.csv are instead laid out along the
+equator, one group of ellipses every 10 degrees of RA, with the centres of each
+group on a meridian or on the equator and the axes along or across the line
+joining them. The scores of the normalised distance documented for stilts
+matcher=skyellipse (the separation over the sum of the radii along that line)
+can then be worked out by hand. skyellipse_pairs.csv holds every pair, as
+find=all join=1and2, with the pairs kept by find=best, best1 and best2.
+
+The groups cover coincident centres, a multiple match resolved differently by
+each find mode, zero-size ellipses (points), crossed ellipses which overlap
+away from the line joining them (score 1, as sky_match defines it), thin ones
+crossing and just missing each other, and a pair either side of RA 0/360. The
+exact overlap test is also checked against dense sampling of the boundaries.
+
+Run with: python -m pytest tests
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+from astropy.table import Table
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import sky_match
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+def read(name):
+    return Table.read(os.path.join(DATA, name), format='ascii.csv')
+
+@pytest.fixture
+def tables():
+    return read('skyellipse_1.csv'), read('skyellipse_2.csv'), read('skyellipse_pairs.csv')
+
+def pairs_of(table, score='Score'):
+    '''{(id_1, id_2): score} of the rows of a match with both sides present.'''
+    both = ~np.ma.getmaskarray(table['id_1']) & ~np.ma.getmaskarray(table['id_2'])
+    return dict(((str(i1), str(i2)), float(s)) for i1, i2, s in zip(table['id_1'][both], table['id_2'][both], table[score][both]))
+
+def expected_pairs(expected, find):
+    keep = np.ones(len(expected), dtype=bool) if find == 'all' else expected[find] == 1
+    return dict(((str(i1), str(i2)), float(s)) for i1, i2, s in zip(expected['id_1'][keep], expected['id_2'][keep], expected['Score'][keep]))
+
+def assert_pairs(found, expected):
+    assert sorted(found) == sorted(expected)
+    for pair in expected:
+        assert found[pair] == pytest.approx(expected[pair], abs=1e-9), pair
+
+def test_ellipse_pairs(tables):
+    t1, t2, expected = tables
+    i1, i2, score = sky_match.ellipse_pairs(*([t1[c] for c in ('ra', 'dec', 'a', 'b', 'pa')] +
+                                              [t2[c] for c in ('ra', 'dec', 'a', 'b', 'pa')]))
+    found = dict(((str(t1['id'][i]), str(t2['id'][j])), s) for i, j, s in zip(i1, i2, score))
+    assert_pairs(found, expected_pairs(expected, 'all'))
+
+@pytest.mark.parametrize('find', sky_match.FIND_MODES)
+def test_find_modes(tables, find):
+    t1, t2, expected = tables
+    assert_pairs(pairs_of(sky_match.match_ellipses(t1, t2, find=find, join='1and2')), expected_pairs(expected, find))
+
+@pytest.mark.parametrize('join', sky_match.JOIN_MODES)
+def test_join_modes(tables, join):
+    t1, t2, expected = tables
+    matched = expected_pairs(expected, 'best')
+    only1 = sorted(set(str(i) for i in t1['id']) - set(i1 for i1, i2 in matched))
+    only2 = sorted(set(str(i) for i in t2['id']) - set(i2 for i1, i2 in matched))
+    rows = {'1and2': list(matched),
+            '1or2': list(matched) + [(i, None) for i in only1] + [(None, i) for i in only2],
+            'all1': list(matched) + [(i, None) for i in only1],
+            'all2': list(matched) + [(None, i) for i in only2],
+            '1xor2': [(i, None) for i in only1] + [(None, i) for i in only2]}
+    t = sky_match.match_ellipses(t1, t2, find='best', join=join)
+    if join == '1not2':
+        assert sorted(str(i) for i in t['id']) == only1
+    elif join == '2not1':
+        assert sorted(str(i) for i in t['id']) == only2
+    else:
+        found = [tuple(None if m else str(v) for v, m in zip((row['id_1'], row['id_2']), (np.ma.is_masked(row['id_1']), np.ma.is_masked(row['id_2']))))
+                 for row in t]
+        assert sorted(found, key=str) == sorted(rows[join], key=str)
+        assert ('Score' in t.colnames) == (join != '1xor2')
+        if join != '1xor2':
+            assert_pairs(pairs_of(t), matched)
+
+def test_zero_size(tables):
+    t1, t2, expected = tables
+    found = pairs_of(sky_match.match_ellipses(t1, t2, find='all'))
+    # A point inside an ellipse, and coincident points, match; separate points do not
+    assert found[('p1', 'q')] == pytest.approx(0.4)
+    assert found[('p2', 'p2b')] == 0.
+    assert not [pair for pair in found if 'p3' in pair or 'p3b' in pair]
+
+def test_ra_wrap(tables):
+    t1, t2, expected = tables
+    found = pairs_of(sky_match.match_ellipses(t1, t2, find='all'))
+    assert found[('w1', 'w2')] == pytest.approx(0.45)
+    # and the same with the table shifted across RA 0/360
+    t1['ra'] = np.mod(t1['ra'] + 180., 360.)
+    t2['ra'] = np.mod(t2['ra'] + 180., 360.)
+    assert_pairs(pairs_of(sky_match.match_ellipses(t1, t2, find='all')), expected_pairs(expected, 'all'))
+
+def test_thin_crossed(tables):
+    t1, t2, expected = tables
+    found = pairs_of(sky_match.match_ellipses(t1, t2, find='all'))
+    # Ellipses 0.1 arcsec wide crossing 7.6 arcsec from their centres, and two missing by 0.4 arcsec
+    assert found[('x3', 'x4')] == 1.
+    assert not [pair for pair in found if 'n3' in pair or 'n4' in pair]
+
+def sampled_overlap(a1, b1, pa1, x2, y2, a2, b2, pa2, nsample=20000):
+    '''Whether any of nsample points on the boundary of ellipse 1, at the origin, is inside ellipse 2 at (x2, y2).'''
+    t = np.linspace(0., 2.*np.pi, nsample, endpoint=False)[np.newaxis, :]
+    pa1 = np.radians(pa1)[:, np.newaxis]
+    pa2 = np.radians(pa2)[:, np.newaxis]
+    u = a1[:, np.newaxis]*np.cos(t)
+    v = b1[:, np.newaxis]*np.sin(t)
+    x = u*np.sin(pa1) + v*np.cos(pa1) - x2[:, np.newaxis]
+    y = u*np.cos(pa1) - v*np.sin(pa1) - y2[:, np.newaxis]
+    along = x*np.sin(pa2) + y*np.cos(pa2)
+    across = x*np.cos(pa2) - y*np.sin(pa2)
+    return ((along/a2[:, np.newaxis])**2 + (across/b2[:, np.newaxis])**2 <= 1.).any(axis=1)
+
+def test_overlap_sampled():
+    rs = np.random.RandomState(1)
+    n = 300
+    a1, a2 = rs.uniform(1., 20., n), rs.uniform(1., 20., n)
+    b1, b2 = a1*rs.uniform(0.01, 1., n), a2*rs.uniform(0.01, 1., n)
+    pa1, pa2 = rs.uniform(0., 180., n), rs.uniform(0., 180., n)
+    x2, y2 = rs.uniform(-30., 30., n), rs.uniform(-30., 30., n)
+    exact = sky_match._overlap(a1, b1, pa1, x2, y2, a2, b2, pa2)
+    sampled = sampled_overlap(a1, b1, pa1, x2, y2, a2, b2, pa2) | sampled_overlap(a2, b2, pa2, -x2, -y2, a1, b1, pa1)
+    assert exact.any() and not exact.all()
+    assert np.array_equal(exact, sampled)
+
+def test_index1(tables):
+    t1, t2, expected = tables
+    index = sky_match.ellipse_index(*[t1[c] for c in ('ra', 'dec', 'a', 'b', 'pa')])
+    for find in sky_match.FIND_MODES:
+        assert_pairs(pairs_of(sky_match.match_ellipses(t1, t2, find=find, index1=index)), expected_pairs(expected, find))
+
+def test_constant_values(tables):
+    t1, t2, expected = tables
+    # Circles of 6 arcsec: the groups of equal circles at RA 40, 50 and 100 are unchanged
+    found = pairs_of(sky_match.match_ellipses(t1, t2, values1=('ra', 'dec', 6., 6., 0.), values2=('ra', 'dec', 6., 6., 0.), find='all'))
+    for pair in (('A', 'X'), ('A', 'Y'), ('B', 'Y'), ('C', 'Z'), ('D', 'Z'), ('E', 'U'), ('E', 'V')):
+        assert found[pair] == pytest.approx(expected_pairs(expected, 'all')[pair])
+
+def test_missing_ellipses(tables):
+    t1, t2, expected = tables
+    t1['pa'] = np.ma.masked_array(t1['pa'], mask=t1['id'] == 'c1')
+    found = pairs_of(sky_match.match_ellipses(t1, t2, find='all'))
+    assert ('c1', 'k1') not in found
+    assert len(found) == len(expected) - 1
+
+def test_bad_modes(tables):
+    t1, t2, expected = tables
+    with pytest.raises(ValueError):
+        sky_match.match_ellipses(t1, t2, find='closest')
+    with pytest.raises(ValueError):
+        sky_match.match_ellipses(t1, t2, join='both')
+
+@pytest.mark.parametrize('find', sky_match.FIND_MODES)
+def test_match_exact(find):
+    comp = Table({'island': [1, 1, 2, 3], 'flux': [1., 2., 3., 4.]})
+    isle = Table({'island': [1, 2, 4], 'flux': [10., 30., 50.]})
+    t = sky_match.match_exact(comp, isle, 'island', find=find)
+    found = sorted(zip(t['flux_1'], t['flux_2']))
+    if find in ('best', 'best2'):
+        assert found == [(1., 10.), (3., 30.)]
+    else:
+        assert found == [(1., 10.), (2., 10.), (3., 30.)]
+    assert 'Score' not in t.colnames
+    # Components of other islands, or beyond the first of theirs with find=best
+    assert sorted(sky_match.match_exact(comp, isle, 'island', join='1not2')['flux']) == [2., 4.]
+    assert sorted(sky_match.match_exact(comp, isle, 'island', find='all', join='1not2')['flux']) == [4.]
+    assert sorted(sky_match.match_exact(comp, isle, 'island', find='all', join='2not1')['flux']) == [50.]
@@ -12,6 +12,7 @@ from astropy.table import Table, Column
 
 from astropy.io import fits
 from astropy import wcs
+import psf_resample
 
 from optparse import OptionParser
 
@@ -43,6 +44,8 @@ parser.add_option('--fitsimage',dest="fitsimage",default=None,
                   help="Fitsimage to update (header) (default = get from catalogue name).")
 parser.add_option('--outfits',dest="outfits",default=None,
                   help="Output fits image file with new beam in header (default = fitsimage_mod.fits).")
+parser.add_option('--interpolation',type="choice",dest="interpolation",default="nearest",choices=["nearest","bilinear"],
+                  help="How to sample the PSF maps at each source: nearest or bilinear; the position angle is always nearest (default = nearest).")
 
 (options, args) = parser.parse_args()
 
@@ -141,20 +144,18 @@ else:
         psf_in = fits.open(psfimage)
         w = wcs.WCS(psf_in[0].header,naxis=2)
 
-        unmara, unmadec = np.array(data['ra']).tolist(), np.array(data['dec']).tolist()
-        rapix, decpix = w.wcs_world2pix(unmara,unmadec,1)
-        raintpix, decintpix = np.array(np.round(rapix),dtype=int), np.array(np.round(decpix),dtype=int)
-        raclip, decclip = np.clip(raintpix,0,psf_in[0].data.shape[1]-1), np.clip(decintpix,0,psf_in[0].data.shape[0]-1)
-        # Yes, it's bonkers that the wcs is the other way round compared to the fits file
-        psf_ratio = psf_in[0].data[decclip,raclip]
+        # Sources off the maps take the values at their edges
+        ra, dec = np.array(data['ra'],dtype=float), np.array(data['dec'],dtype=float)
+        psf_ratio = psf_resample.sample(psf_in[0].data,w,ra,dec,options.interpolation,edge='clamp')
 
         # Get the PSF information
         a_in = fits.open(aimage)
         b_in = fits.open(bimage)
         pa_in = fits.open(paimage)
-        a = a_in[0].data[decclip,raclip]
-        b = b_in[0].data[decclip,raclip]
-        pa = pa_in[0].data[decclip,raclip]
+        a = psf_resample.sample(a_in[0].data,w,ra,dec,options.interpolation,edge='clamp')
+        b = psf_resample.sample(b_in[0].data,w,ra,dec,options.interpolation,edge='clamp')
+        # Angles are not interpolated
+        pa = psf_resample.sample(pa_in[0].data,w,ra,dec,'nearest',edge='clamp')
 
         # Scale the peak fluxes
         if options.scaleint: